@@ -0,0 +1,199 @@
+import asyncio
+import glob
+import os
+from collections import deque
+from datetime import datetime
+
+import orjson
+from bson import ObjectId
+
+from app import database, storage
+from app.ratelimit import client_ip
+from app.utils import ndjson_lines
+
+# Nhật ký audit (đăng nhập, refresh, logout, đổi quyền, xóa user...). record() chỉ
+# đưa sự kiện vào hàng đợi trong bộ nhớ, không chờ DB: task nền ghi theo lô
+# (tối đa AUDIT_BATCH_SIZE sự kiện hoặc mỗi AUDIT_FLUSH_SECONDS giây).
+# Hàng đợi đầy thì AUDIT_OVERFLOW=drop bỏ sự kiện (có đếm), =spill ghi ra file
+# NDJSON riêng của từng worker (AUDIT_SPILL_PATH.<pid>). Khi khởi động, worker giữ
+# lock audit_replay nạp lại file của các worker đã chết. Mỗi sự kiện có _id từ
+# lúc record() nên nạp lại hai lần vào Mongo không sinh bản trùng.
+AUDIT_ENABLED = os.getenv("AUDIT_ENABLED", "1") == "1"
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", "1"))
+AUDIT_OVERFLOW = os.getenv("AUDIT_OVERFLOW", "drop")
+AUDIT_SPILL_PATH = os.getenv("AUDIT_SPILL_PATH", "audit-spill.ndjson")
+
+_queue = deque()
+_wake = None
+_task = None
+_spill = None
+_stats = {"recorded": 0, "flushed": 0, "batches": 0, "dropped": 0, "spilled": 0, "replayed": 0, "flush_errors": 0}
+
+def _spill_path(pid: int = None):
+    return f"{AUDIT_SPILL_PATH}.{pid or os.getpid()}"
+
+def _overflow(docs):
+    global _spill
+    if AUDIT_OVERFLOW == "spill":
+        try:
+            if _spill is None:
+                _spill = open(_spill_path(), "ab", buffering=0)
+            _spill.write(ndjson_lines(docs))
+            _stats["spilled"] += len(docs)
+            return
+        except OSError as e:
+            print(f"⚠️ Audit spill failed: {e}")
+    _stats["dropped"] += len(docs)
+
+def record(event: str, request=None, **fields):
+    # Không bao giờ chặn request: chỉ thêm vào hàng đợi
+    if not AUDIT_ENABLED:
+        return
+    doc = {"_id": ObjectId(), "event": event, "at": datetime.utcnow()}
+    doc.update((k, v) for k, v in fields.items() if v is not None)
+    if request is not None:
+        doc["ip"] = client_ip(request)
+    _stats["recorded"] += 1
+    if len(_queue) >= AUDIT_QUEUE_SIZE:
+        _overflow([doc])
+        return
+    _queue.append(doc)
+    if len(_queue) >= AUDIT_BATCH_SIZE and _wake is not None:
+        _wake.set()
+
+async def flush():
+    # Ghi hết hàng đợi theo lô; lô lỗi được trả lại đầu hàng đợi cho lần sau
+    while _queue:
+        batch = [_queue.popleft() for _ in range(min(AUDIT_BATCH_SIZE, len(_queue)))]
+        try:
+            await storage.get_storage().insert_events(batch)
+        except Exception as e:
+            _stats["flush_errors"] += 1
+            print(f"⚠️ Audit flush failed ({len(batch)} events): {e}")
+            room = max(AUDIT_QUEUE_SIZE - len(_queue), 0)
+            _overflow(batch[room:])
+            _queue.extendleft(reversed(batch[:room]))
+            return
+        _stats["flushed"] += len(batch)
+        _stats["batches"] += 1
+
+async def _flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), AUDIT_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        await flush()
+        if _queue:
+            # DB đang lỗi: chờ hết chu kỳ thay vì thử lại liên tục
+            await asyncio.sleep(AUDIT_FLUSH_SECONDS)
+
+def _pid_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _orphan_spills():
+    # File của worker đã chết (đang không ai mở để ghi) và file .replay còn sót
+    # từ lần nạp bị ngắt. File mang pid của chính tiến trình này là của tiến
+    # trình cũ trùng pid: spill của tiến trình này chỉ mở khi hàng đợi đầy.
+    # .replay trước: đổi tên file cùng pid sau đó không đè lên file chưa nạp xong
+    paths = glob.glob(glob.escape(AUDIT_SPILL_PATH) + ".*")
+    for path in sorted(paths, key=lambda p: (not p.endswith(".replay"), p)):
+        suffix = path[len(AUDIT_SPILL_PATH) + 1:].removesuffix(".replay")
+        if not suffix.isdigit():
+            continue
+        pid = int(suffix)
+        if path.endswith(".replay") or pid == os.getpid() or not _pid_alive(pid):
+            yield path
+
+async def _insert_replayed(batch):
+    await storage.get_storage().insert_events(batch)
+    _stats["replayed"] += len(batch)
+
+async def _replay_file(path: str):
+    # Đổi tên trước khi đọc: file .replay còn lại nghĩa là lần nạp trước bị ngắt,
+    # nạp lại từ đầu (Mongo bỏ qua _id đã có)
+    if not path.endswith(".replay"):
+        os.replace(path, path + ".replay")
+        path += ".replay"
+    batch = []
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            doc = orjson.loads(line)
+            doc["at"] = datetime.fromisoformat(doc["at"])
+            if "_id" in doc:
+                doc["_id"] = ObjectId(doc["_id"])
+            batch.append(doc)
+            if len(batch) >= AUDIT_BATCH_SIZE:
+                await _insert_replayed(batch)
+                batch = []
+    if batch:
+        await _insert_replayed(batch)
+    os.remove(path)
+
+async def _replay_spills():
+    # Backend nhúng chỉ chạy một worker nên không cần lock
+    locked = storage.is_embedded() or await database.acquire_lock("audit_replay")
+    if not locked:
+        return
+    try:
+        for path in _orphan_spills():
+            await _replay_file(path)
+            print(f"✅ Audit spill replayed: {path}")
+    finally:
+        if not storage.is_embedded():
+            await database.release_lock("audit_replay")
+
+async def start():
+    global _task, _wake
+    if not AUDIT_ENABLED:
+        return
+    try:
+        await _replay_spills()
+    except Exception as e:
+        print(f"⚠️ Could not replay audit spill: {e}")
+    if _task is None:
+        _wake = asyncio.Event()
+        _task = asyncio.create_task(_flush_loop())
+
+async def stop():
+    global _task, _spill
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    await flush()
+    if _queue:
+        # DB không ghi được lúc tắt: ra file spill nếu bật, không thì mất (có đếm)
+        _overflow(list(_queue))
+        _queue.clear()
+    if _spill is not None:
+        _spill.close()
+        _spill = None
+
+async def iter_events(filters: dict = None, batch_size: int = 500):
+    async for docs in storage.get_storage().iter_events(filters, batch_size):
+        yield docs
+
+def get_stats():
+    return {
+        **_stats,
+        "enabled": AUDIT_ENABLED,
+        "queued": len(_queue),
+        "queue_size": AUDIT_QUEUE_SIZE,
+        "batch_size": AUDIT_BATCH_SIZE,
+        "overflow": AUDIT_OVERFLOW,
+    }
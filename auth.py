@@ -1,97 +1,174 @@
-from datetime import datetime, timedelta
-from passlib.context import CryptContext
-from jose import jwt, JWTError
-from uuid import uuid4
-from fastapi import HTTPException, status
-from typing import Optional
-import os  # THÊM IMPORT OS
-
-from app.database import db
-
-# SỬA: Dùng biến môi trường thống nhất
-SECRET_KEY = os.getenv("APP_SECRET_KEY", "CHANGE_THIS_SECRET_KEY_FOR_SESSION")
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
-REFRESH_TOKEN_EXPIRE_DAYS = 30
-
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
-
-def hash_password(password: str):
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-
-def create_refresh_token(user_id: str):
-    token = str(uuid4())
-    expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-
-    db["refresh_tokens"].insert_one({
-        "token": token,
-        "user_id": user_id,
-        "expires_at": expire,
-        "created_at": datetime.utcnow()
-    })
-
-    return token
-
-def revoke_refresh_token(token: str):
-    db["refresh_tokens"].delete_one({"token": token})
-
-def revoke_all_user_refresh_tokens(user_id: str):
-    db["refresh_tokens"].delete_many({"user_id": user_id})
-
-def is_refresh_token_valid(token: str):
-    doc = db["refresh_tokens"].find_one({"token": token})
-    if not doc:
-        return None
-    if doc["expires_at"] < datetime.utcnow():
-        db["refresh_tokens"].delete_one({"token": token})
-        return None
-    return doc
-
-def add_to_blacklist(token: str):
-    try:
-        # THÊM: Cho phép decode không verify expiration
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False})
-        expire_time = datetime.utcfromtimestamp(payload["exp"]) if "exp" in payload else datetime.utcnow() + timedelta(days=1)
-        
-        db["token_blacklist"].insert_one({
-            "token": token,
-            "user_id": payload.get("user_id"),
-            "expires_at": expire_time,
-            "blacklisted_at": datetime.utcnow(),
-            "reason": "logout"
-        })
-    except JWTError:
-        # Nếu token không hợp lệ, vẫn thêm vào blacklist
-        db["token_blacklist"].insert_one({
-            "token": token,
-            "user_id": "unknown",
-            "expires_at": datetime.utcnow() + timedelta(days=1),
-            "blacklisted_at": datetime.utcnow(),
-            "reason": "invalid_token"
-        })
-
-def is_token_blacklisted(token: str):
-    doc = db["token_blacklist"].find_one({"token": token})
-    return doc is not None
-
-def revoke_all_user_tokens(user_id: str):
-    revoke_all_user_refresh_tokens(user_id)
-
-def decode_access_token(token: str):
-    try:
-        if is_token_blacklisted(token):
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
-        
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+from datetime import datetime, timedelta
+import jwt
+from uuid import uuid4
+import secrets
+import time
+from fastapi import HTTPException, status
+from typing import Optional
+import os  # THÊM IMPORT OS
+
+from app import audit, cache, revocation, jwt_keys, refresh_store, token_store
+from app.metrics import timed
+from app.hashing import pwd_context, hash_password_async, verify_password_async
+
+# Khóa ký/verify nằm ở app.jwt_keys (HS256 hoặc RS256/EdDSA theo JWT_ALGORITHM)
+SECRET_KEY = jwt_keys.SECRET_KEY
+ALGORITHM = jwt_keys.ALGORITHM
+ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
+REFRESH_TOKEN_EXPIRE_DAYS = 30
+
+# Chế độ stateless: access token mang đủ thông tin UserOut + version,
+# get_current_user không cần đọc user từ DB (xem deps.get_current_user)
+AUTH_STATELESS = os.getenv("AUTH_STATELESS", "0") == "1"
+AUTH_RECHECK_SECONDS = int(os.getenv("AUTH_RECHECK_SECONDS", "300"))
+
+# Argon2 chạy trong pool riêng (app.hashing) để không chặn event loop
+async def hash_password(password: str):
+    return await hash_password_async(password)
+
+async def verify_password(plain_password: str, hashed_password: str):
+    return await verify_password_async(plain_password, hashed_password)
+
+def user_claims(user: dict):
+    claims = {"user_id": user.get("_id"), "role": user.get("role")}
+    if AUTH_STATELESS:
+        claims.update({
+            "username": user.get("username"),
+            "email": user.get("email"),
+            "ver": user.get("version", 0),
+        })
+    return claims
+
+def user_from_claims(payload: dict):
+    # Trả về None nếu claim thiếu, đã cũ hoặc đã quá hạn kiểm tra lại với DB
+    if not AUTH_STATELESS or "ver" not in payload:
+        return None
+    user_id = payload.get("user_id")
+    if not user_id or not payload.get("username") or not payload.get("role"):
+        return None
+    # iat là epoch UTC; datetime.utcnow().timestamp() sẽ bị coi là giờ địa phương
+    if time.time() - payload.get("iat", 0) > AUTH_RECHECK_SECONDS:
+        return None
+    if not cache.is_user_version_current(user_id, payload["ver"]):
+        return None
+    return {
+        "_id": user_id,
+        "username": payload["username"],
+        "email": payload.get("email"),
+        "role": payload["role"],
+        "version": payload["ver"],
+    }
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    to_encode = data.copy()
+    now = datetime.utcnow()
+    expire = now + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    to_encode.update({"exp": expire, "iat": now})
+    with timed("jwt", "encode"):
+        return jwt_keys.encode(to_encode)
+
+def _refresh_token_hash(token: str):
+    return revocation.token_hash(token)
+
+def _refresh_record(token: str, user_id: str, family_id: str):
+    now = datetime.utcnow()
+    return {
+        "token_hash": _refresh_token_hash(token),
+        "user_id": user_id,
+        "family_id": family_id,
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        "created_at": now,
+        "used_at": None,
+        "replaced_by": None,
+        "revoked": False,
+    }
+
+async def create_refresh_token(user_id: str):
+    # Chỉ lưu hash; family_id nối các token sinh ra từ cùng một lần đăng nhập
+    token = secrets.token_urlsafe(32)
+    await refresh_store.get_store().insert(_refresh_record(token, user_id, uuid4().hex))
+    return token
+
+async def revoke_refresh_token(token: str):
+    await refresh_store.get_store().delete(_refresh_token_hash(token))
+
+async def revoke_all_user_refresh_tokens(user_id: str):
+    await refresh_store.get_store().revoke_user(user_id)
+
+async def is_refresh_token_valid(token: str):
+    # Token đã đổi (used_at) không còn hợp lệ, nhưng không tính là dùng lại ở đây
+    h = _refresh_token_hash(token)
+    doc = await refresh_store.get_store().get(h)
+    if not doc or doc.get("revoked") or doc.get("used_at"):
+        return None
+    if doc["expires_at"] < datetime.utcnow():
+        await refresh_store.get_store().delete(h)
+        return None
+    return doc
+
+async def rotate_refresh_token(token: str):
+    # Đổi token cũ lấy token mới cùng family, trả về (token mới, bản ghi cũ).
+    # Token đã đổi rồi mà còn được gửi lên => bị lộ: thu hồi cả family.
+    store = refresh_store.get_store()
+    h = _refresh_token_hash(token)
+    doc = await store.get(h)
+    if not doc or doc.get("revoked"):
+        return None
+    if doc["expires_at"] < datetime.utcnow():
+        await store.delete(h)
+        return None
+
+    new_token = secrets.token_urlsafe(32)
+    if not await store.mark_used(h, _refresh_token_hash(new_token)):
+        print(f"⚠️ Refresh token reuse detected for user {doc.get('user_id')}, revoking family {doc.get('family_id')}")
+        audit.record("refresh_reuse", user_id=doc.get("user_id"), family_id=doc.get("family_id"))
+        await store.revoke_family(doc["family_id"])
+        return None
+
+    await store.insert(_refresh_record(new_token, doc["user_id"], doc["family_id"]))
+    return new_token, doc
+
+async def add_to_blacklist(token: str):
+    try:
+        # THÊM: Cho phép decode không verify expiration
+        with timed("jwt", "decode"):
+            payload = jwt_keys.decode(token, verify_exp=False)
+        expire_time = datetime.utcfromtimestamp(payload["exp"]) if "exp" in payload else datetime.utcnow() + timedelta(days=1)
+        doc = {
+            "token": token,
+            "token_hash": revocation.token_hash(token),
+            "user_id": payload.get("user_id"),
+            "expires_at": expire_time,
+            "blacklisted_at": datetime.utcnow(),
+            "reason": "logout"
+        }
+    except jwt.PyJWTError:
+        # Nếu token không hợp lệ, vẫn thêm vào blacklist
+        doc = {
+            "token": token,
+            "token_hash": revocation.token_hash(token),
+            "user_id": "unknown",
+            "expires_at": datetime.utcnow() + timedelta(days=1),
+            "blacklisted_at": datetime.utcnow(),
+            "reason": "invalid_token"
+        }
+
+    await token_store.get_blacklist().add(doc)
+
+async def is_token_blacklisted(token: str):
+    # Backend Mongo tra trong bộ nhớ (app.revocation); Redis là một lệnh EXISTS
+    return await token_store.get_blacklist().is_revoked(token)
+
+async def revoke_all_user_tokens(user_id: str):
+    await revoke_all_user_refresh_tokens(user_id)
+
+async def decode_access_token(token: str):
+    try:
+        if await is_token_blacklisted(token):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+        
+        with timed("jwt", "decode"):
+            payload = jwt_keys.decode(token)
+        return payload
+    except jwt.PyJWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token invalid or expired")
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""Chọn tham số Argon2 cho thời gian verify mục tiêu trên máy đang chạy.
+
+    python -m app.benchmarks.bench_argon2 --target-ms 250
+    python -m app.benchmarks.bench_argon2 --target-ms 100 --memory 19456,47104 --parallelism 1 -o argon2.json
+
+Với mỗi memory_cost (KiB), tăng time_cost từ 1 cho tới khi median verify vượt
+--target-ms; trong các tổ hợp đạt mục tiêu chọn memory_cost lớn nhất (độ khó
+của Argon2 nằm ở bộ nhớ), rồi time_cost lớn nhất với memory đó. Kết quả in ra dạng
+biến môi trường ARGON2_*; user cũ được băm lại khi đăng nhập (hashing.needs_update).
+Chạy trên đúng loại máy chạy app: mỗi worker của pool băm chiếm một core, nên
+thông lượng login tối đa xấp xỉ HASH_POOL_SIZE / thời gian verify.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from app import hashing
+from app.benchmarks.bench_auth import BENCH_PASSWORD, _git_commit
+
+def _measure(time_cost, memory_cost, parallelism, rounds):
+    context = hashing.make_context(time_cost, memory_cost, parallelism)
+    password_hash = context.hash(BENCH_PASSWORD)
+    context.verify(BENCH_PASSWORD, password_hash)  # làm nóng bộ nhớ trước khi đo
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        context.verify(BENCH_PASSWORD, password_hash)
+        samples.append(time.perf_counter() - start)
+    return round(statistics.median(samples) * 1000, 3)
+
+def calibrate(args):
+    results = []
+    for memory_cost in args.memory:
+        for time_cost in range(1, args.max_time_cost + 1):
+            ms = _measure(time_cost, memory_cost, args.parallelism, args.rounds)
+            fits = ms <= args.target_ms
+            results.append({"time_cost": time_cost, "memory_cost": memory_cost, "parallelism": args.parallelism,
+                            "verify_ms": ms, "fits": fits})
+            print(f"  m={memory_cost:<8} t={time_cost:<3} p={args.parallelism:<3} {ms:>10.3f} ms {'✅' if fits else '❌'}")
+            if not fits:
+                break
+    fitting = [r for r in results if r["fits"]]
+    best = max(fitting, key=lambda r: (r["memory_cost"], r["time_cost"])) if fitting else None
+    return results, best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.benchmarks.bench_argon2")
+    parser.add_argument("--target-ms", type=float, default=250.0, help="Median verify time budget per login")
+    parser.add_argument("--memory", type=lambda s: [int(x) for x in s.split(",") if x], default=[19456, 47104, 65536, 131072],
+                        help="memory_cost candidates in KiB")
+    parser.add_argument("--parallelism", type=int, default=hashing.ARGON2_PARALLELISM)
+    parser.add_argument("--max-time-cost", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("-o", "--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    print(f"Argon2 calibration (target {args.target_ms} ms, {os.cpu_count()} CPUs)")
+    current = _measure(hashing.ARGON2_TIME_COST, hashing.ARGON2_MEMORY_COST, hashing.ARGON2_PARALLELISM, args.rounds)
+    print(f"  current: t={hashing.ARGON2_TIME_COST} m={hashing.ARGON2_MEMORY_COST} "
+          f"p={hashing.ARGON2_PARALLELISM} -> {current} ms")
+    results, best = calibrate(args)
+    if best is None:
+        print(f"❌ No candidate verifies within {args.target_ms} ms, try smaller --memory values")
+    else:
+        print(f"✅ Best within budget: {best['verify_ms']} ms "
+              f"(~{hashing.HASH_POOL_SIZE * 1000 / best['verify_ms']:.1f} logins/s with HASH_POOL_SIZE={hashing.HASH_POOL_SIZE})")
+        print(f"ARGON2_TIME_COST={best['time_cost']}")
+        print(f"ARGON2_MEMORY_COST={best['memory_cost']}")
+        print(f"ARGON2_PARALLELISM={best['parallelism']}")
+    if args.output:
+        report = {
+            "meta": {
+                "timestamp": datetime.utcnow().isoformat(),
+                "commit": _git_commit(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "target_ms": args.target_ms,
+            },
+            "current_ms": current,
+            "candidates": results,
+            "best": best,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+    return 0 if best else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
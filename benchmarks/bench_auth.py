@@ -0,0 +1,277 @@
+"""Benchmark các hot path xác thực, chạy hoàn toàn trong process (không cần mạng).
+
+    python -m app.benchmarks.bench_auth --concurrency 16 --requests 2000 -o bench.json
+    python -m app.benchmarks.bench_auth --compare base.json bench.json
+
+Mặc định dùng mongomock-motor làm backend; truyền --mongo-url (hoặc BENCH_MONGO_URL)
+để chạy với mongod cục bộ, hoặc --storage sqlite|memory cho backend nhúng (app.storage).
+Kết quả ghi ra JSON để so sánh giữa các commit.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+# Benchmark bắn hàng nghìn /login từ cùng một IP: tắt rate limit trước khi import app
+os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+
+BENCH_PASSWORD = "bench-password"
+SCENARIOS = ["login", "refresh", "users_me", "users_list"]
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+def _summary(latencies, elapsed, errors):
+    s = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "requests": len(s),
+        "errors": errors,
+        "rps": round(len(s) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": ms(sum(s) / len(s)) if s else 0.0,
+        "p50_ms": ms(_percentile(s, 50)),
+        "p95_ms": ms(_percentile(s, 95)),
+        "p99_ms": ms(_percentile(s, 99)),
+        "max_ms": ms(s[-1]) if s else 0.0,
+    }
+
+async def _run_scenario(make_request, total, concurrency):
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker(worker_id):
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            r = await make_request(worker_id, i)
+            latencies.append(time.perf_counter() - start)
+            if r.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(w) for w in range(concurrency)])
+    return _summary(latencies, time.perf_counter() - start, errors)
+
+async def _login(client, username, password=BENCH_PASSWORD):
+    r = await client.post("/login", json={"username": username, "password": password})
+    r.raise_for_status()
+    return r.json()
+
+async def _seed_users(count):
+    from app.auth import hash_password
+    from app.crud_user import insert_users
+
+    # Băm một lần rồi dùng lại, seed không phải là thứ cần đo
+    password_hash = await hash_password(BENCH_PASSWORD)
+    now = datetime.utcnow()
+    docs = [{
+        "username": f"bench{i}",
+        "email": f"bench{i}@example.com",
+        "password_hash": password_hash,
+        "role": "user",
+        "version": 1,
+        "created_at": now,
+    } for i in range(count)]
+    for i in range(0, len(docs), 1000):
+        await insert_users(docs[i:i + 1000])
+
+async def bench_endpoints(args):
+    from app import database
+
+    if args.storage == "mongo" and args.mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        database.DATABASE_NAME = args.db_name
+        client = AsyncIOMotorClient(args.mongo_url)
+        await client.drop_database(args.db_name)
+        database.connect(client)
+    elif args.storage == "mongo":
+        from mongomock_motor import AsyncMongoMockClient
+        database.connect(AsyncMongoMockClient())
+
+    from app.main import app, bootstrap_state
+
+    results = {}
+    async with app.router.lifespan_context(app):
+        while not bootstrap_state["ready"]:
+            await asyncio.sleep(0.05)
+        await _seed_users(max(args.users, args.concurrency))
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            admin = await _login(client, "admin", "admin123")
+            admin_headers = {"Authorization": f"Bearer {admin['access_token']}"}
+            # Mỗi worker dùng một user riêng để refresh token không bị dùng chung
+            sessions = [await _login(client, f"bench{w}") for w in range(args.concurrency)]
+
+            async def login(w, i):
+                return await client.post("/login", json={"username": f"bench{i % args.users}", "password": BENCH_PASSWORD})
+
+            async def refresh(w, i):
+                r = await client.post("/refresh", json={"refresh_token": sessions[w]["refresh_token"]})
+                if r.status_code == 200:
+                    sessions[w]["refresh_token"] = r.json()["refresh_token"]
+                return r
+
+            async def users_me(w, i):
+                return await client.get("/users/me", headers={"Authorization": f"Bearer {sessions[w]['access_token']}"})
+
+            async def users_list(w, i):
+                return await client.get("/users", params={"limit": 100}, headers=admin_headers)
+
+            scenarios = {"login": login, "refresh": refresh, "users_me": users_me, "users_list": users_list}
+            for name in args.scenarios:
+                # login chạy argon2, giảm số request để benchmark không quá lâu
+                total = max(args.concurrency, args.requests // 10) if name == "login" else args.requests
+                results[name] = await _run_scenario(scenarios[name], total, args.concurrency)
+                print(f"  {name:<12} {_format(results[name])}")
+    return results
+
+def _bench_sync(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return _micro_summary(time.perf_counter() - start, iterations)
+
+async def _bench_async(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await fn()
+    return _micro_summary(time.perf_counter() - start, iterations)
+
+def _micro_summary(elapsed, iterations):
+    return {
+        "iterations": iterations,
+        "us_per_op": round(elapsed / iterations * 1e6, 3),
+        "ops_per_s": round(iterations / elapsed, 1),
+    }
+
+async def bench_micro(args):
+    from bson import ObjectId
+    from app import hashing
+    from app.auth import create_access_token, decode_access_token, verify_password, hash_password
+    from app.utils import oid_str, user_out
+
+    n = args.micro_iterations
+    claims = {"user_id": str(ObjectId()), "role": "user"}
+    token = create_access_token(claims)
+    password_hash = await hash_password(BENCH_PASSWORD)
+    doc = {
+        "_id": ObjectId(), "username": "alice", "email": "alice@example.com",
+        "password_hash": password_hash, "role": "user", "version": 3, "created_at": datetime.utcnow(),
+    }
+
+    results = {
+        "create_access_token": _bench_sync(lambda: create_access_token(claims), n),
+        "decode_access_token": await _bench_async(lambda: decode_access_token(token), n),
+        "verify_password_inline": _bench_sync(lambda: hashing._verify(BENCH_PASSWORD, password_hash), args.hash_iterations),
+        "verify_password_pool": await _bench_async(lambda: verify_password(BENCH_PASSWORD, password_hash), args.hash_iterations),
+        "oid_str": _bench_sync(lambda: oid_str(doc), n * 10),
+        "user_out": _bench_sync(lambda: user_out(doc), n * 10),
+    }
+    hashing.shutdown()
+    for name, r in results.items():
+        print(f"  {name:<24} {r['us_per_op']:>12.3f} us/op {r['ops_per_s']:>14.1f} ops/s")
+    return results
+
+def _format(r):
+    return (f"{r['rps']:>9.1f} req/s  p50 {r['p50_ms']:>8.3f}  p95 {r['p95_ms']:>8.3f}  "
+            f"p99 {r['p99_ms']:>8.3f} ms  errors {r['errors']}")
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except Exception:
+        return None
+
+def compare(base_path, new_path):
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def pct(a, b):
+        return f"{(b - a) / a * 100:+7.1f}%" if a else "    n/a"
+
+    print(f"{base['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    for name, r in new.get("endpoints", {}).items():
+        b = base.get("endpoints", {}).get(name)
+        if b:
+            print(f"  {name:<24} rps {pct(b['rps'], r['rps'])}  p50 {pct(b['p50_ms'], r['p50_ms'])}  "
+                  f"p95 {pct(b['p95_ms'], r['p95_ms'])}  p99 {pct(b['p99_ms'], r['p99_ms'])}")
+    for name, r in new.get("micro", {}).items():
+        b = base.get("micro", {}).get(name)
+        if b:
+            print(f"  {name:<24} us/op {pct(b['us_per_op'], r['us_per_op'])}")
+
+async def main_async(args):
+    results = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "backend": args.storage if args.storage != "mongo" else "mongod" if args.mongo_url else "mongomock",
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "users": args.users,
+        },
+    }
+    if args.scenarios:
+        print(f"Endpoints (concurrency={args.concurrency}, backend={results['meta']['backend']})")
+        results["endpoints"] = await bench_endpoints(args)
+    if not args.skip_micro:
+        print("Microbenchmarks")
+        results["micro"] = await bench_micro(args)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.benchmarks.bench_auth")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--scenarios", type=lambda s: [x for x in s.split(",") if x], default=SCENARIOS)
+    parser.add_argument("--micro-iterations", type=int, default=2000)
+    parser.add_argument("--hash-iterations", type=int, default=20)
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--mongo-url", default=os.getenv("BENCH_MONGO_URL"))
+    parser.add_argument("--db-name", default="user_db_bench")
+    parser.add_argument("--storage", choices=["mongo", "sqlite", "memory"], default=os.getenv("STORAGE_BACKEND", "mongo"))
+    parser.add_argument("-o", "--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Diff two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # app.storage đọc biến môi trường khi import, nên phải đặt trước lần import app đầu tiên
+    os.environ["STORAGE_BACKEND"] = args.storage
+    if args.storage == "sqlite" and "SQLITE_PATH" not in os.environ:
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_auth_"), "bench.db")
+    results = asyncio.run(main_async(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
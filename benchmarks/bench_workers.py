@@ -0,0 +1,163 @@
+"""Đo throughput khi tăng số worker của `python -m app.cli serve`.
+
+    python -m app.benchmarks.bench_workers --workers 1,2,4 --mongo-url mongodb://localhost:27017
+    python -m app.benchmarks.bench_workers --workers 1,2 --scenarios health
+
+Mỗi số worker khởi động một server thật trên cổng local rồi bắn tải qua HTTP từ
+--load-procs tiến trình (một tiến trình Python khó tạo đủ tải cho nhiều worker).
+Các worker là tiến trình riêng nên cần mongod thật; riêng kịch bản health không
+chạm tới DB.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+from app.benchmarks.bench_auth import _summary, _format, _git_commit
+
+SCENARIOS = ["health", "users_me", "login"]
+
+def _load_process(url, scenario, total, concurrency, headers):
+    # Chạy trong tiến trình con: trả về latency thô để gộp percentile chính xác
+    async def run():
+        latencies = []
+        errors = 0
+        counter = iter(range(total))
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+            async def request():
+                if scenario == "health":
+                    return await client.get("/health")
+                if scenario == "users_me":
+                    return await client.get("/users/me", headers=headers)
+                return await client.post("/login", json={"username": "admin", "password": "admin123"})
+
+            async def worker():
+                nonlocal errors
+                for _ in counter:
+                    start = time.perf_counter()
+                    try:
+                        r = await request()
+                        if r.status_code >= 400:
+                            errors += 1
+                    except httpx.HTTPError:
+                        errors += 1
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+            return latencies, errors, time.perf_counter() - start
+
+    return asyncio.run(run())
+
+def _wait_ready(url, path, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url + path, timeout=1).status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def bench_workers(workers, args, pool):
+    url = f"http://127.0.0.1:{args.port}"
+    env = {
+        **os.environ,
+        "MONGO_URL": args.mongo_url,
+        "MONGO_DB": args.db_name,
+        # Tải đến từ một IP, không đo rate limit ở đây
+        "RATE_LIMIT_ENABLED": "0",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.cli", "serve", "--workers", str(workers),
+         "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        needs_db = any(s != "health" for s in args.scenarios)
+        if not _wait_ready(url, "/ready" if needs_db else "/health", args.startup_timeout):
+            raise RuntimeError(f"server with {workers} worker(s) not ready after {args.startup_timeout}s")
+
+        headers = {}
+        if needs_db:
+            r = httpx.post(url + "/login", json={"username": "admin", "password": "admin123"}, timeout=30)
+            r.raise_for_status()
+            headers = {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+        results = {}
+        for name in args.scenarios:
+            total = args.requests // 10 if name == "login" else args.requests
+            per_proc = max(1, total // args.load_procs)
+            parts = pool.starmap(_load_process, [(url, name, per_proc, args.concurrency, headers)] * args.load_procs)
+            latencies = [v for part in parts for v in part[0]]
+            errors = sum(part[1] for part in parts)
+            results[name] = _summary(latencies, max(part[2] for part in parts), errors)
+            print(f"  workers={workers:<3} {name:<10} {_format(results[name])}")
+        return results
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.benchmarks.bench_workers")
+    parser.add_argument("--workers", type=lambda s: [int(x) for x in s.split(",") if x], default=[1, 2, 4])
+    parser.add_argument("--scenarios", type=lambda s: [x for x in s.split(",") if x], default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32, help="Connections per load process")
+    parser.add_argument("--load-procs", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--mongo-url", default=os.getenv("BENCH_MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default="user_db_bench_workers")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("-o", "--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "commit": _git_commit(),
+            "cpus": os.cpu_count(),
+            "load_procs": args.load_procs,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+        },
+        "workers": {},
+    }
+    print(f"Worker scaling (cpus={os.cpu_count()}, load_procs={args.load_procs}, concurrency={args.concurrency})")
+    with multiprocessing.get_context("spawn").Pool(args.load_procs) as pool:
+        for n in args.workers:
+            results["workers"][str(n)] = bench_workers(n, args, pool)
+
+    base = results["workers"][str(args.workers[0])]
+    print(f"Speedup vs {args.workers[0]} worker(s)")
+    for n in args.workers:
+        line = "  ".join(
+            f"{name} x{r['rps'] / base[name]['rps']:.2f}" if base[name]["rps"] else f"{name} n/a"
+            for name, r in results["workers"][str(n)].items()
+        )
+        print(f"  workers={n:<3} {line}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"✅ Results written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import codecs
+import csv
+import io
+import json
+import os
+from collections import deque
+from datetime import datetime
+from pydantic import ValidationError
+
+from app.schemas import UserImport
+from app.crud_user import insert_users, iter_user_batches
+from app.utils import oid_str, ndjson_lines
+from app.hashing import hash_many_async
+
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+EXPORT_FIELDS = ["_id", "username", "email", "role", "created_at"]
+
+async def iter_lines(chunks):
+    # Ghép các chunk bytes/str thành từng dòng, không cần đọc hết body vào bộ nhớ
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    async for chunk in chunks:
+        buf += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        *lines, buf = buf.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buf += decoder.decode(b"", final=True)
+    if buf:
+        yield buf.rstrip("\r")
+
+async def iter_rows(lines, fmt: str = "ndjson"):
+    """Sinh ra (row, error) cho từng dòng dữ liệu của NDJSON hoặc CSV (có header)."""
+    if fmt == "csv":
+        async for item in _iter_csv_rows(lines):
+            yield item
+        return
+    async for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield None, "Invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield None, "Row must be a JSON object"
+            continue
+        yield _clean(row), None
+
+def _clean(row: dict):
+    # Ô trống trong CSV coi như không có giá trị
+    return {k: v for k, v in row.items() if v not in ("", None)}
+
+class _PendingLines:
+    """Nguồn dòng cho csv.reader: trả các dòng đã nhận, hết thì dừng. Reader vẫn
+    đọc tiếp được sau khi nguồn tạm hết, nên một reader dùng cho cả file."""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+async def _iter_csv_rows(lines):
+    # Ô trong ngoặc kép có thể chứa xuống dòng: reader báo hết dữ liệu giữa chừng
+    # thì giữ các dòng của bản ghi lại và đọc lại từ đầu khi có thêm dòng
+    source = _PendingLines()
+    reader = csv.reader(source, strict=True)
+    header = None
+    record = []
+    async for line in lines:
+        if not record and not line.strip():
+            continue
+        record.append(line + "\n")
+        source.lines.extend(record)
+        try:
+            values = next(reader)
+        except csv.Error as e:
+            if "unexpected end of data" in str(e):
+                continue
+            record = []
+            yield None, f"Invalid CSV: {e}"
+            continue
+        record = []
+        if header is None:
+            header = [h.strip() for h in values]
+            continue
+        yield _clean(dict(zip(header, values))), None
+    if record:
+        yield None, "Invalid CSV: unterminated quoted field"
+
+async def _import_batch(batch):
+    results = {}
+    valid = []
+    for n, row, error in batch:
+        if error:
+            results[n] = {"row": n, "status": "error", "error": error}
+            continue
+        try:
+            valid.append((n, UserImport(**row)))
+        except ValidationError as e:
+            err = e.errors()[0]
+            field = ".".join(str(p) for p in err.get("loc", ()))
+            results[n] = {"row": n, "username": row.get("username"), "status": "error", "error": f"{field}: {err['msg']}"}
+
+    # Băm song song trên pool argon2, dòng đã có password_hash thì giữ nguyên
+    hashes = iter(await hash_many_async([u.password for _, u in valid if not u.password_hash]))
+    now = datetime.utcnow()
+    docs = [{
+        "username": u.username,
+        "email": u.email,
+        "password_hash": u.password_hash or next(hashes),
+        "role": u.role,
+        "version": 1,
+        "created_at": now,
+        "updated_at": now,
+    } for _, u in valid]
+
+    errors = await insert_users(docs)
+    for i, (n, u) in enumerate(valid):
+        if i in errors:
+            results[n] = {"row": n, "username": u.username, "status": "error", "error": errors[i]}
+        else:
+            results[n] = {"row": n, "username": u.username, "status": "created", "_id": str(docs[i]["_id"])}
+    return [results[n] for n, _, _ in batch]
+
+async def import_users(rows, batch_size: int = BULK_BATCH_SIZE):
+    results = []
+    batch = []
+    n = 0
+    async for row, error in rows:
+        n += 1
+        batch.append((n, row, error))
+        if len(batch) >= batch_size:
+            results.extend(await _import_batch(batch))
+            batch = []
+    if batch:
+        results.extend(await _import_batch(batch))
+    return results
+
+def summarize(results):
+    created = sum(1 for r in results if r["status"] == "created")
+    return {"total": len(results), "created": created, "failed": len(results) - created}
+
+async def export_users(fmt: str = "ndjson", include_hash: bool = False):
+    fields = EXPORT_FIELDS + (["password_hash"] if include_hash else [])
+    projection = {f: 1 for f in fields if f != "_id"}
+
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=fields, extrasaction="ignore", lineterminator="\n")
+        writer.writeheader()
+        yield buf.getvalue()
+        async for batch in iter_user_batches(projection=projection):
+            buf.seek(0)
+            buf.truncate()
+            writer.writerows(oid_str(d) for d in batch)
+            yield buf.getvalue()
+    else:
+        async for batch in iter_user_batches(projection=projection):
+            yield ndjson_lines(batch)
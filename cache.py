@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app import storage
+from app.database import get_db
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+# Kênh invalidation giữa các worker (tùy chọn), đi qua collection cache_invalidations.
+# Backend nhúng (SQLite/bộ nhớ) chỉ chạy một worker và không có Mongo: luôn tắt
+CACHE_BROADCAST = os.getenv("CACHE_BROADCAST", "0") == "1" and not storage.is_embedded()
+CACHE_BROADCAST_POLL_SECONDS = float(os.getenv("CACHE_BROADCAST_POLL_SECONDS", "2"))
+
+class TTLCache:
+    """LRU có thời hạn. Mọi thao tác đều đồng bộ, không có await ở giữa,
+    nên an toàn khi dùng chung trong một event loop."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def values(self):
+        now = time.monotonic()
+        return [value for expires, value in self._data.values() if expires >= now]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Version mới nhất đã biết của mỗi user, dùng cho chế độ AUTH_STATELESS.
+# Giữ lâu bằng thời hạn access token để phát hiện claim cũ.
+USER_VERSION_TTL = float(os.getenv("USER_VERSION_TTL", str(24 * 60 * 60)))
+DELETED = float("inf")
+user_versions = TTLCache(USER_CACHE_SIZE, USER_VERSION_TTL)
+
+def _user_keys(user_id=None, username=None):
+    keys = []
+    if user_id:
+        keys.append(f"id:{user_id}")
+    if username:
+        keys.append(f"username:{username}")
+    return keys
+
+def get_user_by_id(user_id: str):
+    return user_cache.get(f"id:{user_id}")
+
+def get_user_by_username(username: str):
+    return user_cache.get(f"username:{username}")
+
+def put_user(user: dict):
+    for key in _user_keys(user.get("_id"), user.get("username")):
+        user_cache.set(key, user)
+    note_user_version(user.get("_id"), user.get("version", 0))
+
+def note_user_version(user_id, version):
+    if not user_id or version is None:
+        return
+    known = user_versions.get(user_id)
+    if known is None or known < version:
+        user_versions.set(user_id, version)
+
+def is_user_version_current(user_id: str, version):
+    known = user_versions.get(user_id)
+    return known is None or version >= known
+
+async def invalidate_user(user_id=None, username=None, version=None, deleted=False):
+    keys = _user_keys(user_id, username)
+    for key in keys:
+        user_cache.delete(key)
+    if deleted:
+        version = DELETED
+    note_user_version(user_id, version)
+    if CACHE_BROADCAST and keys:
+        await get_db()["cache_invalidations"].insert_one({
+            "keys": keys,
+            "user_id": user_id,
+            "version": version,
+            "deleted": deleted,
+            "at": datetime.utcnow(),
+        })
+
+# Nhận invalidation từ worker khác
+_last_seen = None
+_task = None
+_broadcast_stats = {"received": 0, "poll_errors": 0}
+
+async def poll_once():
+    global _last_seen
+    query = {}
+    if _last_seen is not None:
+        query["at"] = {"$gte": _last_seen - timedelta(seconds=max(CACHE_BROADCAST_POLL_SECONDS, 1))}
+    async for doc in get_db()["cache_invalidations"].find(query, {"_id": 0}):
+        for key in doc.get("keys", []):
+            user_cache.delete(key)
+        version = DELETED if doc.get("deleted") else doc.get("version")
+        note_user_version(doc.get("user_id"), version)
+        _broadcast_stats["received"] += 1
+        if _last_seen is None or doc["at"] > _last_seen:
+            _last_seen = doc["at"]
+
+async def _poll_loop():
+    while True:
+        await asyncio.sleep(CACHE_BROADCAST_POLL_SECONDS)
+        try:
+            await poll_once()
+        except Exception as e:
+            _broadcast_stats["poll_errors"] += 1
+            print(f"⚠️ Cache invalidation poll failed: {e}")
+
+async def start():
+    global _task, _last_seen
+    if not CACHE_BROADCAST or _task is not None:
+        return
+    # Chỉ quan tâm các sự kiện phát sinh sau khi worker khởi động
+    _last_seen = datetime.utcnow()
+    _task = asyncio.create_task(_poll_loop())
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+def get_stats():
+    return {
+        "users": user_cache.stats(),
+        "user_versions": user_versions.stats(),
+        "broadcast": {**_broadcast_stats, "enabled": CACHE_BROADCAST},
+    }
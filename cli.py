@@ -0,0 +1,383 @@
+"""Công cụ dòng lệnh chạy offline, ví dụ:
+
+    python -m app.cli import-users users.csv
+    python -m app.cli export-users --format csv -o users.csv
+    python -m app.cli new-jwt-key --algorithm EdDSA --dir keys/
+    python -m app.cli serve --workers 4 --port 8080
+    python -m app.cli explain-users
+    python -m app.cli storage-parity --backends memory,sqlite,mongo
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from app import hashing, jwt_keys, storage
+from app.database import init_db, get_db, MIGRATIONS
+from app.storage import build_list_query, encode_cursor, list_projection
+from app.bulk import iter_lines, iter_rows, import_users, export_users, summarize, BULK_BATCH_SIZE
+
+async def _file_chunks(path: str):
+    f = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+def _detect_format(path: str, fmt: str):
+    if fmt:
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+async def cmd_import_users(args):
+    # Đảm bảo unique index tồn tại trước khi dựa vào nó để báo dòng trùng
+    await storage.init()
+    await hashing.start()
+    try:
+        rows = iter_rows(iter_lines(_file_chunks(args.file)), _detect_format(args.file, args.format))
+        results = await import_users(rows, batch_size=args.batch_size)
+    finally:
+        hashing.shutdown()
+
+    if args.results:
+        with open(args.results, "w", encoding="utf-8") as out:
+            for r in results:
+                out.write(json.dumps(r) + "\n")
+    else:
+        for r in results:
+            if r["status"] != "created":
+                print(f"❌ row {r['row']}: {r.get('error')}", file=sys.stderr)
+
+    summary = summarize(results)
+    print(f"✅ Imported {summary['created']}/{summary['total']} users ({summary['failed']} failed)", file=sys.stderr)
+    return 0 if summary["failed"] == 0 else 1
+
+async def cmd_export_users(args):
+    out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        async for chunk in export_users(args.format, args.include_hash):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+async def cmd_new_jwt_key(args):
+    # Xoay key: tạo key mới trong thư mục, đặt JWT_ACTIVE_KID=<kid> rồi khởi động lại;
+    # key cũ giữ lại để verify token đã phát tới khi chúng hết hạn
+    kid = args.kid or f"{args.algorithm.lower()}-{datetime.utcnow():%Y%m%d%H%M%S}"
+    os.makedirs(args.dir, exist_ok=True)
+    path = os.path.join(args.dir, f"{kid}.pem")
+    if os.path.exists(path):
+        print(f"❌ {path} already exists", file=sys.stderr)
+        return 1
+    key = jwt_keys.generate_private_key(args.algorithm)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(jwt_keys.private_key_pem(key))
+    print(f"✅ Wrote {path}", file=sys.stderr)
+    print(kid)
+    return 0
+
+def default_workers():
+    return int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+
+def cmd_serve(args):
+    import uvicorn
+
+    workers = args.workers or (1 if storage.is_embedded() else default_workers())
+    if workers > 1 and storage.is_embedded():
+        # Cache và blacklist của từng worker chỉ đồng bộ được qua Mongo/Redis
+        print(f"❌ STORAGE_BACKEND={storage.STORAGE_BACKEND} supports a single worker", file=sys.stderr)
+        return 1
+    if workers > 1:
+        # Cache từng worker nhận invalidation của worker khác qua Mongo (app.cache)
+        os.environ.setdefault("CACHE_BROADCAST", "1")
+        # Refresh token tiered giữ bản ghi trong bộ nhớ từng worker: request cùng token
+        # tới hai worker đều đổi được, và thu hồi chậm tới REFRESH_CACHE_TTL. Mongo
+        # kiểm tra dùng lại nguyên tử (find_one_and_update) nên an toàn cho nhiều worker
+        if os.getenv("TOKEN_BACKEND") != "redis":
+            os.environ.setdefault("REFRESH_STORE", "mongo")
+        # Chia CPU cho pool Argon2 của các worker, tránh N worker x N process băm
+        os.environ.setdefault("HASH_POOL_SIZE", str(max(1, (os.cpu_count() or 1) // workers)))
+        # Worker đọc WEB_CONCURRENCY (jwt_keys không cho key tạm khi có nhiều worker);
+        # kiểm tra key ở đây để báo lỗi một lần thay vì ở từng worker
+        os.environ["WEB_CONCURRENCY"] = str(workers)
+        try:
+            jwt_keys.load_keys()
+        except (RuntimeError, ValueError) as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+    print(f"🚀 Serving on {args.host}:{args.port} with {workers} worker(s)", file=sys.stderr)
+    # Migration và tạo admin chỉ chạy ở worker giữ lock startup (database.init_db)
+    uvicorn.run(
+        "app.main:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        log_level=args.log_level,
+        proxy_headers=args.proxy_headers,
+        timeout_keep_alive=args.keep_alive,
+    )
+    return 0
+
+def _explain_cases():
+    now = datetime.utcnow()
+    week = {"created_from": now - timedelta(days=7), "created_to": now}
+    cases = [
+        {},
+        {"role": "user"},
+        week,
+        {"role": "user", **week},
+        {"username_prefix": "ad"},
+        {"role": "admin", "username_prefix": "ad"},
+        {"email_prefix": "ad"},
+        {"role": "admin", "email_prefix": "ad"},
+        {"role": "user", "username_prefix": "ad", **week},
+    ]
+    # Trang thứ hai (có cursor) cũng phải dùng index
+    sample = {"_id": ObjectId(), "username": "admin", "email": "admin@example.com", "created_at": now}
+    return [(f, None) for f in cases] + [
+        (f, encode_cursor(sample, build_list_query(f)[2])) for f in cases
+    ]
+
+def _plan_stages(plan):
+    yield plan.get("stage")
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            yield from _plan_stages(child)
+
+async def cmd_explain_users(args):
+    # Cần mongod thật: chạy explain cho từng tổ hợp bộ lọc của GET /users và báo
+    # lỗi nếu plan thắng có COLLSCAN hoặc SORT trong bộ nhớ
+    await init_db()
+    users = get_db()["users"]
+    failed = 0
+    for filters, after in _explain_cases():
+        query, sort, field = build_list_query(filters, after)
+        plan = await users.find(query, list_projection(field)).sort(sort).limit(args.limit).explain()
+        winning = plan["queryPlanner"]["winningPlan"]
+        stages = list(_plan_stages(winning.get("queryPlan", winning)))
+        stats = plan.get("executionStats", {})
+        bad = {"COLLSCAN", "SORT"} & set(stages)
+        failed += bool(bad)
+        label = ",".join(k for k, v in filters.items() if v) or "(none)"
+        print(f"{'❌' if bad else '✅'} {label:<40} {'page2' if after else 'page1'} "
+              f"{'>'.join(s for s in stages if s)}  "
+              f"examined {stats.get('totalDocsExamined', '?')} returned {stats.get('nReturned', '?')}")
+    return 1 if failed else 0
+
+def _normalize(value):
+    # So sánh được giữa các backend: id thành chuỗi, thời điểm làm tròn mili giây như BSON
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000).isoformat()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple, set)):
+        items = [_normalize(v) for v in value]
+        return sorted(items, key=str) if isinstance(value, set) else items
+    return value
+
+async def _parity_script(store, seed):
+    # Cùng một chuỗi thao tác cho mọi backend; trả về [(bước, kết quả)] để so sánh
+    out = []
+
+    async def step(name, coro):
+        try:
+            out.append((name, _normalize(await coro)))
+        except storage.DuplicateUserError as e:
+            out.append((name, f"duplicate {e.field}"))
+        except ValueError as e:
+            out.append((name, f"ValueError {e}"))
+
+    users = [dict(u) for u in seed]
+    for u in users[:4]:
+        await step(f"insert {u['username']}", store.insert_user(u))
+    await step("insert duplicate username", store.insert_user({**users[0], "_id": ObjectId(), "email": "other@example.com"}))
+    await step("insert duplicate email", store.insert_user({**users[1], "_id": ObjectId(), "username": "other"}))
+    await step("insert_users", store.insert_users([users[4], {**users[5], "username": users[0]["username"]}, users[6]]))
+
+    await step("find by username", store.find_user_by_username(users[1]["username"]))
+    await step("find missing", store.find_user_by_username("nobody"))
+    await step("find by ids", store.find_users_by_ids([users[0]["_id"], users[2]["_id"], ObjectId()]))
+
+    t0 = users[0]["created_at"]
+    filter_cases = [
+        {},
+        {"role": "admin"},
+        {"username_prefix": "al"},
+        {"role": "user", "username_prefix": "a"},
+        {"email_prefix": "b"},
+        {"created_from": t0 + timedelta(seconds=1), "created_to": t0 + timedelta(seconds=5)},
+        {"role": "user", "created_from": t0},
+        {"username_prefix": "*"},
+    ]
+    for filters in filter_cases:
+        field = storage.sort_field(filters)
+        pages, after = [], None
+        while True:
+            docs = await store.list_users(filters, after, 2, storage.list_projection(field))
+            pages.append([d["username"] for d in docs])
+            if len(docs) < 2:
+                break
+            after = storage.encode_cursor(docs[-1], field)
+        out.append((f"list {filters}", _normalize(pages)))
+        await step(f"count {filters}", store.count_users(filters, exact=True))
+        # Kích thước lô là chi tiết của driver, chỉ so thứ tự các bản ghi
+        streamed = [d["username"] async for b in store.iter_users(filters, None, 3, {"username": 1}) for d in b]
+        out.append((f"iter {filters}", streamed))
+    await step("bad cursor", store.list_users({"username_prefix": "a"}, "not-a-cursor", 2, None))
+
+    await step("update by id", store.update_user({"_id": users[2]["_id"]}, {"email": "new@example.com", "role": "admin"}))
+    await step("update by username", store.update_user({"username": users[3]["username"]}, {"role": "user"}))
+    await step("update duplicate email", store.update_user({"_id": users[2]["_id"]}, {"email": users[0]["email"]}))
+    await step("update missing", store.update_user({"username": "nobody"}, {"role": "user"}))
+    await step("after update", store.find_user_by_username(users[2]["username"]))
+    await step("delete by username", store.delete_user({"username": users[3]["username"]}))
+    await step("delete again", store.delete_user({"username": users[3]["username"]}))
+    await step("delete by id", store.delete_user({"_id": users[4]["_id"]}))
+    await step("count after delete", store.count_users({}, exact=True))
+
+    if store.embedded:
+        now = t0
+        record = {"token_hash": "h1", "user_id": "u1", "family_id": "f1", "created_at": now,
+                  "expires_at": now + timedelta(days=1), "used_at": None, "replaced_by": None, "revoked": False}
+        await store.refresh_insert(record)
+        await store.refresh_insert({**record, "token_hash": "h2"})
+        await store.refresh_insert({**record, "token_hash": "h3", "user_id": "u2", "family_id": "f2"})
+        await step("refresh get", store.refresh_get("h1"))
+        await step("refresh mark_used", store.refresh_mark_used("h1", "h9"))
+        await step("refresh mark_used again", store.refresh_mark_used("h1", "h8"))
+        rec = await store.refresh_get("h1")
+        out.append(("refresh after use", [rec["replaced_by"], rec["used_at"] is not None]))
+        await store.refresh_revoke_family("f1")
+        await step("refresh revoked", store.refresh_get("h2"))
+        await store.refresh_revoke_user("u2")
+        await step("refresh revoke user", store.refresh_get("h3"))
+        await store.refresh_delete("h1")
+        await step("refresh delete", store.refresh_get("h1"))
+        await store.revoke_token("t1", datetime.utcnow() + timedelta(hours=1), "u1")
+        await store.revoke_token("t2", datetime.utcnow() - timedelta(hours=1), "u1")
+        await step("revoked hashes", store.revoked_hashes(["t1", "t2", "t3"]))
+    return out
+
+def _parity_seed():
+    t0 = datetime.utcnow().replace(microsecond=0) - timedelta(days=1)
+    names = [("alice", "admin"), ("bob", "user"), ("alan", "user"), ("carol", "user"),
+             ("al*ce", "user"), ("dave", "user"), ("albert", "admin")]
+    return [{
+        "_id": ObjectId(),
+        "username": name,
+        "email": f"{name.replace('*', 'x')}@example.com",
+        "password_hash": "hash-" + name,
+        "role": role,
+        "version": 1,
+        "created_at": t0 + timedelta(seconds=i),
+    } for i, (name, role) in enumerate(names)]
+
+async def cmd_storage_parity(args):
+    # Chạy cùng kịch bản trên từng backend và so với backend đầu tiên
+    unknown = set(args.backends) - set(storage.BACKENDS)
+    if unknown:
+        print(f"❌ Unknown backends: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+    seed = _parity_seed()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in args.backends:
+            if backend == "mongo":
+                db = get_db().client[args.mongo_db]
+                await db.client.drop_database(args.mongo_db)
+                for _, _, migrate in MIGRATIONS:
+                    await migrate(db)
+                store = storage.MongoStorage(db)
+            elif backend == "sqlite":
+                store = storage.SQLiteStorage(os.path.join(tmp, "parity.db"))
+            else:
+                store = storage.MemoryStorage()
+            try:
+                results[backend] = await _parity_script(store, seed)
+            finally:
+                if backend == "mongo":
+                    await db.client.drop_database(args.mongo_db)
+                elif backend == "sqlite":
+                    store.close()
+
+    base_name = args.backends[0]
+    base = results[base_name]
+    failed = 0
+    for backend, steps in results.items():
+        # Mongo không giữ refresh token/blacklist trong app.storage: chỉ so phần user
+        n = min(len(steps), len(base))
+        diffs = [(a[0], a[1], b[1]) for a, b in zip(base[:n], steps[:n]) if a != b]
+        failed += bool(diffs)
+        print(f"{'❌' if diffs else '✅'} {backend:<8} {n - len(diffs)}/{n} steps match {base_name}")
+        for name, expected, got in diffs[:args.show]:
+            print(f"   {name}\n     {base_name}: {expected}\n     {backend}: {got}")
+    return 1 if failed else 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("import-users", help="Import users from an NDJSON/CSV file ('-' for stdin)")
+    p.add_argument("file")
+    p.add_argument("--format", choices=["ndjson", "csv"])
+    p.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    p.add_argument("--results", help="Write per-row results as NDJSON to this file")
+    p.set_defaults(func=cmd_import_users)
+
+    p = sub.add_parser("export-users", help="Export users as NDJSON/CSV")
+    p.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    p.add_argument("--include-hash", action="store_true")
+    p.add_argument("-o", "--output")
+    p.set_defaults(func=cmd_export_users)
+
+    p = sub.add_parser("new-jwt-key", help="Generate a signing key <kid>.pem for JWT_KEYS_DIR and print its kid")
+    p.add_argument("--algorithm", choices=["RS256", "EdDSA", "ES256", "ES384", "ES512"], default="RS256")
+    p.add_argument("--dir", default=jwt_keys.JWT_KEYS_DIR or "keys")
+    p.add_argument("--kid")
+    p.set_defaults(func=cmd_new_jwt_key)
+
+    p = sub.add_parser("serve", help="Run the API with N uvicorn worker processes")
+    p.add_argument("--workers", type=int, help="Default: $WEB_CONCURRENCY or the number of CPUs (1 with embedded storage)")
+    p.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    p.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    p.add_argument("--log-level", default="info")
+    p.add_argument("--proxy-headers", action="store_true")
+    p.add_argument("--keep-alive", type=int, default=5)
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser("explain-users", help="Check that every GET /users filter uses an index (needs MongoDB)")
+    p.add_argument("--limit", type=int, default=100)
+    p.set_defaults(func=cmd_explain_users)
+
+    p = sub.add_parser("storage-parity", help="Run the same storage script on each backend and diff the results")
+    p.add_argument("--backends", type=lambda s: [x for x in s.split(",") if x], default=["memory", "sqlite"],
+                   help="Comma-separated: memory, sqlite, mongo (mongo uses MONGO_URL)")
+    p.add_argument("--mongo-db", default="user_db_parity")
+    p.add_argument("--show", type=int, default=5, help="Differences to print per backend")
+    p.set_defaults(func=cmd_storage_parity)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    result = args.func(args)
+    # serve chạy đồng bộ (uvicorn tự tạo event loop), các lệnh khác là coroutine
+    return asyncio.run(result) if asyncio.iscoroutine(result) else result
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+import asyncio
+import os
+
+# Gộp các truy vấn giống nhau đang chạy đồng thời (single-flight) và gom nhiều
+# key khác nhau trong một cửa sổ ngắn thành một truy vấn (micro-batch)
+COALESCE_WINDOW_MS = float(os.getenv("COALESCE_WINDOW_MS", "1"))
+COALESCE_MAX_BATCH = int(os.getenv("COALESCE_MAX_BATCH", "100"))
+
+class SingleFlight:
+    """Các coroutine cùng hỏi một key khi truy vấn trước chưa xong sẽ chờ chung
+    kết quả đó thay vì tự gọi DB."""
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            # Chạy thành task riêng: request khởi tạo bị hủy thì các request chờ chung vẫn có kết quả
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Tránh cảnh báo "exception never retrieved" khi mọi request chờ đã bị hủy
+            task.exception()
+
+    def forget(self, key):
+        # Gọi sau khi ghi: request tới sau không dùng chung kết quả đọc trước khi ghi
+        self._inflight.pop(key, None)
+
+    def stats(self):
+        return {"calls": self.calls, "shared": self.shared, "inflight": len(self._inflight)}
+
+class Batcher:
+    """Gom các key được hỏi trong COALESCE_WINDOW_MS rồi gọi fetch_many(keys) một lần.
+    fetch_many trả về dict key -> giá trị; key không có trong dict nhận None."""
+
+    def __init__(self, fetch_many, window_ms: float = None, max_batch: int = None):
+        self.fetch_many = fetch_many
+        self.window = (COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000
+        self.max_batch = max_batch or COALESCE_MAX_BATCH
+        self._waiting = {}
+        self._timer = None
+        # Giữ tham chiếu tới task đang chạy: event loop chỉ giữ tham chiếu yếu
+        self._tasks = set()
+        self.batches = 0
+        self.keys = 0
+
+    async def load(self, key):
+        fut = self._waiting.get(key)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiting[key] = fut
+            if len(self._waiting) >= self.max_batch:
+                self._dispatch()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._dispatch)
+        return await asyncio.shield(fut)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        waiting, self._waiting = self._waiting, {}
+        if waiting:
+            task = asyncio.get_running_loop().create_task(self._run(waiting))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, waiting):
+        self.batches += 1
+        self.keys += len(waiting)
+        try:
+            results = await self.fetch_many(list(waiting))
+        except Exception as e:
+            for fut in waiting.values():
+                if not fut.done():
+                    fut.set_exception(e)
+                    fut.exception()
+            return
+        for key, fut in waiting.items():
+            if not fut.done():
+                fut.set_result(results.get(key))
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "keys": self.keys,
+            "avg_batch": self.keys / self.batches if self.batches else 0.0,
+            "window_ms": self.window * 1000,
+        }
@@ -1,45 +1,205 @@
-from app.database import db
-from .utils import oid_str, oid_str_list
-from bson import ObjectId
-from app.auth import hash_password
-from datetime import datetime
-
-async def create_user(username: str, email: str, password: str, role="user"):
-    doc = {
-        "username": username,
-        "email": email,
-        "password_hash": hash_password(password),
-        "role": role,
-        "created_at": datetime.utcnow()
-    }
-    res = db["users"].insert_one(doc)
-    doc["_id"] = res.inserted_id
-    return oid_str(doc)
-
-async def get_user_by_username(username: str):
-    doc = db["users"].find_one({"username": username})
-    return oid_str(doc)
-
-async def get_user_by_id(id_str: str):
-    try:
-        oid = ObjectId(id_str)
-    except:
-        return None
-    doc = db["users"].find_one({"_id": oid})
-    return oid_str(doc)
-
-async def list_users():
-    docs = list(db["users"].find({}))
-    return oid_str_list(docs)
-
-async def update_user(id_str: str, data: dict):
-    if "password" in data and data["password"]:
-        data["password_hash"] = hash_password(data.pop("password"))
-    update_doc = {k: v for k, v in data.items() if v is not None}
-
-    db["users"].update_one({"_id": ObjectId(id_str)}, {"$set": update_doc})
-    return await get_user_by_id(id_str)
-
-async def delete_user(id_str: str):
-    result = db["users"].delete_one({"_id": ObjectId(id_str)})
-    return result.deleted_count
\ No newline at end of file
+import asyncio
+
+from .utils import oid_str, user_out
+from bson import ObjectId
+from app.auth import hash_password
+from app import audit, cache, hashing
+from app.coalesce import SingleFlight, Batcher
+from app.storage import get_storage, sort_field, decode_cursor, encode_cursor, list_projection, DuplicateUserError, USER_OUT_PROJECTION
+from datetime import datetime
+
+# Truy cập DB qua app.storage (Mongo, SQLite hoặc bộ nhớ theo STORAGE_BACKEND);
+# cache, gộp truy vấn và băm mật khẩu nằm ở đây, dùng chung cho mọi backend
+
+async def create_user(username: str, email: str, password: str, role="user"):
+    # Một lần insert, unique index quyết định trùng lặp (không find trước)
+    password_hash = await hash_password(password)
+    now = datetime.utcnow()
+    doc = {
+        "username": username,
+        "email": email,
+        "password_hash": password_hash,
+        "role": role,
+        "version": 1,
+        "created_at": now,
+        "updated_at": now,
+    }
+    await get_storage().insert_user(doc)
+    return oid_str(doc)
+
+# Request đồng thời hỏi cùng một user dùng chung một truy vấn; các id khác nhau
+# hỏi trong cùng cửa sổ COALESCE_WINDOW_MS được gộp thành một find $in
+_username_flight = SingleFlight()
+_id_flight = SingleFlight()
+
+def _remember(user: dict):
+    # Kết quả đọc xong sau một lần ghi (version cũ hơn) thì không đưa vào cache
+    if cache.is_user_version_current(user.get("_id"), user.get("version", 0)):
+        cache.put_user(user)
+
+async def _load_user_by_username(username: str):
+    doc = await get_storage().find_user_by_username(username)
+    user = oid_str(doc)
+    if user:
+        _remember(user)
+    return user
+
+async def _load_users_by_ids(id_strs: list):
+    docs = await get_storage().find_users_by_ids([ObjectId(i) for i in id_strs])
+    users = {}
+    for doc in docs:
+        user = oid_str(doc)
+        _remember(user)
+        users[user["_id"]] = user
+    return users
+
+_id_batcher = Batcher(_load_users_by_ids)
+
+async def get_user_by_username(username: str):
+    user = cache.get_user_by_username(username)
+    if user is not None:
+        return user
+    return await _username_flight.do(username, lambda: _load_user_by_username(username))
+
+async def get_user_by_id(id_str: str):
+    user = cache.get_user_by_id(id_str)
+    if user is not None:
+        return user
+    if not ObjectId.is_valid(id_str):
+        return None
+    return await _id_flight.do(id_str, lambda: _id_batcher.load(id_str))
+
+async def get_users_by_ids(id_strs):
+    # Trả về dict id -> user; id không hợp lệ/không tồn tại thì không có trong dict.
+    # Phần không có trong cache được lấy bằng một find $in duy nhất.
+    users = {}
+    missing = []
+    for id_str in set(id_strs):
+        user = cache.get_user_by_id(id_str)
+        if user is not None:
+            users[id_str] = user
+        elif ObjectId.is_valid(id_str):
+            missing.append(id_str)
+    if missing:
+        users.update(await _load_users_by_ids(missing))
+    return users
+
+def _forget(id_str: str, username: str = None):
+    _id_flight.forget(id_str)
+    if username:
+        _username_flight.forget(username)
+
+def get_coalesce_stats():
+    return {
+        "by_username": _username_flight.stats(),
+        "by_id": _id_flight.stats(),
+        "id_batches": _id_batcher.stats(),
+    }
+
+def check_cursor(filters: dict, cursor: str):
+    # Ném ValueError nếu cursor không khớp kiểu sắp xếp của bộ lọc
+    decode_cursor(sort_field(filters), cursor)
+
+async def list_users(limit: int = 100, after: str = None, filters: dict = None):
+    # Trả về (users, next_cursor); next_cursor là None ở trang cuối
+    field = sort_field(filters)
+    docs = await get_storage().list_users(filters, after, limit, list_projection(field))
+    next_cursor = encode_cursor(docs[-1], field) if len(docs) == limit else None
+    return [user_out(d) for d in docs], next_cursor
+
+async def iter_user_batches(after: str = None, batch_size: int = 500, projection: dict = None, filters: dict = None):
+    # Trả về document gốc (ObjectId/datetime), nơi gọi tự chọn cách serialize
+    async for docs in get_storage().iter_users(filters, after, batch_size, projection or USER_OUT_PROJECTION):
+        yield docs
+
+async def count_users(filters: dict = None, exact: bool = False):
+    return await get_storage().count_users(filters, exact=exact)
+
+async def users_version():
+    # Tăng sau mỗi lần thêm/sửa/xóa user, dùng làm ETag cho GET /users
+    return await get_storage().users_version()
+
+async def insert_users(docs: list):
+    # Không thứ tự: một dòng trùng không chặn các dòng còn lại, unique index
+    # username/email quyết định dòng nào lỗi. Trả về {vị trí: lỗi}
+    if not docs:
+        return {}
+    return await get_storage().insert_users(docs)
+
+async def _update_one(key: dict, data: dict):
+    if "password" in data and data["password"]:
+        data["password_hash"] = await hash_password(data.pop("password"))
+    update_doc = {k: v for k, v in data.items() if v is not None}
+    update_doc["updated_at"] = datetime.utcnow()
+
+    # Một round trip: trả luôn bản ghi sau khi sửa (version đã tăng)
+    doc = await get_storage().update_user(key, update_doc)
+    if not doc:
+        return None
+    user = oid_str(doc)
+    await cache.invalidate_user(user["_id"], user.get("username"), user.get("version"))
+    _forget(user["_id"], user.get("username"))
+    return user
+
+async def update_user(id_str: str, data: dict):
+    return await _update_one({"_id": ObjectId(id_str)}, data)
+
+async def update_user_by_username(username: str, data: dict):
+    return await _update_one({"username": username}, data)
+
+async def _delete_one(key: dict):
+    doc = await get_storage().delete_user(key)
+    if not doc:
+        return None
+    user = oid_str(doc)
+    await cache.invalidate_user(user["_id"], user.get("username"), deleted=True)
+    _forget(user["_id"], user.get("username"))
+    return user
+
+# Băm lại mật khẩu theo tham số Argon2 hiện tại, chạy nền sau khi /login đã trả lời
+_rehashing = set()
+_rehash_tasks = set()
+_rehash_stats = {"scheduled": 0, "rehashed": 0, "skipped_busy": 0, "changed": 0, "errors": 0}
+
+async def _rehash(user: dict, password: str):
+    try:
+        old_hash = user["password_hash"]
+        new_hash = await hash_password(password)
+        # Chỉ đổi hash: version giữ nguyên nên access token vừa cấp vẫn hợp lệ ở
+        # chế độ stateless và ETag không đổi. Bản trong cache sửa tại chỗ
+        if await get_storage().set_password_hash(ObjectId(user["_id"]), old_hash, new_hash):
+            cached = cache.get_user_by_id(user["_id"])
+            if cached is not None and cached.get("password_hash") == old_hash:
+                cached["password_hash"] = new_hash
+            _rehash_stats["rehashed"] += 1
+            audit.record("password_rehashed", username=user.get("username"), user_id=user["_id"])
+        else:
+            _rehash_stats["changed"] += 1
+    except Exception as e:
+        _rehash_stats["errors"] += 1
+        print(f"⚠️ Password rehash failed for {user.get('username')}: {e}")
+    finally:
+        _rehashing.discard(user["_id"])
+
+def schedule_rehash(user: dict, password: str):
+    # Gọi sau khi verify thành công; không chờ, request không chịu thêm lần băm nào
+    if not hashing.needs_update(user.get("password_hash")) or user["_id"] in _rehashing:
+        return
+    if hashing.is_busy():
+        _rehash_stats["skipped_busy"] += 1
+        return
+    _rehash_stats["scheduled"] += 1
+    _rehashing.add(user["_id"])
+    task = asyncio.create_task(_rehash(user, password))
+    _rehash_tasks.add(task)
+    task.add_done_callback(_rehash_tasks.discard)
+
+def get_rehash_stats():
+    return {**_rehash_stats, "in_flight": len(_rehashing)}
+
+async def delete_user(id_str: str):
+    return 1 if await _delete_one({"_id": ObjectId(id_str)}) else 0
+
+async def delete_user_by_username(username: str):
+    # Trả về user đã xóa (_id, username) hoặc None
+    return await _delete_one({"username": username})
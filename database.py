@@ -1,37 +1,190 @@
-from pymongo import MongoClient
-import time
-
-MONGO_URL = "mongodb://localhost:27017"
-DATABASE_NAME = "user_db"
-
-try:
-    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=5000)
-    # Test connection
-    client.server_info()
-    db = client[DATABASE_NAME]
-    print("✅ MongoDB connected successfully")
-except Exception as e:
-    print(f"❌ MongoDB connection failed: {e}")
-    db = None
-
-def init_db():
-    if db is None:
-        print("❌ Cannot initialize database - no connection")
-        return
-        
-    try:
-        # Indexes for users collection
-        db["users"].create_index("username", unique=True)
-        db["users"].create_index("email", unique=True)
-        
-        # Indexes for refresh tokens
-        db["refresh_tokens"].create_index("token", unique=True)
-        db["refresh_tokens"].create_index("expires_at", expireAfterSeconds=0)
-        
-        # Indexes for token blacklist
-        db["token_blacklist"].create_index("token", unique=True)
-        db["token_blacklist"].create_index("expires_at", expireAfterSeconds=0)
-        
-        print("✅ Database indexes created successfully")
-    except Exception as e:
-        print(f"❌ Database initialization error: {e}")
\ No newline at end of file
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from datetime import datetime, timedelta
+import asyncio
+import os
+import socket
+import uuid
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
+DATABASE_NAME = os.getenv("MONGO_DB", "user_db")
+
+# Cấu hình connection pool và timeout
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+
+# SKIP_MIGRATIONS=1: bỏ qua bước tạo index (ví dụ khi đã chạy migration riêng)
+SKIP_MIGRATIONS = os.getenv("SKIP_MIGRATIONS", "0") == "1"
+
+# Nhiều worker cùng khởi động: chỉ worker giữ lock chạy migration và bootstrap,
+# lock tự hết hạn sau STARTUP_LOCK_TTL giây nếu worker đó chết giữa chừng
+STARTUP_LOCK_TTL = int(os.getenv("STARTUP_LOCK_TTL", "120"))
+STARTUP_WAIT_INTERVAL = float(os.getenv("STARTUP_WAIT_INTERVAL", "0.5"))
+
+# Sự kiện audit tự xóa sau chừng này ngày (TTL index; đổi giá trị với DB cũ cần collMod)
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "90"))
+
+_client = None
+
+def connect(client=None):
+    # Gọi trong lifespan; Motor không mở kết nối cho tới truy vấn đầu tiên
+    # và tự kết nối lại nếu Mongo tạm thời không truy cập được.
+    # Truyền client có sẵn (ví dụ mongomock trong benchmark) để dùng thay Mongo thật.
+    global _client
+    if client is not None:
+        _client = client
+    if _client is None:
+        _client = AsyncIOMotorClient(
+            MONGO_URL,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        )
+    return _client
+
+def close():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+def get_client():
+    # CLI và script dùng trực tiếp mà không qua lifespan
+    return _client or connect()
+
+def get_db():
+    return get_client()[DATABASE_NAME]
+
+async def ping():
+    await get_client().admin.command("ping")
+
+# Migration: mỗi bước idempotent, phiên bản đã chạy lưu ở migrations._id="schema"
+async def _m001_initial_indexes(db):
+    # Indexes for users collection
+    await db["users"].create_index("username", unique=True)
+    await db["users"].create_index("email", unique=True)
+
+    # Indexes for refresh tokens
+    await db["refresh_tokens"].create_index("token", unique=True)
+    await db["refresh_tokens"].create_index("expires_at", expireAfterSeconds=0)
+
+    # Indexes for token blacklist
+    await db["token_blacklist"].create_index("token", unique=True)
+    await db["token_blacklist"].create_index("expires_at", expireAfterSeconds=0)
+    await db["token_blacklist"].create_index("blacklisted_at")
+
+    # Sự kiện invalidation cache giữa các worker, tự xóa sau 5 phút
+    await db["cache_invalidations"].create_index("at", expireAfterSeconds=300)
+
+async def _m002_hashed_refresh_tokens(db):
+    # Refresh token chỉ còn lưu hash: bản ghi token thô cũ bị xóa (người dùng đăng nhập lại)
+    coll = db["refresh_tokens"]
+    await coll.delete_many({"token_hash": {"$exists": False}})
+    try:
+        await coll.drop_index("token_1")
+    except OperationFailure:
+        pass
+    await coll.create_index("token_hash", unique=True)
+    await coll.create_index("family_id")
+    await coll.create_index("user_id")
+
+async def _m003_user_list_indexes(db):
+    # Index cho bộ lọc GET /users (storage.build_list_query): equality trước,
+    # rồi trường sort, _id cuối để keyset pagination không phải sort trong bộ nhớ
+    users = db["users"]
+    await users.create_index([("role", 1), ("_id", 1)])
+    await users.create_index([("created_at", 1), ("_id", 1)])
+    await users.create_index([("role", 1), ("created_at", 1), ("_id", 1)])
+    await users.create_index([("role", 1), ("username", 1)])
+    await users.create_index([("role", 1), ("email", 1)])
+
+async def _m004_audit_events(db):
+    # Ghi theo lô từ app.audit; export lọc theo thời gian, loại sự kiện hoặc username
+    events = db["audit_events"]
+    await events.create_index("at", expireAfterSeconds=AUDIT_RETENTION_DAYS * 86400)
+    await events.create_index([("event", 1), ("at", 1)])
+    await events.create_index([("username", 1), ("at", 1)])
+
+MIGRATIONS = [
+    (1, "initial indexes", _m001_initial_indexes),
+    (2, "hashed refresh tokens", _m002_hashed_refresh_tokens),
+    (3, "user list indexes", _m003_user_list_indexes),
+    (4, "audit events", _m004_audit_events),
+]
+
+async def run_migrations():
+    db = get_db()
+    state = await db["migrations"].find_one({"_id": "schema"}) or {}
+    current = state.get("version", 0)
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        await step(db)
+        await db["migrations"].update_one(
+            {"_id": "schema"},
+            {"$set": {"version": version, "name": name, "applied_at": datetime.utcnow()}},
+            upsert=True,
+        )
+        print(f"✅ Migration {version} applied: {name}")
+    return current
+
+async def schema_version():
+    state = await get_db()["migrations"].find_one({"_id": "schema"}) or {}
+    return state.get("version", 0)
+
+# Lock trong collection locks: _id là tên lock, ai giữ ghi ở owner
+LOCK_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def acquire_lock(name: str, ttl: int = STARTUP_LOCK_TTL):
+    now = datetime.utcnow()
+    try:
+        await get_db()["locks"].find_one_and_update(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": LOCK_OWNER}]},
+            {"$set": {"owner": LOCK_OWNER, "expires_at": now + timedelta(seconds=ttl), "acquired_at": now}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        # Lock đang do worker khác giữ (upsert đụng _id đã tồn tại)
+        return False
+
+async def release_lock(name: str):
+    await get_db()["locks"].delete_one({"_id": name, "owner": LOCK_OWNER})
+
+async def init_db(on_leader=None):
+    # Lỗi kết nối được ném ra để nơi gọi thử lại. Trả về True nếu tiến trình này
+    # là leader (đã chạy migration và on_leader), False nếu worker khác đã làm.
+    await ping()
+    print("✅ MongoDB connected successfully")
+    latest = MIGRATIONS[-1][0]
+    waited = False
+    while True:
+        if await acquire_lock("startup"):
+            # Đã phải chờ worker khác: khi tới lượt, worker đó có thể đã migrate xong,
+            # thì đây là follower (không chạy lại migration/on_leader)
+            if waited and not SKIP_MIGRATIONS and await schema_version() >= latest:
+                await release_lock("startup")
+                print("✅ Schema is current, startup handled by another worker")
+                return False
+            try:
+                if SKIP_MIGRATIONS:
+                    print("⏭️ Migrations skipped (SKIP_MIGRATIONS=1)")
+                else:
+                    await run_migrations()
+                if on_leader is not None:
+                    await on_leader()
+            finally:
+                await release_lock("startup")
+            return True
+        if SKIP_MIGRATIONS or await schema_version() >= latest:
+            print("✅ Schema is current, startup handled by another worker")
+            return False
+        waited = True
+        await asyncio.sleep(STARTUP_WAIT_INTERVAL)
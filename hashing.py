@@ -0,0 +1,145 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from app import metrics
+
+# Cấu hình pool băm mật khẩu
+HASH_POOL_MODE = os.getenv("HASH_POOL_MODE", "process")  # process | thread
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", str(os.cpu_count() or 1)))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "64"))
+
+# Tham số Argon2 (mặc định = mặc định của passlib). Chọn giá trị bằng
+# python -m app.benchmarks.bench_argon2 --target-ms ...; hash cũ khác tham số
+# được băm lại sau lần đăng nhập thành công kế tiếp (crud_user.schedule_rehash)
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "4"))
+
+def make_context(time_cost: int, memory_cost: int, parallelism: int):
+    return CryptContext(
+        schemes=["argon2"],
+        deprecated="auto",
+        argon2__rounds=time_cost,
+        argon2__memory_cost=memory_cost,
+        argon2__parallelism=parallelism,
+    )
+
+# Worker process (spawn) import lại module này nên dùng cùng tham số từ biến môi trường
+pwd_context = make_context(ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM)
+
+# Các hàm chạy trong worker process, phải ở cấp module để pickle được
+def _hash(password: str):
+    return pwd_context.hash(password)
+
+def _verify(plain_password: str, hashed_password: str):
+    return pwd_context.verify(plain_password, hashed_password)
+
+def _hash_many(passwords):
+    return [pwd_context.hash(p) for p in passwords]
+
+def _noop():
+    return None
+
+_executor = None
+_pending = 0
+_stats = {
+    "hash_calls": 0,
+    "verify_calls": 0,
+    "rejected": 0,
+    "total_seconds": 0.0,
+    "max_seconds": 0.0,
+    "max_queue_depth": 0,
+}
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        if HASH_POOL_MODE == "thread":
+            _executor = ThreadPoolExecutor(max_workers=HASH_POOL_SIZE, thread_name_prefix="argon2")
+        else:
+            # spawn thay vì fork: tiến trình cha đã có thread của Motor
+            _executor = ProcessPoolExecutor(
+                max_workers=HASH_POOL_SIZE,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _executor
+
+async def start():
+    # Khởi động sẵn các worker để request đầu tiên không phải chờ spawn
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    await asyncio.gather(*[loop.run_in_executor(executor, _noop) for _ in range(HASH_POOL_SIZE)])
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def _run(kind: str, fn, *args):
+    global _pending
+    if _pending >= HASH_QUEUE_LIMIT:
+        _stats["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please try again later",
+            headers={"Retry-After": "1"},
+        )
+
+    _pending += 1
+    _stats["max_queue_depth"] = max(_stats["max_queue_depth"], _queue_depth())
+    start_time = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), fn, *args)
+    finally:
+        _pending -= 1
+        elapsed = time.perf_counter() - start_time
+        metrics.record("argon2", kind, elapsed)
+        _stats[kind] += 1
+        _stats["total_seconds"] += elapsed
+        _stats["max_seconds"] = max(_stats["max_seconds"], elapsed)
+
+def _queue_depth():
+    return max(0, _pending - HASH_POOL_SIZE)
+
+async def hash_password_async(password: str):
+    return await _run("hash_calls", _hash, password)
+
+async def hash_many_async(passwords: list):
+    # Chia đều cho các worker: mỗi worker nhận một lô, ít round trip IPC hơn
+    if not passwords:
+        return []
+    size = -(-len(passwords) // HASH_POOL_SIZE)
+    chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+    results = await asyncio.gather(*[_run("hash_calls", _hash_many, chunk) for chunk in chunks])
+    return [h for chunk in results for h in chunk]
+
+async def verify_password_async(plain_password: str, hashed_password: str):
+    return await _run("verify_calls", _verify, plain_password, hashed_password)
+
+def needs_update(hashed_password: str):
+    # Chỉ đọc tham số trong chuỗi hash, không chạy Argon2
+    return bool(hashed_password) and pwd_context.needs_update(hashed_password)
+
+def is_busy():
+    # Mọi worker đang bận: việc băm lại không gấp thì để lần đăng nhập sau
+    return _pending >= HASH_POOL_SIZE
+
+def get_stats():
+    calls = _stats["hash_calls"] + _stats["verify_calls"]
+    return {
+        **_stats,
+        "mode": HASH_POOL_MODE,
+        "pool_size": HASH_POOL_SIZE,
+        "queue_limit": HASH_QUEUE_LIMIT,
+        "argon2": {"time_cost": ARGON2_TIME_COST, "memory_cost": ARGON2_MEMORY_COST, "parallelism": ARGON2_PARALLELISM},
+        "in_flight": min(_pending, HASH_POOL_SIZE),
+        "queue_depth": _queue_depth(),
+        "avg_seconds": _stats["total_seconds"] / calls if calls else 0.0,
+    }
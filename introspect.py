@@ -0,0 +1,58 @@
+import os
+import time
+
+import jwt
+
+from app import jwt_keys, token_store
+from app.crud_user import get_users_by_ids
+from app.metrics import timed
+
+# Gateway được cache câu trả lời "active" tối đa chừng này giây (và không quá
+# thời hạn còn lại của token); thu hồi trong khoảng đó sẽ chưa được thấy
+INTROSPECT_CACHE_SECONDS = int(os.getenv("INTROSPECT_CACHE_SECONDS", "30"))
+
+INACTIVE = {"active": False}
+
+async def introspect_tokens(tokens: list):
+    # Kết quả theo đúng thứ tự đầu vào, dạng RFC 7662. Cả lô chỉ tốn một lần
+    # kiểm tra blacklist và một lần đọc user, không phải mỗi token một lần.
+    unique = list(dict.fromkeys(tokens))
+    payloads = {}
+    with timed("jwt", "decode"):
+        for token in unique:
+            try:
+                payload = jwt_keys.decode(token)
+            except jwt.PyJWTError:
+                continue
+            if payload.get("user_id"):
+                payloads[token] = payload
+
+    revoked = await token_store.get_blacklist().revoked_many(list(payloads)) if payloads else set()
+    for token in revoked:
+        payloads.pop(token, None)
+
+    users = await get_users_by_ids([p["user_id"] for p in payloads.values()]) if payloads else {}
+
+    answers = {}
+    for token, payload in payloads.items():
+        user = users.get(payload["user_id"])
+        if not user:
+            continue
+        answers[token] = {
+            "active": True,
+            "token_type": "access_token",
+            "sub": user["_id"],
+            "username": user["username"],
+            "role": user["role"],
+            "exp": payload.get("exp"),
+            "iat": payload.get("iat"),
+        }
+    return [answers.get(token, INACTIVE) for token in tokens]
+
+def cache_control(results: list):
+    # Chỉ cho cache khi có token active; max-age không vượt thời hạn token sớm hết nhất
+    now = int(time.time())
+    ttls = [r["exp"] - now for r in results if r["active"] and r.get("exp")]
+    if not ttls:
+        return "no-store"
+    return f"private, max-age={max(0, min(INTROSPECT_CACHE_SECONDS, *ttls))}"
@@ -0,0 +1,143 @@
+import os
+import uuid
+from pathlib import Path
+
+import jwt
+from jwt.algorithms import ECAlgorithm, OKPAlgorithm, RSAAlgorithm
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+# Cấu hình ký JWT
+#   JWT_ALGORITHM=HS256 (mặc định): ký bằng APP_SECRET_KEY như trước
+#   JWT_ALGORITHM=RS256 | EdDSA | ES256 | ES384 | ES512: ký bằng private key trong JWT_KEYS_DIR
+# JWT_KEYS_DIR chứa các file <kid>.pem (private hoặc chỉ public key).
+# JWT_ACTIVE_KID chọn key dùng để ký; các key còn lại chỉ dùng để verify,
+# nên khi xoay key cứ thêm key mới, đổi JWT_ACTIVE_KID, giữ key cũ tới khi
+# token cũ hết hạn rồi mới xóa.
+SECRET_KEY = os.getenv("APP_SECRET_KEY", "CHANGE_THIS_SECRET_KEY_FOR_SESSION")
+ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "")
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID", "")
+
+SYMMETRIC_ALGORITHMS = {"HS256", "HS384", "HS512"}
+# Mỗi đường cong EC chỉ đi với một thuật toán (RFC 7518 3.4)
+EC_CURVES = {"secp256r1": "ES256", "secp384r1": "ES384", "secp521r1": "ES512"}
+
+_keyset = None
+
+class KeySet:
+    def __init__(self):
+        self.signing_kid = None
+        self.signing_key = None
+        self.signing_algorithm = ALGORITHM
+        # kid -> (key object đã parse, algorithm)
+        self.verify_keys = {}
+
+def algorithm_for_key(key):
+    # Mỗi kid gắn cố định một thuật toán theo loại key, tránh tấn công đổi "alg"
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return "RS256"
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return "EdDSA"
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        if key.curve.name not in EC_CURVES:
+            raise ValueError(f"Unsupported EC curve: {key.curve.name}")
+        return EC_CURVES[key.curve.name]
+    raise ValueError(f"Unsupported key type: {type(key).__name__}")
+
+def generate_private_key(algorithm: str):
+    if algorithm == "RS256":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if algorithm == "EdDSA":
+        return ed25519.Ed25519PrivateKey.generate()
+    curves = {"ES256": ec.SECP256R1, "ES384": ec.SECP384R1, "ES512": ec.SECP521R1}
+    if algorithm in curves:
+        return ec.generate_private_key(curves[algorithm]())
+    raise ValueError(f"Unsupported algorithm: {algorithm}")
+
+def private_key_pem(key):
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+def _load_pem(data: bytes):
+    if b"PRIVATE KEY" in data:
+        return serialization.load_pem_private_key(data, password=None)
+    return serialization.load_pem_public_key(data)
+
+def load_keys():
+    keyset = KeySet()
+    if ALGORITHM in SYMMETRIC_ALGORITHMS:
+        keyset.signing_key = SECRET_KEY
+        keyset.verify_keys[None] = (SECRET_KEY, ALGORITHM)
+        return keyset
+
+    private_keys = {}
+    if JWT_KEYS_DIR:
+        for path in sorted(Path(JWT_KEYS_DIR).glob("*.pem")):
+            key = _load_pem(path.read_bytes())
+            public_key = key.public_key() if hasattr(key, "public_key") else key
+            keyset.verify_keys[path.stem] = (public_key, algorithm_for_key(key))
+            if public_key is not key:
+                private_keys[path.stem] = key
+
+    kid = JWT_ACTIVE_KID or (sorted(private_keys)[-1] if private_keys else None)
+    if kid is None:
+        # Không có key: tạo key tạm, chỉ hợp lệ trong tiến trình này. Nhiều worker
+        # thì mỗi worker một key, token ký ở worker này bị worker khác từ chối
+        if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+            raise RuntimeError(f"JWT_ALGORITHM={ALGORITHM} with several workers needs a private key in JWT_KEYS_DIR")
+        kid = f"ephemeral-{uuid.uuid4().hex[:8]}"
+        key = generate_private_key(ALGORITHM)
+        private_keys[kid] = key
+        keyset.verify_keys[kid] = (key.public_key(), ALGORITHM)
+        print(f"⚠️ JWT_KEYS_DIR has no private key, using ephemeral {ALGORITHM} key {kid}")
+    if kid not in private_keys:
+        raise RuntimeError(f"JWT_ACTIVE_KID={kid} has no private key in {JWT_KEYS_DIR}")
+
+    keyset.signing_kid = kid
+    keyset.signing_key = private_keys[kid]
+    keyset.signing_algorithm = algorithm_for_key(private_keys[kid])
+    return keyset
+
+def get_keyset():
+    global _keyset
+    if _keyset is None:
+        _keyset = load_keys()
+    return _keyset
+
+def reload_keys():
+    # Đọc lại JWT_KEYS_DIR, dùng khi thêm/xóa key mà không khởi động lại
+    global _keyset
+    _keyset = load_keys()
+    return _keyset
+
+def encode(claims: dict):
+    keyset = get_keyset()
+    headers = {"kid": keyset.signing_kid} if keyset.signing_kid else None
+    return jwt.encode(claims, keyset.signing_key, algorithm=keyset.signing_algorithm, headers=headers)
+
+def decode(token: str, verify_exp: bool = True):
+    # Ném jwt.PyJWTError nếu token sai, hết hạn hoặc kid không còn được tin cậy
+    keyset = get_keyset()
+    kid = jwt.get_unverified_header(token).get("kid")
+    entry = keyset.verify_keys.get(kid)
+    if entry is None:
+        raise jwt.InvalidKeyError(f"Unknown kid: {kid}")
+    key, algorithm = entry
+    return jwt.decode(token, key, algorithms=[algorithm], options={"verify_exp": verify_exp})
+
+_JWK_ENCODERS = {"RS256": RSAAlgorithm, "EdDSA": OKPAlgorithm, "ES256": ECAlgorithm, "ES384": ECAlgorithm, "ES512": ECAlgorithm}
+
+def jwks():
+    # Chỉ công bố public key; chế độ HS256 không có gì để công bố
+    keys = []
+    for kid, (key, algorithm) in get_keyset().verify_keys.items():
+        if kid is None or algorithm not in _JWK_ENCODERS:
+            continue
+        jwk = _JWK_ENCODERS[algorithm].to_jwk(key, as_dict=True)
+        jwk.update({"kid": kid, "alg": algorithm, "use": "sig"})
+        keys.append(jwk)
+    return {"keys": keys}
@@ -1,270 +1,533 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request, Response
-from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.sessions import SessionMiddleware
-from fastapi.responses import JSONResponse
-from contextlib import asynccontextmanager
-import os
-from jose import jwt, JWTError
-
-from app.database import init_db, db 
-from app.schemas import UserCreate, UserOut, LoginIn, Token, UserUpdate, TokenRefresh, LogoutResponse
-from app.crud_user import create_user, get_user_by_username, list_users, update_user, delete_user, get_user_by_id
-from app.auth import verify_password, create_access_token, create_refresh_token, is_refresh_token_valid, revoke_refresh_token, add_to_blacklist, revoke_all_user_tokens, decode_access_token, SECRET_KEY, ALGORITHM
-from app.deps import get_current_user, require_admin, get_token_from_request
-
-# HÀM LIFESPAN MỚI
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup
-    init_db()
-    await create_admin_user()
-    yield
-    # Shutdown (có thể thêm cleanup code ở đây nếu cần)
-
-# SỬA: Thêm lifespan vào FastAPI app
-app = FastAPI(
-    title="FastAPI Mongo Auth", 
-    version="1.0.0",
-    lifespan=lifespan
-)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# SỬA: Dùng biến môi trường thống nhất
-SECRET_KEY = os.getenv("APP_SECRET_KEY", "CHANGE_THIS_SECRET_KEY_FOR_SESSION")
-app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
-
-async def create_admin_user():
-    """Tạo tài khoản admin mặc định nếu chưa tồn tại"""
-    try:
-        admin_user = await get_user_by_username("admin")
-        if not admin_user:
-            await create_user("admin", "admin@example.com", "admin123", "admin")
-            print("✅ Admin user created successfully")
-            print("   👤 Username: admin")
-            print("   🔑 Password: admin123")
-            print("   📧 Email: admin@example.com")
-        else:
-            print("✅ Admin user already exists")
-    except Exception as e:
-        print(f"⚠️ Could not create admin user: {e}")
-
-@app.get("/")
-async def root():
-    return {
-        "message": "FastAPI Mongo Auth System", 
-        "version": "1.0.0",
-        "docs": "/docs",
-        "endpoints": {
-            "auth": [
-                "POST /register - Register new user",
-                "POST /login - Login and get tokens", 
-                "POST /refresh - Refresh access token",
-                "POST /logout - Logout and revoke token"
-            ],
-            "users": [
-                "GET /users/me - Get current user info",
-                "PUT /users/me - Update current user", 
-                "PUT /users/{username} - Update user by username",
-                "DELETE /users/{username} - Delete user by username",
-                "GET /users - Get all users (admin only)"
-            ]
-        }
-    }
-
-@app.post("/register", response_model=UserOut, tags=["Auth"])
-async def register(user: UserCreate):
-    existed = await get_user_by_username(user.username)
-    if existed:
-        raise HTTPException(status_code=400, detail="User already exists")
-    new_user = await create_user(user.username, user.email, user.password)
-    return JSONResponse(
-        status_code=201, 
-        content={**new_user, "message": "User registered successfully"}
-    )
-
-@app.post("/login", response_model=Token, tags=["Auth"])
-async def login(response: Response, payload: LoginIn):
-    user = await get_user_by_username(payload.username)
-    if not user or not verify_password(payload.password, user.get("password_hash")):
-        raise HTTPException(status_code=401, detail="Incorrect username or password")
-    
-    access_token = create_access_token({"user_id": user.get("_id"), "role": user.get("role")})
-    refresh_token = create_refresh_token(str(user.get("_id")))
-    
-    # Set secure cookies
-    response.set_cookie(
-        key="access_token", 
-        value=access_token, 
-        httponly=True, 
-        secure=False,
-        samesite="lax",
-        max_age=24 * 60 * 60
-    )
-    
-    response.set_cookie(
-        key="refresh_token", 
-        value=refresh_token, 
-        httponly=True, 
-        secure=False,
-        samesite="lax", 
-        max_age=30 * 24 * 60 * 60
-    )
-    
-    return {
-        "access_token": access_token, 
-        "token_type": "bearer", 
-        "refresh_token": refresh_token,
-        "message": "Login successful"
-    }
-
-@app.post("/refresh", response_model=Token, tags=["Auth"])
-async def refresh_token_route(payload: TokenRefresh):
-    r = is_refresh_token_valid(payload.refresh_token)
-    if not r:
-        raise HTTPException(status_code=401, detail="Refresh token invalid or expired")
-    
-    user_id = r.get("user_id")
-    user = await get_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    access_token = create_access_token({"user_id": user_id, "role": user.get("role")})
-    
-    return {
-        "access_token": access_token, 
-        "token_type": "bearer",
-        "refresh_token": payload.refresh_token,
-        "message": "Token refreshed successfully"
-    }
-
-# SỬA: Logout duy nhất - cải thiện và làm mạnh mẽ hơn
-@app.post("/logout", response_model=LogoutResponse, tags=["Auth"])
-async def logout(response: Response, request: Request):
-    try:
-        # Lấy token từ request
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            # Nếu không có token trong header, vẫn xóa cookies và session
-            response.delete_cookie("access_token")
-            response.delete_cookie("refresh_token")
-            response.delete_cookie("session")
-            request.session.clear()
-            return {
-                "success": True,
-                "message": "Đăng xuất thành công (no token provided)."
-            }
-        
-        token = auth_header.split(" ")[1]
-        
-        if token:
-            try:
-                # Thử lấy thông tin user từ token (cho phép token hết hạn)
-                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False})
-                user_id = payload.get("user_id")
-                
-                if user_id:
-                    # Thêm token vào blacklist
-                    add_to_blacklist(token)
-                    # Xóa refresh token của user (tùy chọn - để chắc chắn hơn)
-                    revoke_all_user_tokens(user_id)
-            except JWTError:
-                # Token không hợp lệ, nhưng vẫn thêm vào blacklist để chắc chắn
-                add_to_blacklist(token)
-            
-        # Xóa session và cookies
-        response.delete_cookie("access_token")
-        response.delete_cookie("refresh_token")
-        response.delete_cookie("session")
-        
-        # Clear session data
-        request.session.clear()
-        
-        return {
-            "success": True,
-            "message": "Đăng xuất thành công. Token đã bị thu hồi."
-        }
-    except Exception as e:
-        # Vẫn cố gắng xóa cookies ngay cả khi có lỗi
-        response.delete_cookie("access_token")
-        response.delete_cookie("refresh_token")
-        response.delete_cookie("session")
-        request.session.clear()
-        
-        return JSONResponse(
-            status_code=400,
-            content={"success": False, "message": f"Logout completed with warning: {str(e)}"}
-        )
-
-# THÊM: Endpoint kiểm tra token
-@app.get("/check-token", tags=["Auth"])
-async def check_token(request: Request):
-    """Kiểm tra token có hợp lệ không"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return {"valid": False, "message": "No token provided"}
-    
-    token = auth_header.split(" ")[1]
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        user = await get_user_by_id(user_id)
-        
-        if not user:
-            return {"valid": False, "message": "User not found"}
-        
-        return {
-            "valid": True, 
-            "user": user["username"],
-            "role": user["role"],
-            "expires": payload.get("exp")
-        }
-    except JWTError as e:
-        return {"valid": False, "message": f"Token invalid: {str(e)}"}
-
-@app.get("/users", response_model=list[UserOut], tags=["Users"])
-async def get_users_route(admin=Depends(require_admin)):
-    users = await list_users()
-    return users
-
-@app.get("/users/me", response_model=UserOut, tags=["Users"])
-async def get_me(user: dict = Depends(get_current_user)):
-    return user
-
-@app.put("/users/me", response_model=UserOut, tags=["Users"])
-async def update_current_user(payload: UserUpdate, current_user: dict = Depends(get_current_user)):
-    updated = await update_user(current_user["_id"], payload.dict(exclude_unset=True))
-    return {**updated, "message": "Your profile updated successfully"}
-
-@app.put("/users/{username}", response_model=UserOut, tags=["Users"])
-async def update_user_by_username(username: str, payload: UserUpdate, current_user: dict = Depends(get_current_user)):
-    target_user = await get_user_by_username(username)
-    if not target_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    if current_user.get("role") != "admin" and current_user.get("username") != username:
-        raise HTTPException(status_code=403, detail="Forbidden")
-    
-    updated = await update_user(target_user["_id"], payload.dict(exclude_unset=True))
-    return {**updated, "message": f"User {username} updated successfully"}
-
-@app.delete("/users/{username}", tags=["Users"])
-async def delete_user_by_username(username: str, admin=Depends(require_admin)):
-    target_user = await get_user_by_username(username)
-    if not target_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    n = await delete_user(target_user["_id"])
-    if n == 0:
-        raise HTTPException(status_code=404, detail="User not found")
-    return {"message": f"User {username} deleted successfully"}
-
-if __name__ == "__main__":
-    import uvicorn
+from fastapi import FastAPI, HTTPException, Depends, Query, status, Request, Response
+from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.sessions import SessionMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
+import os
+from typing import Optional
+from datetime import datetime
+import jwt
+
+from app.database import connect, close
+from app.middleware import FirstRequestTimer, MetricsMiddleware, mark, startup_timings, profile_state, profile_report
+from app import audit, cache, hashing, jwt_keys, metrics, ratelimit, refresh_store, storage, token_store
+from app.schemas import UserCreate, UserOut, LoginIn, Token, UserUpdate, TokenRefresh, LogoutResponse, IntrospectIn
+from app.crud_user import create_user, get_user_by_username, list_users, iter_user_batches, count_users, check_cursor, users_version, update_user, update_user_by_username as update_user_by_name, delete_user_by_username as delete_user_by_name, get_user_by_id, get_coalesce_stats, schedule_rehash, get_rehash_stats, DuplicateUserError
+from app.auth import verify_password, create_access_token, user_claims, create_refresh_token, rotate_refresh_token, revoke_refresh_token, add_to_blacklist, revoke_all_user_tokens, decode_access_token, is_token_blacklisted, SECRET_KEY
+from app.deps import get_current_user, require_admin, require_introspect_client, get_token_from_request
+from app.introspect import introspect_tokens, cache_control
+from app.utils import ORJSONResponse, user_out, ndjson_lines, etag, etag_matches
+from app.bulk import iter_lines, iter_rows, import_users, export_users, summarize
+
+BOOTSTRAP_MAX_RETRY_DELAY = 30
+# Cache-Control của GET /users: mặc định cho proxy lưu nhưng phải hỏi lại (If-None-Match)
+# mỗi lần, nên quyền admin vẫn được kiểm tra; Vary theo Authorization/Cookie
+USERS_CACHE_CONTROL = os.getenv("USERS_CACHE_CONTROL", "no-cache, must-revalidate")
+bootstrap_state = {"ready": False, "error": None}
+
+async def bootstrap():
+    # Chạy nền để worker nhận request ngay; /ready báo 503 cho tới khi xong
+    delay = 1
+    while True:
+        try:
+            # Mongo: chỉ một worker (giữ lock startup) chạy migration và tạo admin
+            await storage.init(on_leader=create_admin_user)
+            break
+        except Exception as e:
+            bootstrap_state["error"] = str(e)
+            print(f"❌ {storage.STORAGE_BACKEND} storage not ready ({e}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BOOTSTRAP_MAX_RETRY_DELAY)
+
+    await asyncio.gather(hashing.start(), storage.start(), token_store.start(), refresh_store.start(), audit.start())
+    bootstrap_state.update(ready=True, error=None)
+    mark("ready_ms")
+
+# HÀM LIFESPAN MỚI
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: chỉ tạo client, không chờ round trip nào tới Mongo
+    if not storage.is_embedded():
+        connect()
+    # Parse key ký JWT một lần, cấu hình sai thì dừng ngay khi khởi động
+    jwt_keys.get_keyset()
+    await cache.start()
+    bootstrap_task = asyncio.create_task(bootstrap())
+    mark("startup_ms")
+    yield
+    # Shutdown
+    bootstrap_task.cancel()
+    await cache.stop()
+    await refresh_store.stop()
+    await token_store.stop()
+    await audit.stop()
+    await storage.stop()
+    hashing.shutdown()
+    close()
+
+# SỬA: Thêm lifespan vào FastAPI app
+app = FastAPI(
+    title="FastAPI Mongo Auth", 
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    # Client trình duyệt cần đọc cursor trang sau và ETag (If-None-Match)
+    expose_headers=["X-Next-Cursor", "ETag"],
+)
+
+# SỬA: Dùng chung SECRET_KEY với app.auth, không đọc env lần nữa
+app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+app.add_middleware(FirstRequestTimer)
+app.add_middleware(MetricsMiddleware)
+
+async def create_admin_user():
+    """Tạo tài khoản admin mặc định nếu chưa tồn tại"""
+    try:
+        admin_user = await get_user_by_username("admin")
+        if not admin_user:
+            await create_user("admin", "admin@example.com", "admin123", "admin")
+            print("✅ Admin user created successfully")
+            print("   👤 Username: admin")
+            print("   🔑 Password: admin123")
+            print("   📧 Email: admin@example.com")
+        else:
+            print("✅ Admin user already exists")
+    except DuplicateUserError:
+        print("✅ Admin user already exists")
+    except Exception as e:
+        print(f"⚠️ Could not create admin user: {e}")
+
+# THÊM: Liveness/readiness cho orchestrator
+@app.get("/health", tags=["Ops"])
+async def health():
+    return {"status": "ok"}
+
+@app.get("/ready", tags=["Ops"])
+async def ready():
+    if not bootstrap_state["ready"]:
+        return ORJSONResponse(status_code=503, content={"ready": False, "reason": bootstrap_state["error"] or "starting"})
+    try:
+        await asyncio.wait_for(storage.ping(), timeout=2)
+    except Exception as e:
+        return ORJSONResponse(status_code=503, content={"ready": False, "reason": f"database: {e}"})
+    return {"ready": True}
+
+# THÊM: Public key để service khác tự verify token (RS256/EdDSA)
+@app.get("/.well-known/jwks.json", tags=["Auth"])
+async def jwks():
+    return ORJSONResponse(content=jwt_keys.jwks(), headers={"Cache-Control": "public, max-age=300"})
+
+@app.get("/")
+async def root():
+    return {
+        "message": "FastAPI Mongo Auth System", 
+        "version": "1.0.0",
+        "docs": "/docs",
+        "endpoints": {
+            "auth": [
+                "POST /register - Register new user",
+                "POST /login - Login and get tokens", 
+                "POST /refresh - Refresh access token",
+                "POST /logout - Logout and revoke token",
+                "GET /.well-known/jwks.json - Public signing keys",
+                "POST /introspect - Validate up to 100 access tokens in one call"
+            ],
+            "users": [
+                "GET /users/me - Get current user info",
+                "PUT /users/me - Update current user", 
+                "PUT /users/{username} - Update user by username",
+                "DELETE /users/{username} - Delete user by username",
+                "GET /users?limit=&cursor=&format=json|ndjson&role=&created_from=&created_to=&username_prefix=&email_prefix= - List users (admin only)",
+                "GET /users/count?exact=&<same filters> - Count users (admin only)"
+            ],
+            "admin": [
+                "POST /admin/users/import - Bulk import users from NDJSON/CSV",
+                "GET /admin/users/export - Stream all users as NDJSON/CSV",
+                "GET /admin/audit?event=&username=&since=&until= - Stream audit events as NDJSON",
+                "GET /stats - Internal counters",
+                "GET /metrics - Prometheus metrics",
+                "GET /debug/profile - Sampled profiler report"
+            ]
+        }
+    }
+
+@app.post("/register", response_model=UserOut, tags=["Auth"])
+async def register(request: Request, user: UserCreate):
+    await ratelimit.check_register(request)
+    # Không find trước: insert thẳng, trùng username/email trả 409
+    try:
+        new_user = await create_user(user.username, user.email, user.password)
+    except DuplicateUserError as e:
+        raise HTTPException(status_code=409, detail=f"User already exists ({e.field})")
+    audit.record("register", request, username=new_user["username"], user_id=new_user["_id"])
+    return ORJSONResponse(
+        status_code=201, 
+        content={**user_out(new_user), "message": "User registered successfully"}
+    )
+
+@app.post("/login", response_model=Token, tags=["Auth"])
+async def login(request: Request, response: Response, payload: LoginIn):
+    # Chặn sớm (429) trước khi đọc DB hay chạy Argon2
+    await ratelimit.check_login(request, payload.username)
+    user = await get_user_by_username(payload.username)
+    if not user or not await verify_password(payload.password, user.get("password_hash")):
+        await ratelimit.login_failed(payload.username)
+        audit.record("login_failed", request, username=payload.username)
+        raise HTTPException(status_code=401, detail="Incorrect username or password")
+    # Hash theo tham số Argon2 cũ: băm lại ở nền, không kéo dài request này
+    schedule_rehash(user, payload.password)
+    
+    access_token = create_access_token(user_claims(user))
+    refresh_token = await create_refresh_token(str(user.get("_id")))
+    audit.record("login", request, username=user["username"], user_id=str(user.get("_id")))
+    
+    # Set secure cookies
+    response.set_cookie(
+        key="access_token", 
+        value=access_token, 
+        httponly=True, 
+        secure=False,
+        samesite="lax",
+        max_age=24 * 60 * 60
+    )
+    
+    response.set_cookie(
+        key="refresh_token", 
+        value=refresh_token, 
+        httponly=True, 
+        secure=False,
+        samesite="lax", 
+        max_age=30 * 24 * 60 * 60
+    )
+    
+    return {
+        "access_token": access_token, 
+        "token_type": "bearer", 
+        "refresh_token": refresh_token,
+        "message": "Login successful"
+    }
+
+@app.post("/refresh", response_model=Token, tags=["Auth"])
+async def refresh_token_route(request: Request, response: Response, payload: TokenRefresh):
+    # Mỗi lần refresh đổi sang refresh token mới, token cũ hết hiệu lực
+    rotated = await rotate_refresh_token(payload.refresh_token)
+    if not rotated:
+        raise HTTPException(status_code=401, detail="Refresh token invalid or expired")
+    new_refresh_token, r = rotated
+    
+    user_id = r.get("user_id")
+    user = await get_user_by_id(user_id)
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    access_token = create_access_token(user_claims(user))
+    audit.record("refresh", request, username=user["username"], user_id=user_id)
+    response.set_cookie(
+        key="refresh_token",
+        value=new_refresh_token,
+        httponly=True,
+        secure=False,
+        samesite="lax",
+        max_age=30 * 24 * 60 * 60
+    )
+    
+    return {
+        "access_token": access_token, 
+        "token_type": "bearer",
+        "refresh_token": new_refresh_token,
+        "message": "Token refreshed successfully"
+    }
+
+# SỬA: Logout duy nhất - cải thiện và làm mạnh mẽ hơn
+@app.post("/logout", response_model=LogoutResponse, tags=["Auth"])
+async def logout(response: Response, request: Request):
+    try:
+        # Lấy token từ request
+        auth_header = request.headers.get("Authorization")
+        if not auth_header or not auth_header.startswith("Bearer "):
+            # Nếu không có token trong header, vẫn xóa cookies và session
+            response.delete_cookie("access_token")
+            response.delete_cookie("refresh_token")
+            response.delete_cookie("session")
+            request.session.clear()
+            return {
+                "success": True,
+                "message": "Đăng xuất thành công (no token provided)."
+            }
+        
+        token = auth_header.split(" ")[1]
+        
+        if token:
+            try:
+                # Thử lấy thông tin user từ token (cho phép token hết hạn)
+                payload = jwt_keys.decode(token, verify_exp=False)
+                user_id = payload.get("user_id")
+                
+                if user_id:
+                    # Thêm token vào blacklist
+                    await add_to_blacklist(token)
+                    # Xóa refresh token của user (tùy chọn - để chắc chắn hơn)
+                    await revoke_all_user_tokens(user_id)
+                    audit.record("logout", request, username=payload.get("username"), user_id=user_id)
+            except jwt.PyJWTError:
+                # Token không hợp lệ, nhưng vẫn thêm vào blacklist để chắc chắn
+                await add_to_blacklist(token)
+            
+        # Xóa session và cookies
+        response.delete_cookie("access_token")
+        response.delete_cookie("refresh_token")
+        response.delete_cookie("session")
+        
+        # Clear session data
+        request.session.clear()
+        
+        return {
+            "success": True,
+            "message": "Đăng xuất thành công. Token đã bị thu hồi."
+        }
+    except Exception as e:
+        # Vẫn cố gắng xóa cookies ngay cả khi có lỗi
+        response.delete_cookie("access_token")
+        response.delete_cookie("refresh_token")
+        response.delete_cookie("session")
+        request.session.clear()
+        
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": f"Logout completed with warning: {str(e)}"}
+        )
+
+# THÊM: Endpoint kiểm tra token
+@app.get("/check-token", tags=["Auth"])
+async def check_token(request: Request):
+    """Kiểm tra token có hợp lệ không"""
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return {"valid": False, "message": "No token provided"}
+    
+    token = auth_header.split(" ")[1]
+    if await is_token_blacklisted(token):
+        return {"valid": False, "message": "Token has been revoked"}
+    try:
+        payload = jwt_keys.decode(token)
+        user_id = payload.get("user_id")
+        user = await get_user_by_id(user_id)
+        
+        if not user:
+            return {"valid": False, "message": "User not found"}
+        
+        return {
+            "valid": True, 
+            "user": user["username"],
+            "role": user["role"],
+            "expires": payload.get("exp")
+        }
+    except jwt.PyJWTError as e:
+        return {"valid": False, "message": f"Token invalid: {str(e)}"}
+
+# THÊM: Introspection theo lô cho gateway (kiểu RFC 7662)
+@app.post("/introspect", tags=["Auth"])
+async def introspect(payload: IntrospectIn, client=Depends(require_introspect_client)):
+    results = await introspect_tokens(payload.tokens)
+    return ORJSONResponse({"results": results}, headers={"Cache-Control": cache_control(results)})
+
+def user_filters(
+    role: Optional[str] = None,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    username_prefix: Optional[str] = Query(None, min_length=1, max_length=50),
+    email_prefix: Optional[str] = Query(None, min_length=1, max_length=100),
+):
+    # Lọc phía server, mỗi tổ hợp đều có index (xem database._m003_user_list_indexes)
+    return {
+        "role": role,
+        "created_from": created_from,
+        "created_to": created_to,
+        "username_prefix": username_prefix,
+        "email_prefix": email_prefix,
+    }
+
+async def _ndjson_users(after: Optional[str], filters: dict):
+    async for batch in iter_user_batches(after=after, filters=filters):
+        yield ndjson_lines(user_out(d) for d in batch)
+
+def _not_modified(tag: str, cache_control: str):
+    return Response(status_code=304, headers={"ETag": tag, "Cache-Control": cache_control, "Vary": "Authorization, Cookie"})
+
+@app.get("/users", response_model=list[UserOut], tags=["Users"])
+async def get_users_route(
+    request: Request,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    filters: dict = Depends(user_filters),
+    admin=Depends(require_admin),
+):
+    # ETag theo version của cả collection (mọi trang cùng đổi khi có ghi); đọc version
+    # trước dữ liệu nên body không bao giờ cũ hơn ETag đi kèm
+    tag = etag("users", await users_version())
+    if etag_matches(request.headers.get("if-none-match"), tag):
+        return _not_modified(tag, USERS_CACHE_CONTROL)
+    headers = {"ETag": tag, "Cache-Control": USERS_CACHE_CONTROL, "Vary": "Authorization, Cookie"}
+
+    if format == "ndjson":
+        try:
+            # Kiểm tra cursor trước khi bắt đầu stream
+            if cursor:
+                check_cursor(filters, cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        return StreamingResponse(_ndjson_users(cursor, filters), media_type="application/x-ndjson", headers=headers)
+
+    try:
+        users, next_cursor = await list_users(limit=limit, after=cursor, filters=filters)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Trang đầy thì trả cursor cho trang kế tiếp
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    # list_users đã trả đúng hình dạng UserOut, bỏ qua bước validate lại
+    return ORJSONResponse(users, headers=headers)
+
+@app.get("/users/count", tags=["Users"])
+async def count_users_route(
+    exact: bool = False,
+    filters: dict = Depends(user_filters),
+    admin=Depends(require_admin),
+):
+    # Mặc định xấp xỉ: không lọc thì đọc metadata, có lọc thì dừng đếm ở ngưỡng
+    return await count_users(filters, exact=exact)
+
+@app.get("/users/me", response_model=UserOut, tags=["Users"])
+async def get_me(request: Request, user: dict = Depends(get_current_user)):
+    # version tăng sau mỗi lần sửa; user lấy từ claim hoặc cache nên 304 không cần đọc DB
+    tag = etag(user["_id"], user.get("version", 0))
+    if etag_matches(request.headers.get("if-none-match"), tag):
+        return _not_modified(tag, "private, no-cache")
+    return ORJSONResponse(user_out(user), headers={"ETag": tag, "Cache-Control": "private, no-cache", "Vary": "Authorization, Cookie"})
+
+def _audit_update(actor: dict, updated: dict, data: dict):
+    # Chỉ ghi tên trường đã đổi (không ghi mật khẩu); đổi role là sự kiện riêng
+    event = "role_changed" if data.get("role") is not None else "user_updated"
+    audit.record(event, username=updated["username"], user_id=updated["_id"], actor=actor.get("username"),
+                 fields=sorted(k for k, v in data.items() if v is not None), role=data.get("role"))
+
+@app.put("/users/me", response_model=UserOut, tags=["Users"])
+async def update_current_user(payload: UserUpdate, current_user: dict = Depends(get_current_user)):
+    data = payload.dict(exclude_unset=True)
+    try:
+        updated = await update_user(current_user["_id"], dict(data))
+    except DuplicateUserError as e:
+        raise HTTPException(status_code=409, detail=f"User already exists ({e.field})")
+    if not updated:
+        raise HTTPException(status_code=404, detail="User not found")
+    _audit_update(current_user, updated, data)
+    return ORJSONResponse(user_out(updated))
+
+@app.put("/users/{username}", response_model=UserOut, tags=["Users"])
+async def update_user_by_username(username: str, payload: UserUpdate, current_user: dict = Depends(get_current_user)):
+    # Quyền chỉ phụ thuộc current_user, nên sửa thẳng theo username trong một round trip
+    if current_user.get("role") != "admin" and current_user.get("username") != username:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    
+    data = payload.dict(exclude_unset=True)
+    try:
+        updated = await update_user_by_name(username, dict(data))
+    except DuplicateUserError as e:
+        raise HTTPException(status_code=409, detail=f"User already exists ({e.field})")
+    if not updated:
+        raise HTTPException(status_code=404, detail="User not found")
+    _audit_update(current_user, updated, data)
+    return ORJSONResponse(user_out(updated))
+
+@app.delete("/users/{username}", tags=["Users"])
+async def delete_user_by_username(username: str, admin=Depends(require_admin)):
+    deleted = await delete_user_by_name(username)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="User not found")
+    audit.record("user_deleted", username=username, user_id=deleted["_id"], actor=admin.get("username"))
+    return {"message": f"User {username} deleted successfully"}
+
+# THÊM: Import/export user hàng loạt (admin)
+@app.post("/admin/users/import", tags=["Admin"])
+async def import_users_route(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"),
+    admin=Depends(require_admin),
+):
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    results = await import_users(iter_rows(iter_lines(request.stream()), fmt))
+    return {**summarize(results), "results": results}
+
+@app.get("/admin/users/export", tags=["Admin"])
+async def export_users_route(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    include_hash: bool = False,
+    admin=Depends(require_admin),
+):
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(export_users(format, include_hash), media_type=media_type)
+
+@app.get("/admin/audit", tags=["Admin"])
+async def export_audit_route(
+    event: Optional[str] = None,
+    username: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    admin=Depends(require_admin),
+):
+    # Stream theo lô từ storage, không dựng cả danh sách trong bộ nhớ
+    filters = {"event": event, "username": username, "since": since, "until": until}
+    async def lines():
+        async for docs in audit.iter_events(filters):
+            yield ndjson_lines(docs)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# THÊM: Số liệu nội bộ cho admin
+def collect_stats():
+    return {
+        "hashing": {**hashing.get_stats(), "rehash": get_rehash_stats()},
+        "revocation": token_store.get_stats(),
+        "refresh_tokens": refresh_store.get_stats(),
+        "cache": cache.get_stats(),
+        "coalesce": get_coalesce_stats(),
+        "ratelimit": ratelimit.get_stats(),
+        "audit": audit.get_stats(),
+        "startup": startup_timings,
+    }
+
+@app.get("/stats", tags=["Admin"])
+async def get_stats(admin=Depends(require_admin)):
+    return collect_stats()
+
+# THÊM: Prometheus scrape endpoint
+@app.get("/metrics", tags=["Ops"], response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(collect_stats()), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile", tags=["Admin"], response_class=PlainTextResponse)
+async def get_profile(
+    limit: int = Query(30, ge=1, le=500),
+    reset: bool = False,
+    rate: Optional[float] = Query(None, ge=0, le=1),
+    admin=Depends(require_admin),
+):
+    # rate: bật/tắt profiler lấy mẫu lúc chạy (0 = tắt)
+    if rate is not None:
+        profile_state["rate"] = rate
+    header = f"sample_rate={profile_state['rate']} samples={profile_state['samples']}\n\n"
+    return PlainTextResponse(header + profile_report(limit, reset))
+
+if __name__ == "__main__":
+    # Nhiều worker: python -m app.cli serve --workers N
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
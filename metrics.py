@@ -0,0 +1,106 @@
+import bisect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Thời gian từng pha (mongo, argon2, jwt, serialize) của request hiện tại,
+# middleware đặt một dict mới cho mỗi request
+_phases = ContextVar("request_phases", default=None)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=""):
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labelvalues, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = _labels(self.labelnames, labelvalues, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _labels(self.labelnames, labelvalues, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route", "status")
+)
+PHASE_SECONDS = Histogram(
+    "app_phase_duration_seconds", "Time spent per phase (mongo, sqlite, memory, redis, argon2, jwt, serialize)", ("phase", "op")
+)
+
+def start_request():
+    phases = {}
+    return phases, _phases.set(phases)
+
+def end_request(token):
+    _phases.reset(token)
+
+def record(phase: str, op: str, elapsed: float):
+    PHASE_SECONDS.observe(elapsed, phase, op)
+    phases = _phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + elapsed
+
+@contextmanager
+def timed(phase: str, op: str = ""):
+    """Đo một pha; dùng được quanh cả lời gọi await trong coroutine."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, op, time.perf_counter() - start)
+
+def server_timing(phases: dict, total: float):
+    parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in phases.items()]
+    parts.append(f"app;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+def _flatten(prefix, value, out):
+    if isinstance(value, bool):
+        out.append((prefix, int(value)))
+    elif isinstance(value, (int, float)):
+        out.append((prefix, value))
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(f"{prefix}_{k}" if prefix else str(k), v, out)
+
+def render(stats: dict = None):
+    lines = REQUEST_SECONDS.render() + PHASE_SECONDS.render()
+    if stats:
+        # Các bộ đếm nội bộ (/stats) xuất dưới dạng gauge app_stat{section,name}
+        lines += ["# HELP app_stat Internal counters from /stats", "# TYPE app_stat gauge"]
+        for section, values in stats.items():
+            flat = []
+            _flatten("", values, flat)
+            for name, v in flat:
+                lines.append(f'app_stat{{section="{_escape(section)}",name="{_escape(name)}"}} {v}')
+    return "\n".join(lines) + "\n"
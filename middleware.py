@@ -1,4 +1,103 @@
-from starlette.middleware.sessions import SessionMiddleware
-
-# Middleware đã được thêm trong main.py
-# File này không bắt buộc nhưng giữ cho đúng cấu trúc project
\ No newline at end of file
+import cProfile
+import io
+import os
+import pstats
+import random
+import time
+from starlette.datastructures import MutableHeaders
+from starlette.middleware.sessions import SessionMiddleware
+
+from app import metrics
+
+# SessionMiddleware được thêm trong main.py
+
+# Mốc thời gian khởi động của worker, tính từ lúc import app
+_t0 = time.perf_counter()
+startup_timings = {
+    "startup_ms": None,        # lifespan sẵn sàng nhận request
+    "ready_ms": None,          # migration + bootstrap xong
+    "first_request_ms": None,  # request HTTP đầu tiên
+}
+
+def mark(phase: str):
+    if startup_timings[phase] is None:
+        startup_timings[phase] = round((time.perf_counter() - _t0) * 1000, 1)
+        print(f"⏱️ {phase}: {startup_timings[phase]} ms after import")
+
+class FirstRequestTimer:
+    """ASGI middleware ghi lại thời điểm request đầu tiên (time-to-first-request)."""
+
+    def __init__(self, app):
+        self.app = app
+        self._seen = False
+
+    async def __call__(self, scope, receive, send):
+        if not self._seen and scope["type"] == "http":
+            self._seen = True
+            mark("first_request_ms")
+        await self.app(scope, receive, send)
+
+# Profiler lấy mẫu: PROFILE_SAMPLE_RATE=0.01 => profile ~1% request (mỗi lúc tối đa một request)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+profile_state = {"rate": PROFILE_SAMPLE_RATE, "active": False, "samples": 0, "stats": None}
+
+def profile_report(limit: int = 30, reset: bool = False):
+    if profile_state["stats"] is None:
+        return "No samples collected"
+    out = io.StringIO()
+    profile_state["stats"].stream = out
+    profile_state["stats"].sort_stats("cumulative").print_stats(limit)
+    if reset:
+        profile_state.update(stats=None, samples=0)
+    return out.getvalue()
+
+class MetricsMiddleware:
+    """ASGI middleware: histogram Prometheus theo route, header Server-Timing
+    với thời gian từng pha (mongo, argon2, jwt, serialize) và profiler lấy mẫu."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        phases, token = metrics.start_request()
+        start = time.perf_counter()
+        status_code = 500
+
+        profiler = None
+        if profile_state["rate"] > 0 and not profile_state["active"] and random.random() < profile_state["rate"]:
+            profile_state["active"] = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", metrics.server_timing(phases, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                if profile_state["stats"] is None:
+                    profile_state["stats"] = pstats.Stats(profiler)
+                else:
+                    profile_state["stats"].add(profiler)
+                profile_state["samples"] += 1
+                profile_state["active"] = False
+            # Dùng template route (/users/{username}) để tránh bùng nổ label
+            route = scope.get("route")
+            metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status_code),
+            )
+            metrics.end_request(token)
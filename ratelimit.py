@@ -0,0 +1,180 @@
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request, status
+
+# Giới hạn tần suất cho /login và /register, kiểm tra trước mọi truy vấn DB và
+# trước Argon2. Giới hạn viết dạng "số_lần/số_giây", ví dụ "10/60".
+#   RATE_LIMIT_BACKEND=memory (mặc định): token bucket trong bộ nhớ từng worker
+#   RATE_LIMIT_BACKEND=redis: bộ đếm cửa sổ cố định dùng chung (app.token_store.get_redis)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Chỉ bật khi chạy sau reverse proxy tin cậy, nếu không client tự giả IP được
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+
+LOGIN_LIMIT_PER_IP = os.getenv("LOGIN_LIMIT_PER_IP", "20/60")
+# Theo username chỉ tính lần đăng nhập sai: người dùng thật không bị khóa
+LOGIN_FAILURES_PER_USER = os.getenv("LOGIN_FAILURES_PER_USER", "5/300")
+LOGIN_LIMIT_GLOBAL = os.getenv("LOGIN_LIMIT_GLOBAL", "200/1")
+REGISTER_LIMIT_PER_IP = os.getenv("REGISTER_LIMIT_PER_IP", "5/60")
+
+def parse_limit(spec: str):
+    count, _, seconds = spec.partition("/")
+    return int(count), float(seconds or 1)
+
+class TokenBucketLimiter:
+    """Token bucket theo key, mỗi thao tác O(1). Bucket đầy tương đương không
+    có bucket, nên chỉ giữ key đang bị trừ; quá max_keys thì bỏ key cũ nhất (LRU)."""
+
+    def __init__(self, name: str, limit: int, period: float, max_keys: int = None):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self.rate = limit / period
+        self.max_keys = max_keys or RATE_LIMIT_MAX_KEYS
+        self._buckets = OrderedDict()  # key -> (tokens, thời điểm cập nhật)
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def _tokens(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(self.limit)
+        tokens, updated = bucket
+        return min(float(self.limit), tokens + (now - updated) * self.rate)
+
+    async def hit(self, key: str, cost: int = 1, peek: bool = False):
+        # Trả về số giây cần chờ (0 nếu được phép). peek=True chỉ kiểm tra, không trừ
+        now = time.monotonic()
+        tokens = self._tokens(key, now)
+        if tokens < cost:
+            self.rejected += 1
+            return (cost - tokens) / self.rate
+        if peek:
+            return 0
+        self.allowed += 1
+        self._buckets[key] = (tokens - cost, now)
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+            self.evictions += 1
+        return 0
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "period": self.period,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "keys": len(self._buckets),
+            "evictions": self.evictions,
+        }
+
+class RedisWindowLimiter:
+    """Bộ đếm cửa sổ cố định trong Redis, dùng chung giữa các worker/máy.
+    Redis lỗi thì dùng token bucket cục bộ thay vì chặn hết request."""
+
+    def __init__(self, name: str, limit: int, period: float, max_keys: int = None):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self.fallback = TokenBucketLimiter(name, limit, period, max_keys)
+        self.allowed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    async def hit(self, key: str, cost: int = 1, peek: bool = False):
+        from app.token_store import get_redis, redis_key
+
+        now = time.time()
+        window = int(now // self.period)
+        retry_after = self.period - (now % self.period)
+        k = redis_key("rl", self.name, key, str(window))
+        try:
+            r = get_redis()
+            if peek:
+                count = int(await r.get(k) or 0) + cost
+            else:
+                async with r.pipeline(transaction=False) as pipe:
+                    pipe.incrby(k, cost)
+                    pipe.expire(k, int(self.period) + 1)
+                    count, _ = await pipe.execute()
+        except Exception:
+            self.errors += 1
+            return await self.fallback.hit(key, cost, peek)
+        if count > self.limit:
+            self.rejected += 1
+            return retry_after
+        if not peek:
+            self.allowed += 1
+        return 0
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "period": self.period,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "fallback": self.fallback.stats(),
+        }
+
+def _limiter(name: str, spec: str):
+    limit, period = parse_limit(spec)
+    cls = RedisWindowLimiter if RATE_LIMIT_BACKEND == "redis" else TokenBucketLimiter
+    return cls(name, limit, period)
+
+login_per_ip = _limiter("login_ip", LOGIN_LIMIT_PER_IP)
+login_failures_per_user = _limiter("login_user", LOGIN_FAILURES_PER_USER)
+login_global = _limiter("login_global", LOGIN_LIMIT_GLOBAL)
+register_per_ip = _limiter("register_ip", REGISTER_LIMIT_PER_IP)
+
+def client_ip(request: Request):
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def _reject(retry_after: float):
+    raise HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, please try again later",
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+    )
+
+async def check_login(request: Request, username: str):
+    # Thứ tự: username (chỉ xem), IP, toàn cục; request bị chặn sớm không trừ các bucket sau
+    if not RATE_LIMIT_ENABLED:
+        return
+    wait = await login_failures_per_user.hit(username.lower(), peek=True)
+    if not wait:
+        wait = await login_per_ip.hit(client_ip(request))
+    if not wait:
+        wait = await login_global.hit("*")
+    if wait:
+        _reject(wait)
+
+async def login_failed(username: str):
+    if RATE_LIMIT_ENABLED:
+        await login_failures_per_user.hit(username.lower())
+
+async def check_register(request: Request):
+    if not RATE_LIMIT_ENABLED:
+        return
+    wait = await register_per_ip.hit(client_ip(request))
+    if wait:
+        _reject(wait)
+
+def get_stats():
+    return {
+        "enabled": RATE_LIMIT_ENABLED,
+        "backend": RATE_LIMIT_BACKEND,
+        "login_ip": login_per_ip.stats(),
+        "login_user_failures": login_failures_per_user.stats(),
+        "login_global": login_global.stats(),
+        "register_ip": register_per_ip.stats(),
+    }
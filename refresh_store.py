@@ -0,0 +1,454 @@
+import asyncio
+import os
+from datetime import datetime
+
+from pymongo import DeleteMany, DeleteOne, InsertOne, UpdateMany
+from pymongo.errors import BulkWriteError
+
+from app import storage
+from app.database import get_db
+from app.cache import TTLCache
+from app.coalesce import SingleFlight
+from app.metrics import timed
+from app.token_store import TOKEN_BACKEND, get_redis, redis_key
+
+# Lưu refresh token (chỉ lưu hash) theo family để phát hiện token bị dùng lại.
+#   REFRESH_STORE=tiered (mặc định): LRU trong bộ nhớ, ghi Mongo theo lô bulk_write;
+#     chỉ đúng với một worker (cli serve --workers >1 mặc định dùng mongo)
+#   REFRESH_STORE=mongo: mỗi thao tác là một lệnh Mongo, kiểm tra dùng lại nguyên tử
+#   REFRESH_STORE=redis: hash có TTL trong Redis (mặc định khi TOKEN_BACKEND=redis)
+#   REFRESH_STORE=embedded: bảng của SQLite/bộ nhớ (mặc định khi STORAGE_BACKEND khác mongo)
+REFRESH_STORE = os.getenv(
+    "REFRESH_STORE",
+    "redis" if TOKEN_BACKEND == "redis" else "embedded" if storage.is_embedded() else "tiered",
+)
+REFRESH_CACHE_SIZE = int(os.getenv("REFRESH_CACHE_SIZE", "50000"))
+# Bản ghi đọc từ Mongo chỉ giữ ngắn: thu hồi từ worker khác thấy được sau tối đa TTL
+REFRESH_CACHE_TTL = float(os.getenv("REFRESH_CACHE_TTL", "60"))
+REFRESH_FLUSH_SECONDS = float(os.getenv("REFRESH_FLUSH_SECONDS", "0.5"))
+REFRESH_FLUSH_MAX = int(os.getenv("REFRESH_FLUSH_MAX", "500"))
+
+def _coll():
+    return get_db()["refresh_tokens"]
+
+class MongoRefreshStore:
+    """Ghi thẳng Mongo. mark_used dùng find_one_and_update nên an toàn
+    khi nhiều worker cùng nhận một token."""
+
+    name = "mongo"
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def insert(self, record: dict):
+        with timed("mongo", "refresh_tokens.insert_one"):
+            await _coll().insert_one(dict(record))
+
+    async def get(self, token_hash: str):
+        with timed("mongo", "refresh_tokens.find_one"):
+            return await _coll().find_one({"token_hash": token_hash}, {"_id": 0})
+
+    async def mark_used(self, token_hash: str, replaced_by: str):
+        # False nếu token đã được đổi trước đó (dấu hiệu bị đánh cắp)
+        with timed("mongo", "refresh_tokens.find_one_and_update"):
+            doc = await _coll().find_one_and_update(
+                {"token_hash": token_hash, "used_at": None},
+                {"$set": {"used_at": datetime.utcnow(), "replaced_by": replaced_by}},
+                projection={"_id": 1},
+            )
+        return doc is not None
+
+    async def delete(self, token_hash: str):
+        with timed("mongo", "refresh_tokens.delete_one"):
+            await _coll().delete_one({"token_hash": token_hash})
+
+    async def revoke_family(self, family_id: str):
+        with timed("mongo", "refresh_tokens.update_many"):
+            await _coll().update_many({"family_id": family_id}, {"$set": {"revoked": True}})
+
+    async def revoke_user(self, user_id: str):
+        with timed("mongo", "refresh_tokens.delete_many"):
+            await _coll().delete_many({"user_id": user_id})
+
+    def get_stats(self):
+        return {"store": self.name}
+
+class TieredRefreshStore(MongoRefreshStore):
+    """LRU trong bộ nhớ phía trước Mongo, ghi theo kiểu write-behind.
+
+    Các thay đổi của cùng một token được gộp vào một thao tác chờ ghi, cứ
+    REFRESH_FLUSH_SECONDS (hoặc khi đủ REFRESH_FLUSH_MAX thao tác) thì ghi một
+    lần bằng bulk_write. Thao tác theo family/user là "rào chắn": thay đổi sau
+    rào không được gộp vào thao tác trước rào để giữ đúng thứ tự.
+
+    Thu hồi theo family/user được ghi nhớ REFRESH_CACHE_TTL giây (lâu hơn nếu
+    lô chưa ghi được) và áp dụng cho bản ghi nạp từ Mongo, nên token chỉ có
+    trong Mongo cũng không đổi được trong lúc chờ ghi.
+
+    Đánh đổi: tiến trình chết đột ngột mất tối đa một chu kỳ ghi, và phát hiện
+    dùng lại cũng như thu hồi giữa các worker khác nhau chỉ thấy được sau khi lô
+    đã được ghi và bản ghi trong LRU hết hạn, nên chỉ dùng khi chạy một worker.
+    """
+
+    name = "tiered"
+
+    def __init__(self):
+        self._hot = TTLCache(REFRESH_CACHE_SIZE, REFRESH_CACHE_TTL)
+        # Request đồng thời cùng một token dùng chung một lần đọc Mongo và một bản
+        # ghi trong LRU, nhờ vậy mark_used của request thứ hai thấy used_at
+        self._loads = SingleFlight()
+        # Thu hồi theo family/user gần đây: "family:<id>" -> True, "user:<id>" -> thời điểm.
+        # Bản ghi đọc từ Mongo trước khi lô thu hồi được ghi vẫn bị thu hồi khi nạp
+        self._revokes = TTLCache(REFRESH_CACHE_SIZE, REFRESH_CACHE_TTL)
+        self._pending = []
+        self._index = {}  # token_hash -> thao tác chờ ghi gần nhất
+        self._generation = 0
+        self._wake = asyncio.Event()
+        self._task = None
+        self._stats = {"flushes": 0, "flushed_ops": 0, "coalesced": 0, "flush_errors": 0, "write_errors": 0}
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=REFRESH_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def _queue(self, entry: dict, key: str = None):
+        entry["gen"] = self._generation
+        self._pending.append(entry)
+        if key is None:
+            self._generation += 1
+        else:
+            self._index[key] = entry
+        if self._task is None:
+            # Chưa chạy vòng ghi nền (CLI, script): ghi ngay
+            await self.flush()
+        elif len(self._pending) >= REFRESH_FLUSH_MAX:
+            self._wake.set()
+
+    def _mergeable(self, key: str):
+        entry = self._index.get(key)
+        if entry is not None and entry["gen"] == self._generation:
+            self._stats["coalesced"] += 1
+            return entry
+        return None
+
+    async def insert(self, record: dict):
+        h = record["token_hash"]
+        self._hot.set(h, record)
+        await self._queue({"op": "insert", "doc": dict(record)}, h)
+
+    async def get(self, token_hash: str):
+        record = self._hot.get(token_hash)
+        if record is not None:
+            return record
+        entry = self._index.get(token_hash)
+        if entry is not None and entry["op"] == "insert":
+            record = dict(entry["doc"])
+        elif entry is not None and entry["op"] == "delete":
+            return None
+        else:
+            return await self._loads.do(token_hash, lambda: self._load(token_hash))
+        self._hot.set(token_hash, record)
+        return record
+
+    async def _load(self, token_hash: str):
+        record = await super().get(token_hash)
+        # Trong lúc chờ Mongo, thao tác khác có thể đã đưa bản ghi vào LRU hoặc xóa
+        # nó: bản trong LRU luôn thắng để mọi request thấy cùng một đối tượng
+        cached = self._hot.get(token_hash)
+        if cached is not None:
+            return cached
+        entry = self._index.get(token_hash)
+        if record is None or (entry is not None and entry["op"] == "delete"):
+            return None
+        revoked_at = self._revokes.get(f"user:{record.get('user_id')}")
+        if revoked_at is not None and record["created_at"] <= revoked_at:
+            return None
+        if self._revokes.get(f"family:{record.get('family_id')}"):
+            record["revoked"] = True
+        if entry is not None and entry["op"] == "set":
+            record.update(entry["fields"])
+        self._hot.set(token_hash, record)
+        return record
+
+    async def mark_used(self, token_hash: str, replaced_by: str):
+        record = await self.get(token_hash)
+        if record is None or record.get("used_at") is not None:
+            return False
+        fields = {"used_at": datetime.utcnow(), "replaced_by": replaced_by}
+        record.update(fields)
+        await self._set(token_hash, fields)
+        return True
+
+    async def _set(self, token_hash: str, fields: dict):
+        entry = self._mergeable(token_hash)
+        if entry is not None and entry["op"] == "insert":
+            entry["doc"].update(fields)
+        elif entry is not None and entry["op"] == "set":
+            entry["fields"].update(fields)
+        else:
+            await self._queue({"op": "set", "fields": dict(fields)}, token_hash)
+
+    async def delete(self, token_hash: str):
+        self._hot.delete(token_hash)
+        self._loads.forget(token_hash)
+        entry = self._mergeable(token_hash)
+        if entry is not None and entry["op"] == "insert":
+            # Chưa kịp ghi thì bỏ luôn, không cần round trip nào
+            self._pending.remove(entry)
+            self._index.pop(token_hash, None)
+            return
+        await self._queue({"op": "delete"}, token_hash)
+
+    def _local_records(self):
+        # Bản ghi trong LRU và bản ghi chờ insert (có thể đã bị đẩy khỏi LRU)
+        yield from self._hot.values()
+        for entry in self._index.values():
+            if entry["op"] == "insert":
+                yield entry["doc"]
+
+    async def revoke_family(self, family_id: str):
+        mark = (f"family:{family_id}", True)
+        self._revokes.set(*mark)
+        for record in self._local_records():
+            if record.get("family_id") == family_id:
+                record["revoked"] = True
+        await self._queue({"op": "update_many", "filter": {"family_id": family_id},
+                           "update": {"$set": {"revoked": True}}, "mark": mark})
+
+    async def revoke_user(self, user_id: str):
+        mark = (f"user:{user_id}", datetime.utcnow())
+        self._revokes.set(*mark)
+        for record in list(self._local_records()):
+            if record.get("user_id") == user_id:
+                record["revoked"] = True
+                self._hot.delete(record["token_hash"])
+        await self._queue({"op": "delete_many", "filter": {"user_id": user_id}, "mark": mark})
+
+    def _to_request(self, key, entry):
+        op = entry["op"]
+        if op == "insert":
+            return InsertOne(dict(entry["doc"]))
+        if op == "set":
+            # token_hash là unique nên UpdateMany tương đương UpdateOne; dùng
+            # UpdateMany vì UpdateOne của pymongo mới không chạy với mongomock (benchmark)
+            return UpdateMany({"token_hash": key}, {"$set": entry["fields"]})
+        if op == "delete":
+            return DeleteOne({"token_hash": key})
+        if op == "update_many":
+            return UpdateMany(entry["filter"], entry["update"])
+        return DeleteMany(entry["filter"])
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        keys = {id(entry): key for key, entry in self._index.items()}
+        self._index = {}
+        self._generation += 1
+        requests = [self._to_request(keys.get(id(entry)), entry) for entry in batch]
+        try:
+            with timed("mongo", "refresh_tokens.bulk_write"):
+                await _coll().bulk_write(requests, ordered=True)
+        except BulkWriteError as e:
+            # Lô có thứ tự dừng ở lỗi đầu tiên: bỏ thao tác lỗi, ghi lại phần còn lại
+            self._stats["write_errors"] += 1
+            failed = e.details["writeErrors"][0]["index"]
+            print(f"⚠️ Refresh token write failed: {e.details['writeErrors'][0].get('errmsg')}")
+            self._requeue(batch[failed + 1:], keys)
+            return
+        except Exception as e:
+            self._stats["flush_errors"] += 1
+            print(f"⚠️ Refresh token flush failed, will retry: {e}")
+            self._requeue(batch, keys)
+            return
+        self._stats["flushes"] += 1
+        self._stats["flushed_ops"] += len(batch)
+
+    def _requeue(self, entries, keys):
+        # Đặt lại trước các thao tác mới; thế hệ cũ nên không bị gộp thêm
+        self._pending[:0] = entries
+        for entry in entries:
+            if "mark" in entry:
+                # Thu hồi chưa ghi được: giữ dấu cho tới khi ghi xong
+                self._revokes.set(*entry["mark"])
+            key = keys.get(id(entry))
+            if key is not None and key not in self._index:
+                self._index[key] = entry
+
+    def get_stats(self):
+        return {
+            **self._stats,
+            "store": self.name,
+            "pending": len(self._pending),
+            "hot": self._hot.stats(),
+        }
+
+class RedisRefreshStore:
+    """Mỗi token là một hash rt:<hash> hết hạn cùng token; set rtf:<family> và
+    rtu:<user> giữ danh sách hash để thu hồi theo family/user. Mỗi thao tác là
+    một round trip nhờ pipeline."""
+
+    name = "redis"
+
+    def __init__(self):
+        self._stats = {"reuse_detected": 0}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def insert(self, record: dict):
+        h = record["token_hash"]
+        ttl = max(1, int((record["expires_at"] - datetime.utcnow()).total_seconds()))
+        fields = {
+            "user_id": record["user_id"],
+            "family_id": record["family_id"],
+            "expires_at": record["expires_at"].isoformat(),
+            "created_at": record["created_at"].isoformat(),
+        }
+        with timed("redis", "refresh.insert"):
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.hset(redis_key("rt", h), mapping=fields)
+                pipe.expire(redis_key("rt", h), ttl)
+                pipe.sadd(redis_key("rtf", record["family_id"]), h)
+                pipe.expire(redis_key("rtf", record["family_id"]), ttl)
+                pipe.sadd(redis_key("rtu", record["user_id"]), h)
+                pipe.expire(redis_key("rtu", record["user_id"]), ttl)
+                await pipe.execute()
+
+    async def get(self, token_hash: str):
+        with timed("redis", "refresh.get"):
+            fields = await get_redis().hgetall(redis_key("rt", token_hash))
+        if not fields or "user_id" not in fields:
+            return None
+        return {
+            "token_hash": token_hash,
+            "user_id": fields["user_id"],
+            "family_id": fields["family_id"],
+            "expires_at": datetime.fromisoformat(fields["expires_at"]),
+            "created_at": datetime.fromisoformat(fields["created_at"]),
+            "used_at": datetime.fromisoformat(fields["used_at"]) if fields.get("used_at") else None,
+            "replaced_by": fields.get("replaced_by"),
+            "revoked": fields.get("revoked") == "1",
+        }
+
+    async def mark_used(self, token_hash: str, replaced_by: str):
+        # HSETNX nguyên tử: chỉ lần đổi đầu tiên thành công, kể cả giữa nhiều worker
+        key = redis_key("rt", token_hash)
+        with timed("redis", "refresh.mark_used"):
+            async with get_redis().pipeline(transaction=True) as pipe:
+                pipe.hsetnx(key, "replaced_by", replaced_by)
+                pipe.hsetnx(key, "used_at", datetime.utcnow().isoformat())
+                # Key vừa hết hạn thì HSETNX tạo key mới không có TTL, đặt TTL ngắn cho nó
+                pipe.expire(key, 60, nx=True)
+                first, _, _ = await pipe.execute()
+        if not first:
+            self._stats["reuse_detected"] += 1
+        return bool(first)
+
+    async def delete(self, token_hash: str):
+        with timed("redis", "refresh.delete"):
+            await get_redis().delete(redis_key("rt", token_hash))
+
+    async def revoke_family(self, family_id: str):
+        r = get_redis()
+        with timed("redis", "refresh.revoke_family"):
+            hashes = await r.smembers(redis_key("rtf", family_id))
+            async with r.pipeline(transaction=False) as pipe:
+                for h in hashes:
+                    pipe.hset(redis_key("rt", h), "revoked", "1")
+                    # Key đã hết hạn bị HSET tạo lại (không có user_id, get() bỏ qua): cho TTL ngắn
+                    pipe.expire(redis_key("rt", h), 60, nx=True)
+                await pipe.execute()
+
+    async def revoke_user(self, user_id: str):
+        r = get_redis()
+        with timed("redis", "refresh.revoke_user"):
+            hashes = await r.smembers(redis_key("rtu", user_id))
+            keys = [redis_key("rt", h) for h in hashes] + [redis_key("rtu", user_id)]
+            await r.delete(*keys)
+
+    def get_stats(self):
+        return {**self._stats, "store": self.name}
+
+class EmbeddedRefreshStore:
+    """Chuyển thẳng tới backend nhúng (app.storage): mỗi thao tác là một câu
+    SQL hoặc một phép tra dict nên không cần cache hay ghi theo lô."""
+
+    name = "embedded"
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def insert(self, record: dict):
+        await storage.get_storage().refresh_insert(record)
+
+    async def get(self, token_hash: str):
+        return await storage.get_storage().refresh_get(token_hash)
+
+    async def mark_used(self, token_hash: str, replaced_by: str):
+        return await storage.get_storage().refresh_mark_used(token_hash, replaced_by)
+
+    async def delete(self, token_hash: str):
+        await storage.get_storage().refresh_delete(token_hash)
+
+    async def revoke_family(self, family_id: str):
+        await storage.get_storage().refresh_revoke_family(family_id)
+
+    async def revoke_user(self, user_id: str):
+        await storage.get_storage().refresh_revoke_user(user_id)
+
+    def get_stats(self):
+        return {"store": self.name, "backend": storage.STORAGE_BACKEND}
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None:
+        if REFRESH_STORE == "redis":
+            _store = RedisRefreshStore()
+        elif REFRESH_STORE == "mongo":
+            _store = MongoRefreshStore()
+        elif REFRESH_STORE == "embedded":
+            _store = EmbeddedRefreshStore()
+        else:
+            _store = TieredRefreshStore()
+    return _store
+
+async def start():
+    await get_store().start()
+
+async def stop():
+    if _store is not None:
+        await _store.stop()
+
+def get_stats():
+    return get_store().get_stats()
@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+from app.database import get_db
+
+# Bản sao cục bộ của token_blacklist: request bình thường không cần truy vấn Mongo
+REVOCATION_POLL_SECONDS = float(os.getenv("REVOCATION_POLL_SECONDS", "5"))
+
+_revoked = {}  # token_hash -> expires_at
+_last_seen = None
+_task = None
+_stats = {"checks": 0, "revoked_hits": 0, "reloads": 0, "poll_errors": 0}
+
+def token_hash(token: str):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def add(token_hash_value: str, expires_at: datetime):
+    _revoked[token_hash_value] = expires_at
+
+def is_revoked(token: str):
+    _stats["checks"] += 1
+    h = token_hash(token)
+    expires_at = _revoked.get(h)
+    if expires_at is None:
+        return False
+    if expires_at < datetime.utcnow():
+        # Token đã hết hạn thì JWT cũng không còn hợp lệ, bỏ khỏi bộ nhớ
+        _revoked.pop(h, None)
+        return False
+    _stats["revoked_hits"] += 1
+    return True
+
+def _apply(doc):
+    global _last_seen
+    h = doc.get("token_hash") or token_hash(doc["token"])
+    add(h, doc["expires_at"])
+    blacklisted_at = doc.get("blacklisted_at")
+    if blacklisted_at and (_last_seen is None or blacklisted_at > _last_seen):
+        _last_seen = blacklisted_at
+
+def _purge_expired():
+    now = datetime.utcnow()
+    for h in [h for h, exp in _revoked.items() if exp < now]:
+        _revoked.pop(h, None)
+
+async def load():
+    _revoked.clear()
+    cursor = get_db()["token_blacklist"].find(
+        {"expires_at": {"$gt": datetime.utcnow()}},
+        {"_id": 0, "token": 1, "token_hash": 1, "expires_at": 1, "blacklisted_at": 1},
+    )
+    async for doc in cursor:
+        _apply(doc)
+    _stats["reloads"] += 1
+
+async def poll_once():
+    query = {}
+    if _last_seen is not None:
+        # Lùi lại một chu kỳ để không bỏ sót bản ghi ghi muộn từ worker khác
+        query["blacklisted_at"] = {"$gte": _last_seen - timedelta(seconds=max(REVOCATION_POLL_SECONDS, 1))}
+    cursor = get_db()["token_blacklist"].find(
+        query, {"_id": 0, "token": 1, "token_hash": 1, "expires_at": 1, "blacklisted_at": 1}
+    )
+    async for doc in cursor:
+        _apply(doc)
+    _purge_expired()
+
+async def _poll_loop():
+    while True:
+        await asyncio.sleep(REVOCATION_POLL_SECONDS)
+        try:
+            await poll_once()
+        except Exception as e:
+            _stats["poll_errors"] += 1
+            print(f"⚠️ Revocation poll failed: {e}")
+
+async def start():
+    global _task
+    try:
+        await load()
+        print(f"✅ Revocation cache loaded ({len(_revoked)} tokens)")
+    except Exception as e:
+        print(f"⚠️ Could not load revocation cache: {e}")
+    if REVOCATION_POLL_SECONDS > 0 and _task is None:
+        _task = asyncio.create_task(_poll_loop())
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+def get_stats():
+    return {**_stats, "size": len(_revoked), "poll_seconds": REVOCATION_POLL_SECONDS}
@@ -0,0 +1,1020 @@
+import asyncio
+import base64
+import json
+import os
+import re
+import sqlite3
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+import orjson
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from app import database
+from app.metrics import timed
+
+# Nơi lưu user (và refresh token/blacklist với backend nhúng):
+#   STORAGE_BACKEND=mongo (mặc định): MongoDB qua Motor (app.database)
+#   STORAGE_BACKEND=sqlite: file SQLITE_PATH ở chế độ WAL, không cần service ngoài
+#   STORAGE_BACKEND=memory: dict trong tiến trình, mất khi khởi động lại (chạy thử, test)
+# Backend nhúng chỉ dành cho một worker: cache invalidation giữa các worker cần Mongo.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "app.db")
+# Chu kỳ xóa refresh token/blacklist/audit đã hết hạn (Mongo dùng TTL index)
+STORAGE_PURGE_SECONDS = float(os.getenv("STORAGE_PURGE_SECONDS", "300"))
+# Backend memory giữ tối đa chừng này sự kiện audit (bỏ cũ nhất, như capped collection)
+AUDIT_MEMORY_MAX_EVENTS = int(os.getenv("AUDIT_MEMORY_MAX_EVENTS", "100000"))
+
+class DuplicateUserError(Exception):
+    """username hoặc email đã tồn tại (unique index từ chối)."""
+
+    def __init__(self, field: str = "user"):
+        super().__init__(f"{field} already exists")
+        self.field = field
+
+# Chỉ lấy các trường của UserOut, không kéo password_hash/created_at về
+USER_OUT_PROJECTION = {"username": 1, "email": 1, "role": 1}
+# Trả về đúng các trường cần cho UserOut + version, không kéo password_hash về
+USER_WRITE_PROJECTION = {**USER_OUT_PROJECTION, "version": 1}
+
+# Bộ lọc danh sách user. Mỗi tổ hợp có index tương ứng (Mongo: migration 3,
+# SQLite: _SQLITE_SCHEMA) theo thứ tự equality (role) -> sort -> range, nên
+# không phải sort trong bộ nhớ; kiểm tra Mongo bằng `python -m app.cli explain-users`.
+USER_FILTERS = ("role", "created_from", "created_to", "username_prefix", "email_prefix")
+UNIQUE_SORT_FIELDS = ("username", "email")
+
+def _naive_utc(value: datetime):
+    # Mọi thời điểm được lưu dạng UTC không kèm múi giờ (như datetime.utcnow())
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def sort_field(filters: dict = None):
+    # Sắp xếp theo trường đang lọc khoảng/tiền tố để index phục vụ cả lọc lẫn sort
+    filters = filters or {}
+    if filters.get("username_prefix"):
+        return "username"
+    if filters.get("email_prefix"):
+        return "email"
+    if filters.get("created_from") or filters.get("created_to"):
+        return "created_at"
+    return "_id"
+
+def encode_cursor(doc: dict, field: str):
+    if field == "_id":
+        return str(doc["_id"])
+    value = doc[field]
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, str(doc["_id"])]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(field: str, cursor: str):
+    # Trả về ObjectId (sort theo _id) hoặc (giá trị, ObjectId); ném ValueError nếu không hợp lệ
+    if field == "_id":
+        if not ObjectId.is_valid(cursor):
+            raise ValueError("invalid cursor")
+        return ObjectId(cursor)
+    try:
+        value, id_str = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        last_id = ObjectId(id_str)
+        if field == "created_at":
+            value = datetime.fromisoformat(value)
+        elif not isinstance(value, str):
+            raise ValueError
+    except Exception:
+        raise ValueError("invalid cursor")
+    return value, last_id
+
+def list_projection(field: str):
+    # Cursor theo created_at cần giá trị đó trong document trả về
+    return {**USER_OUT_PROJECTION, "created_at": 1} if field == "created_at" else USER_OUT_PROJECTION
+
+def event_query(event=None, username=None, since=None, until=None):
+    query = {}
+    if event:
+        query["event"] = event
+    if username:
+        query["username"] = username
+    if since or until:
+        query["at"] = {}
+        if since:
+            query["at"]["$gte"] = _naive_utc(since)
+        if until:
+            query["at"]["$lt"] = _naive_utc(until)
+    return query
+
+def _duplicate_field(err: dict):
+    key_value = err.get("keyValue") or err.get("keyPattern")
+    if key_value:
+        return next(iter(key_value))
+    msg = err.get("errmsg", "")
+    return next((f for f in ("username", "email") if f in msg), "user")
+
+# --- Mongo -------------------------------------------------------------------
+
+def _prefix(prefix: str):
+    # Regex neo đầu chuỗi, phân biệt hoa thường: Mongo dùng được index bounds
+    return {"$regex": "^" + re.escape(prefix)}
+
+def user_query(role=None, created_from=None, created_to=None, username_prefix=None, email_prefix=None):
+    query = {}
+    if role:
+        query["role"] = role
+    if created_from or created_to:
+        query["created_at"] = {}
+        if created_from:
+            query["created_at"]["$gte"] = created_from
+        if created_to:
+            query["created_at"]["$lt"] = created_to
+    if username_prefix:
+        query["username"] = _prefix(username_prefix)
+    if email_prefix:
+        query["email"] = _prefix(email_prefix)
+    return query
+
+def build_list_query(filters: dict = None, after: str = None):
+    # Trả về (query, sort, field) cho find(); dùng chung cho list, stream và explain
+    query = user_query(**(filters or {}))
+    field = sort_field(filters)
+    if field == "_id" or field in UNIQUE_SORT_FIELDS:
+        sort = [(field, 1)]
+    else:
+        sort = [(field, 1), ("_id", 1)]
+    if after:
+        key = decode_cursor(field, after)
+        if field == "_id":
+            clause = {"_id": {"$gt": key}}
+        elif field in UNIQUE_SORT_FIELDS:
+            clause = {field: {"$gt": key[0]}}
+        else:
+            value, last_id = key
+            # $gte ở ngoài cho planner cận dưới trên index, $or chỉ lọc các bản ghi trùng giá trị
+            clause = {field: {"$gte": value}, "$or": [{field: {"$gt": value}}, {"_id": {"$gt": last_id}}]}
+        query = {"$and": [query, clause]} if query else clause
+    return query, sort, field
+
+# Không lọc thì đếm theo metadata (O(1)); có lọc thì đếm trên index, chế độ
+# xấp xỉ dừng ở USER_COUNT_APPROX_LIMIT để màn hình admin không phải chờ
+USER_COUNT_APPROX_LIMIT = int(os.getenv("USER_COUNT_APPROX_LIMIT", "10000"))
+
+class MongoStorage:
+    """User trong collection users. Refresh token và blacklist của Mongo nằm ở
+    app.refresh_store/app.token_store (có cache và ghi theo lô riêng)."""
+
+    name = "mongo"
+    embedded = False
+
+    def __init__(self, db=None):
+        self._db = db
+
+    def _users(self):
+        return (self._db if self._db is not None else database.get_db())["users"]
+
+    def _meta(self):
+        return (self._db if self._db is not None else database.get_db())["meta"]
+
+    async def _bump_users_version(self):
+        # Bộ đếm $inc nguyên tử, tăng sau khi ghi xong: ai đọc được version mới thì
+        # cũng đọc được dữ liệu mới. epoch chỉ đặt khi tạo bản ghi, DB bị tạo lại
+        # thì ETag cũ không trùng
+        with timed("mongo", "meta.update_one"):
+            await self._meta().update_one(
+                {"_id": "users"}, {"$inc": {"version": 1}, "$setOnInsert": {"epoch": ObjectId()}}, upsert=True
+            )
+
+    async def users_version(self):
+        # Một lần đọc theo _id cho mỗi GET /users, kể cả khi trả 304
+        with timed("mongo", "meta.find_one"):
+            doc = await self._meta().find_one({"_id": "users"})
+        return f"{doc['epoch']}-{doc['version']}" if doc else "0"
+
+    async def init(self, on_leader=None):
+        return await database.init_db(on_leader=on_leader)
+
+    async def ping(self):
+        await database.ping()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def insert_user(self, doc: dict):
+        # Một lần insert, unique index quyết định trùng lặp; gán doc["_id"]
+        try:
+            with timed("mongo", "users.insert_one"):
+                await self._users().insert_one(doc)
+        except DuplicateKeyError as e:
+            raise DuplicateUserError(_duplicate_field(e.details or {}))
+        await self._bump_users_version()
+        return doc
+
+    async def insert_users(self, docs: list):
+        # insert_many không thứ tự: một dòng trùng không chặn các dòng còn lại.
+        # Trả về {vị trí: lỗi}; các dòng thành công được gán doc["_id"]
+        try:
+            with timed("mongo", "users.insert_many"):
+                await self._users().insert_many(docs, ordered=False)
+            await self._bump_users_version()
+            return {}
+        except BulkWriteError as e:
+            errors = {}
+            for err in e.details.get("writeErrors", []):
+                if err.get("code") == 11000:
+                    errors[err["index"]] = f"{_duplicate_field(err)} already exists"
+                else:
+                    errors[err["index"]] = err.get("errmsg", "write error")
+            if e.details.get("nInserted"):
+                await self._bump_users_version()
+            return errors
+
+    async def find_user_by_username(self, username: str):
+        with timed("mongo", "users.find_one"):
+            return await self._users().find_one({"username": username})
+
+    async def find_users_by_ids(self, ids: list):
+        with timed("mongo", "users.find"):
+            return await self._users().find({"_id": {"$in": ids}}).to_list(length=len(ids))
+
+    async def list_users(self, filters: dict = None, after: str = None, limit: int = 100, projection: dict = None):
+        query, sort, _ = build_list_query(filters, after)
+        cursor = self._users().find(query, projection).sort(sort).limit(limit)
+        with timed("mongo", "users.find"):
+            return await cursor.to_list(length=limit)
+
+    async def iter_users(self, filters: dict = None, after: str = None, batch_size: int = 500, projection: dict = None):
+        query, sort, _ = build_list_query(filters, after)
+        cursor = self._users().find(query, projection).sort(sort).batch_size(batch_size)
+        while True:
+            with timed("mongo", "users.find"):
+                docs = await cursor.to_list(length=batch_size)
+            if not docs:
+                break
+            yield docs
+
+    async def count_users(self, filters: dict = None, exact: bool = False):
+        query = user_query(**(filters or {}))
+        if not query and not exact:
+            with timed("mongo", "users.estimated_document_count"):
+                return {"count": await self._users().estimated_document_count(), "exact": False}
+        if exact:
+            with timed("mongo", "users.count_documents"):
+                return {"count": await self._users().count_documents(query), "exact": True}
+        with timed("mongo", "users.count_documents"):
+            n = await self._users().count_documents(query, limit=USER_COUNT_APPROX_LIMIT)
+        return {"count": n, "exact": n < USER_COUNT_APPROX_LIMIT}
+
+    async def update_user(self, key: dict, fields: dict):
+        # key là {"_id": ObjectId} hoặc {"username": ...}; tăng version, trả về bản ghi sau khi sửa
+        try:
+            with timed("mongo", "users.find_one_and_update"):
+                doc = await self._users().find_one_and_update(
+                    key,
+                    {"$set": fields, "$inc": {"version": 1}},
+                    projection=USER_WRITE_PROJECTION,
+                    return_document=ReturnDocument.AFTER,
+                )
+        except DuplicateKeyError as e:
+            raise DuplicateUserError(_duplicate_field(e.details or {}))
+        if doc:
+            await self._bump_users_version()
+        return doc
+
+    async def set_password_hash(self, user_id: ObjectId, old_hash: str, new_hash: str):
+        # Băm lại cùng mật khẩu: không tăng version/updated_at, không đổi ETag.
+        # Điều kiện trên hash cũ để không đè mật khẩu vừa được đổi song song
+        with timed("mongo", "users.update_one"):
+            result = await self._users().update_one(
+                {"_id": user_id, "password_hash": old_hash}, {"$set": {"password_hash": new_hash}}
+            )
+        return result.modified_count == 1
+
+    async def delete_user(self, key: dict):
+        with timed("mongo", "users.find_one_and_delete"):
+            doc = await self._users().find_one_and_delete(key, projection={"username": 1})
+        if doc:
+            await self._bump_users_version()
+        return doc
+
+    # Sự kiện audit (app.audit): collection audit_events có TTL index (migration 4)
+    def _events(self):
+        return (self._db if self._db is not None else database.get_db())["audit_events"]
+
+    async def insert_events(self, docs: list):
+        # Ghi lại một lô đã ghi dở thì _id trùng: coi như đã ghi (at-least-once, không nhân đôi)
+        try:
+            with timed("mongo", "audit_events.insert_many"):
+                await self._events().insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+
+    async def iter_events(self, filters: dict = None, batch_size: int = 500):
+        cursor = self._events().find(event_query(**(filters or {})), {"_id": 0}).sort([("at", 1), ("_id", 1)]).batch_size(batch_size)
+        while True:
+            with timed("mongo", "audit_events.find"):
+                docs = await cursor.to_list(length=batch_size)
+            if not docs:
+                break
+            yield docs
+
+# --- Backend nhúng -------------------------------------------------------------
+
+def _project(doc: dict, projection: dict = None):
+    if projection is None:
+        return dict(doc)
+    out = {"_id": doc["_id"]}
+    for field in projection:
+        if field in doc:
+            out[field] = doc[field]
+    return out
+
+class _EmbeddedStorage:
+    """Phần chung của SQLite và memory: khởi động, dọn bản ghi hết hạn, và
+    phân trang bằng list_users cho iter_users."""
+
+    embedded = True
+
+    def __init__(self):
+        self._task = None
+
+    async def init(self, on_leader=None):
+        # Không có migration/lock như Mongo: schema tạo ngay khi mở
+        self.open()
+        print(f"✅ {self.name} storage ready")
+        if on_leader is not None:
+            await on_leader()
+        return True
+
+    async def ping(self):
+        self.open()
+
+    async def start(self):
+        self.purge_expired()
+        if STORAGE_PURGE_SECONDS > 0 and self._task is None:
+            self._task = asyncio.create_task(self._purge_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(STORAGE_PURGE_SECONDS)
+            try:
+                self.purge_expired()
+            except Exception as e:
+                print(f"⚠️ Storage purge failed: {e}")
+
+    async def iter_users(self, filters: dict = None, after: str = None, batch_size: int = 500, projection: dict = None):
+        field = sort_field(filters)
+        # Cần trường sort trong document để dựng cursor cho lô kế tiếp
+        wanted = None if projection is None else {**projection, field: 1}
+        while True:
+            docs = await self.list_users(filters, after, batch_size, wanted)
+            if not docs:
+                break
+            after = encode_cursor(docs[-1], field)
+            if projection is not None and field not in projection and field != "_id":
+                for doc in docs:
+                    doc.pop(field, None)
+            yield docs
+            if len(docs) < batch_size:
+                break
+
+def _ts(value: datetime):
+    # Độ dài cố định để so sánh chuỗi đúng thứ tự thời gian
+    return None if value is None else _naive_utc(value).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+def _dt(value: str):
+    return None if value is None else datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+
+def _glob_prefix(prefix: str):
+    # GLOB phân biệt hoa thường như regex của Mongo và dùng được index trên cột
+    return "".join(f"[{c}]" if c in "*?[" else c for c in prefix) + "*"
+
+# Mỗi phần tử là một bước schema, PRAGMA user_version ghi số bước đã chạy
+_SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        email TEXT NOT NULL UNIQUE,
+        password_hash TEXT,
+        role TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1,
+        created_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS users_role_id ON users (role, id);
+    CREATE INDEX IF NOT EXISTS users_created_id ON users (created_at, id);
+    CREATE INDEX IF NOT EXISTS users_role_created_id ON users (role, created_at, id);
+    CREATE INDEX IF NOT EXISTS users_role_username ON users (role, username);
+    CREATE INDEX IF NOT EXISTS users_role_email ON users (role, email);
+    CREATE TABLE IF NOT EXISTS refresh_tokens (
+        token_hash TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        family_id TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        expires_at TEXT NOT NULL,
+        used_at TEXT,
+        replaced_by TEXT,
+        revoked INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS refresh_tokens_family ON refresh_tokens (family_id);
+    CREATE INDEX IF NOT EXISTS refresh_tokens_user ON refresh_tokens (user_id);
+    CREATE INDEX IF NOT EXISTS refresh_tokens_expires ON refresh_tokens (expires_at);
+    CREATE TABLE IF NOT EXISTS revoked_tokens (
+        token_hash TEXT PRIMARY KEY,
+        user_id TEXT,
+        expires_at TEXT NOT NULL,
+        blacklisted_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS revoked_tokens_expires ON revoked_tokens (expires_at);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS audit_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        at TEXT NOT NULL,
+        event TEXT NOT NULL,
+        username TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS audit_events_at ON audit_events (at);
+    CREATE INDEX IF NOT EXISTS audit_events_event_at ON audit_events (event, at);
+    CREATE INDEX IF NOT EXISTS audit_events_username_at ON audit_events (username, at);
+    """,
+    # users_version bắt đầu ngẫu nhiên: file DB tạo lại thì ETag cũ không trùng
+    """
+    ALTER TABLE users ADD COLUMN updated_at TEXT;
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO meta (key, value) VALUES ('users_version', abs(random() % 1000000000));
+    """,
+    # users_version tăng trong cùng câu lệnh ghi (trigger) thay vì một câu riêng sau đó.
+    # Chỉ tính cột hiện ra ngoài (update_user luôn tăng version); đổi riêng password_hash
+    # (băm lại) không đổi ETag
+    """
+    CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'users_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE OF username, email, role, version ON users BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'users_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS users_version_delete AFTER DELETE ON users BEGIN
+        UPDATE meta SET value = value + 1 WHERE key = 'users_version';
+    END;
+    """,
+]
+
+_USER_COLUMNS = ("username", "email", "password_hash", "role", "version", "created_at", "updated_at")
+_USER_DATETIMES = ("created_at", "updated_at")
+_USER_SELECT = "SELECT id, " + ", ".join(_USER_COLUMNS) + " FROM users"
+_REFRESH_SELECT = ("SELECT token_hash, user_id, family_id, created_at, expires_at, used_at, replaced_by, revoked "
+                   "FROM refresh_tokens WHERE token_hash = ?")
+
+def _sqlite_duplicate_field(err: sqlite3.IntegrityError):
+    msg = str(err)
+    return next((f for f in ("username", "email") if f"users.{f}" in msg), "user")
+
+class SQLiteStorage(_EmbeddedStorage):
+    """SQLite chế độ WAL: đọc không chặn ghi, ghi tuần tự. Câu lệnh là chuỗi cố
+    định với tham số ?, sqlite3 giữ sẵn bản đã prepare trong cache theo kết nối
+    nên mỗi lookup chỉ còn bind + step. Truy vấn chạy thẳng trên event loop vì
+    chỉ mất vài micro giây (file nằm trong page cache)."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str = None):
+        super().__init__()
+        self.path = path or SQLITE_PATH
+        self._conn = None
+
+    def open(self):
+        if self._conn is not None:
+            return self._conn
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA foreign_keys=ON")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for step, script in enumerate(_SQLITE_SCHEMA[version:], start=version + 1):
+            conn.executescript(f"BEGIN; {script}; PRAGMA user_version = {step}; COMMIT;")
+        self._conn = conn
+        return conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def stop(self):
+        await super().stop()
+        self.close()
+
+    def _user(self, row, projection: dict = None):
+        doc = {"_id": ObjectId(row[0])}
+        for field, value in zip(_USER_COLUMNS, row[1:]):
+            if projection is None or field in projection:
+                if field in _USER_DATETIMES:
+                    # NULL tương ứng trường không tồn tại trong document Mongo
+                    if value is not None:
+                        doc[field] = _dt(value)
+                else:
+                    doc[field] = value
+        return doc
+
+    def _insert(self, conn, doc: dict):
+        doc.setdefault("_id", ObjectId())
+        conn.execute(
+            "INSERT INTO users (id, username, email, password_hash, role, version, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(doc["_id"]), doc["username"], doc["email"], doc.get("password_hash"), doc["role"],
+             doc.get("version", 1), _ts(doc.get("created_at")), _ts(doc.get("updated_at"))),
+        )
+
+    async def users_version(self):
+        with timed("sqlite", "meta.find_one"):
+            return str(self.open().execute("SELECT value FROM meta WHERE key = 'users_version'").fetchone()[0])
+
+    async def insert_user(self, doc: dict):
+        conn = self.open()
+        try:
+            with timed("sqlite", "users.insert"):
+                self._insert(conn, doc)
+        except sqlite3.IntegrityError as e:
+            raise DuplicateUserError(_sqlite_duplicate_field(e))
+        return doc
+
+    async def insert_users(self, docs: list):
+        # Một transaction cho cả lô; dòng lỗi chỉ hủy câu INSERT của chính nó
+        conn = self.open()
+        errors = {}
+        with timed("sqlite", "users.insert_many"):
+            conn.execute("BEGIN")
+            try:
+                for i, doc in enumerate(docs):
+                    try:
+                        self._insert(conn, doc)
+                    except sqlite3.IntegrityError as e:
+                        errors[i] = f"{_sqlite_duplicate_field(e)} already exists"
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return errors
+
+    async def find_user_by_username(self, username: str):
+        with timed("sqlite", "users.find_one"):
+            row = self.open().execute(_USER_SELECT + " WHERE username = ?", (username,)).fetchone()
+        return self._user(row) if row else None
+
+    async def find_users_by_ids(self, ids: list):
+        if not ids:
+            return []
+        sql = _USER_SELECT + " WHERE id IN (" + ", ".join("?" * len(ids)) + ")"
+        with timed("sqlite", "users.find"):
+            rows = self.open().execute(sql, [str(i) for i in ids]).fetchall()
+        return [self._user(r) for r in rows]
+
+    def _where(self, filters: dict):
+        filters = filters or {}
+        clauses, params = [], []
+        if filters.get("role"):
+            clauses.append("role = ?")
+            params.append(filters["role"])
+        if filters.get("created_from"):
+            clauses.append("created_at >= ?")
+            params.append(_ts(filters["created_from"]))
+        if filters.get("created_to"):
+            clauses.append("created_at < ?")
+            params.append(_ts(filters["created_to"]))
+        if filters.get("username_prefix"):
+            clauses.append("username GLOB ?")
+            params.append(_glob_prefix(filters["username_prefix"]))
+        if filters.get("email_prefix"):
+            clauses.append("email GLOB ?")
+            params.append(_glob_prefix(filters["email_prefix"]))
+        return clauses, params
+
+    async def list_users(self, filters: dict = None, after: str = None, limit: int = 100, projection: dict = None):
+        clauses, params = self._where(filters)
+        field = sort_field(filters)
+        column = "id" if field == "_id" else field
+        if after:
+            key = decode_cursor(field, after)
+            if field == "_id":
+                clauses.append("id > ?")
+                params.append(str(key))
+            elif field in UNIQUE_SORT_FIELDS:
+                clauses.append(f"{column} > ?")
+                params.append(key[0])
+            else:
+                clauses.append(f"({column} > ? OR ({column} = ? AND id > ?))")
+                params += [_ts(key[0]), _ts(key[0]), str(key[1])]
+        order = column if field == "_id" or field in UNIQUE_SORT_FIELDS else f"{column}, id"
+        sql = _USER_SELECT + (" WHERE " + " AND ".join(clauses) if clauses else "") + f" ORDER BY {order} LIMIT ?"
+        with timed("sqlite", "users.find"):
+            rows = self.open().execute(sql, params + [limit]).fetchall()
+        return [self._user(r, projection) for r in rows]
+
+    async def count_users(self, filters: dict = None, exact: bool = False):
+        # SQLite không có số đếm theo metadata; chế độ xấp xỉ dừng ở ngưỡng như Mongo
+        clauses, params = self._where(filters)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        with timed("sqlite", "users.count"):
+            if exact:
+                n = self.open().execute("SELECT count(*) FROM users" + where, params).fetchone()[0]
+                return {"count": n, "exact": True}
+            n = self.open().execute(
+                "SELECT count(*) FROM (SELECT 1 FROM users" + where + " LIMIT ?)", params + [USER_COUNT_APPROX_LIMIT]
+            ).fetchone()[0]
+        return {"count": n, "exact": n < USER_COUNT_APPROX_LIMIT}
+
+    def _key(self, key: dict):
+        if "_id" in key:
+            return "id = ?", [str(key["_id"])]
+        return "username = ?", [key["username"]]
+
+    async def update_user(self, key: dict, fields: dict):
+        where, key_params = self._key(key)
+        sets = [f"{k} = ?" for k in fields if k in _USER_COLUMNS]
+        params = [_ts(v) if k in _USER_DATETIMES else v for k, v in fields.items() if k in _USER_COLUMNS]
+        sql = (f"UPDATE users SET {', '.join(sets + ['version = version + 1'])} WHERE {where} "
+               "RETURNING id, username, email, role, version")
+        conn = self.open()
+        try:
+            with timed("sqlite", "users.update"):
+                row = conn.execute(sql, params + key_params).fetchone()
+        except sqlite3.IntegrityError as e:
+            raise DuplicateUserError(_sqlite_duplicate_field(e))
+        if not row:
+            return None
+        return {"_id": ObjectId(row[0]), "username": row[1], "email": row[2], "role": row[3], "version": row[4]}
+
+    async def set_password_hash(self, user_id: ObjectId, old_hash: str, new_hash: str):
+        with timed("sqlite", "users.update"):
+            cursor = self.open().execute(
+                "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?", (new_hash, str(user_id), old_hash)
+            )
+        return cursor.rowcount == 1
+
+    async def delete_user(self, key: dict):
+        where, key_params = self._key(key)
+        conn = self.open()
+        with timed("sqlite", "users.delete"):
+            row = conn.execute(f"DELETE FROM users WHERE {where} RETURNING id, username", key_params).fetchone()
+        return {"_id": ObjectId(row[0]), "username": row[1]} if row else None
+
+    # Refresh token (app.refresh_store.EmbeddedRefreshStore)
+    async def refresh_insert(self, record: dict):
+        with timed("sqlite", "refresh_tokens.insert"):
+            self.open().execute(
+                "INSERT INTO refresh_tokens (token_hash, user_id, family_id, created_at, expires_at, used_at, replaced_by, revoked) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (record["token_hash"], record["user_id"], record["family_id"], _ts(record["created_at"]),
+                 _ts(record["expires_at"]), _ts(record.get("used_at")), record.get("replaced_by"),
+                 int(bool(record.get("revoked")))),
+            )
+
+    async def refresh_get(self, token_hash: str):
+        with timed("sqlite", "refresh_tokens.find_one"):
+            row = self.open().execute(_REFRESH_SELECT, (token_hash,)).fetchone()
+        if not row:
+            return None
+        return {
+            "token_hash": row[0],
+            "user_id": row[1],
+            "family_id": row[2],
+            "created_at": _dt(row[3]),
+            "expires_at": _dt(row[4]),
+            "used_at": _dt(row[5]),
+            "replaced_by": row[6],
+            "revoked": bool(row[7]),
+        }
+
+    async def refresh_mark_used(self, token_hash: str, replaced_by: str):
+        # UPDATE có điều kiện là nguyên tử, kể cả khi nhiều tiến trình mở cùng file
+        with timed("sqlite", "refresh_tokens.update"):
+            cur = self.open().execute(
+                "UPDATE refresh_tokens SET used_at = ?, replaced_by = ? WHERE token_hash = ? AND used_at IS NULL",
+                (_ts(datetime.utcnow()), replaced_by, token_hash),
+            )
+        return cur.rowcount == 1
+
+    async def refresh_delete(self, token_hash: str):
+        with timed("sqlite", "refresh_tokens.delete"):
+            self.open().execute("DELETE FROM refresh_tokens WHERE token_hash = ?", (token_hash,))
+
+    async def refresh_revoke_family(self, family_id: str):
+        with timed("sqlite", "refresh_tokens.update"):
+            self.open().execute("UPDATE refresh_tokens SET revoked = 1 WHERE family_id = ?", (family_id,))
+
+    async def refresh_revoke_user(self, user_id: str):
+        with timed("sqlite", "refresh_tokens.delete"):
+            self.open().execute("DELETE FROM refresh_tokens WHERE user_id = ?", (user_id,))
+
+    # Access token bị thu hồi (app.token_store.EmbeddedBlacklist), chỉ lưu hash
+    async def revoke_token(self, token_hash: str, expires_at: datetime, user_id: str = None):
+        with timed("sqlite", "revoked_tokens.insert"):
+            self.open().execute(
+                "INSERT OR IGNORE INTO revoked_tokens (token_hash, user_id, expires_at, blacklisted_at) VALUES (?, ?, ?, ?)",
+                (token_hash, user_id, _ts(expires_at), _ts(datetime.utcnow())),
+            )
+
+    async def revoked_hashes(self, hashes: list):
+        if not hashes:
+            return set()
+        sql = ("SELECT token_hash FROM revoked_tokens WHERE expires_at > ? AND token_hash IN ("
+               + ", ".join("?" * len(hashes)) + ")")
+        with timed("sqlite", "revoked_tokens.find"):
+            rows = self.open().execute(sql, [_ts(datetime.utcnow())] + list(hashes)).fetchall()
+        return {r[0] for r in rows}
+
+    # Sự kiện audit: cột để lọc, phần còn lại giữ nguyên dạng JSON
+    async def insert_events(self, docs: list):
+        rows = [(_ts(d["at"]), d["event"], d.get("username"), orjson.dumps({k: v for k, v in d.items() if k != "_id"}))
+                for d in docs]
+        conn = self.open()
+        with timed("sqlite", "audit_events.insert_many"):
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT INTO audit_events (at, event, username, data) VALUES (?, ?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def iter_events(self, filters: dict = None, batch_size: int = 500):
+        filters = filters or {}
+        clauses, params = [], []
+        for column in ("event", "username"):
+            if filters.get(column):
+                clauses.append(f"{column} = ?")
+                params.append(filters[column])
+        if filters.get("since"):
+            clauses.append("at >= ?")
+            params.append(_ts(_naive_utc(filters["since"])))
+        if filters.get("until"):
+            clauses.append("at < ?")
+            params.append(_ts(_naive_utc(filters["until"])))
+        last = (None, 0)
+        while True:
+            page = clauses + (["(at > ? OR (at = ? AND id > ?))"] if last[0] else [])
+            sql = ("SELECT id, at, data FROM audit_events" + (" WHERE " + " AND ".join(page) if page else "")
+                   + " ORDER BY at, id LIMIT ?")
+            with timed("sqlite", "audit_events.find"):
+                rows = self.open().execute(sql, params + ([last[0], last[0], last[1]] if last[0] else []) + [batch_size]).fetchall()
+            if not rows:
+                break
+            last = (rows[-1][1], rows[-1][0])
+            docs = []
+            for _, at, data in rows:
+                doc = orjson.loads(data)
+                doc["at"] = _dt(at)
+                docs.append(doc)
+            yield docs
+            if len(rows) < batch_size:
+                break
+
+    def purge_expired(self):
+        conn = self.open()
+        now = datetime.utcnow()
+        conn.execute("DELETE FROM refresh_tokens WHERE expires_at < ?", (_ts(now),))
+        conn.execute("DELETE FROM revoked_tokens WHERE expires_at < ?", (_ts(now),))
+        conn.execute("DELETE FROM audit_events WHERE at < ?", (_ts(now - timedelta(days=database.AUDIT_RETENTION_DAYS)),))
+
+class MemoryStorage(_EmbeddedStorage):
+    """Dict trong tiến trình: lookup theo id/username là một phép tra dict.
+    Danh sách và đếm quét toàn bộ user, đủ cho dữ liệu nhỏ và test."""
+
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._users = {}          # ObjectId -> document
+        self._by_username = {}
+        self._by_email = {}
+        self._refresh = {}        # token_hash -> record
+        self._revoked = {}        # token_hash -> expires_at
+        self._events = deque(maxlen=AUDIT_MEMORY_MAX_EVENTS)
+        # Bắt đầu ngẫu nhiên: khởi động lại (dữ liệu trống) thì ETag cũ không trùng
+        self._users_version = int.from_bytes(os.urandom(4), "big")
+
+    def open(self):
+        return self
+
+    def _check_unique(self, doc: dict, own_id=None):
+        for field, index in (("username", self._by_username), ("email", self._by_email)):
+            other = index.get(doc.get(field))
+            if other is not None and other != own_id:
+                raise DuplicateUserError(field)
+
+    def _index(self, doc: dict):
+        self._users[doc["_id"]] = doc
+        self._by_username[doc["username"]] = doc["_id"]
+        self._by_email[doc["email"]] = doc["_id"]
+
+    def _unindex(self, doc: dict):
+        self._users.pop(doc["_id"], None)
+        self._by_username.pop(doc["username"], None)
+        self._by_email.pop(doc["email"], None)
+
+    async def users_version(self):
+        return str(self._users_version)
+
+    async def insert_user(self, doc: dict):
+        with timed("memory", "users.insert"):
+            self._check_unique(doc)
+            doc.setdefault("_id", ObjectId())
+            self._index(dict(doc))
+            self._users_version += 1
+        return doc
+
+    async def insert_users(self, docs: list):
+        errors = {}
+        for i, doc in enumerate(docs):
+            try:
+                await self.insert_user(doc)
+            except DuplicateUserError as e:
+                errors[i] = f"{e.field} already exists"
+        return errors
+
+    async def find_user_by_username(self, username: str):
+        with timed("memory", "users.find_one"):
+            user_id = self._by_username.get(username)
+            return dict(self._users[user_id]) if user_id is not None else None
+
+    async def find_users_by_ids(self, ids: list):
+        with timed("memory", "users.find"):
+            return [dict(self._users[i]) for i in ids if i in self._users]
+
+    def _matches(self, doc: dict, filters: dict):
+        if filters.get("role") and doc["role"] != filters["role"]:
+            return False
+        created = doc.get("created_at")
+        if filters.get("created_from") and (created is None or created < _naive_utc(filters["created_from"])):
+            return False
+        if filters.get("created_to") and (created is None or created >= _naive_utc(filters["created_to"])):
+            return False
+        if filters.get("username_prefix") and not doc["username"].startswith(filters["username_prefix"]):
+            return False
+        if filters.get("email_prefix") and not doc["email"].startswith(filters["email_prefix"]):
+            return False
+        return True
+
+    def _select(self, filters: dict = None):
+        filters = filters or {}
+        return [d for d in self._users.values() if self._matches(d, filters)]
+
+    async def list_users(self, filters: dict = None, after: str = None, limit: int = 100, projection: dict = None):
+        field = sort_field(filters)
+        with timed("memory", "users.find"):
+            docs = self._select(filters)
+            if field == "_id" or field in UNIQUE_SORT_FIELDS:
+                sort_key = lambda d: d[field]
+            else:
+                sort_key = lambda d: (d[field], d["_id"])
+            if after:
+                key = decode_cursor(field, after)
+                bound = key if field == "_id" else key[0] if field in UNIQUE_SORT_FIELDS else key
+                docs = [d for d in docs if sort_key(d) > bound]
+            docs.sort(key=sort_key)
+            return [_project(d, projection) for d in docs[:limit]]
+
+    async def count_users(self, filters: dict = None, exact: bool = False):
+        with timed("memory", "users.count"):
+            return {"count": len(self._select(filters)), "exact": True}
+
+    def _find(self, key: dict):
+        user_id = key["_id"] if "_id" in key else self._by_username.get(key["username"])
+        return self._users.get(user_id)
+
+    async def update_user(self, key: dict, fields: dict):
+        with timed("memory", "users.update"):
+            doc = self._find(key)
+            if doc is None:
+                return None
+            updated = {**doc, **fields, "version": doc.get("version", 0) + 1}
+            self._check_unique(updated, own_id=doc["_id"])
+            self._unindex(doc)
+            self._index(updated)
+            self._users_version += 1
+            return _project(updated, USER_WRITE_PROJECTION)
+
+    async def set_password_hash(self, user_id: ObjectId, old_hash: str, new_hash: str):
+        with timed("memory", "users.update"):
+            doc = self._users.get(user_id)
+            if doc is None or doc.get("password_hash") != old_hash:
+                return False
+            doc["password_hash"] = new_hash
+            return True
+
+    async def delete_user(self, key: dict):
+        with timed("memory", "users.delete"):
+            doc = self._find(key)
+            if doc is None:
+                return None
+            self._unindex(doc)
+            self._users_version += 1
+            return {"_id": doc["_id"], "username": doc["username"]}
+
+    async def refresh_insert(self, record: dict):
+        self._refresh[record["token_hash"]] = dict(record)
+
+    async def refresh_get(self, token_hash: str):
+        record = self._refresh.get(token_hash)
+        return dict(record) if record is not None else None
+
+    async def refresh_mark_used(self, token_hash: str, replaced_by: str):
+        record = self._refresh.get(token_hash)
+        if record is None or record.get("used_at") is not None:
+            return False
+        record.update(used_at=datetime.utcnow(), replaced_by=replaced_by)
+        return True
+
+    async def refresh_delete(self, token_hash: str):
+        self._refresh.pop(token_hash, None)
+
+    async def refresh_revoke_family(self, family_id: str):
+        for record in self._refresh.values():
+            if record["family_id"] == family_id:
+                record["revoked"] = True
+
+    async def refresh_revoke_user(self, user_id: str):
+        for h in [h for h, r in self._refresh.items() if r["user_id"] == user_id]:
+            del self._refresh[h]
+
+    async def revoke_token(self, token_hash: str, expires_at: datetime, user_id: str = None):
+        self._revoked.setdefault(token_hash, expires_at)
+
+    async def revoked_hashes(self, hashes: list):
+        now = datetime.utcnow()
+        return {h for h in hashes if h in self._revoked and self._revoked[h] > now}
+
+    async def insert_events(self, docs: list):
+        self._events.extend({k: v for k, v in d.items() if k != "_id"} for d in docs)
+
+    async def iter_events(self, filters: dict = None, batch_size: int = 500):
+        filters = filters or {}
+        since, until = _naive_utc(filters.get("since")), _naive_utc(filters.get("until"))
+        docs = [
+            dict(d) for d in self._events
+            if (not filters.get("event") or d["event"] == filters["event"])
+            and (not filters.get("username") or d.get("username") == filters["username"])
+            and (since is None or d["at"] >= since)
+            and (until is None or d["at"] < until)
+        ]
+        docs.sort(key=lambda d: d["at"])
+        for i in range(0, len(docs), batch_size):
+            yield docs[i:i + batch_size]
+
+    def purge_expired(self):
+        now = datetime.utcnow()
+        for h in [h for h, r in self._refresh.items() if r["expires_at"] < now]:
+            del self._refresh[h]
+        for h in [h for h, exp in self._revoked.items() if exp < now]:
+            del self._revoked[h]
+        cutoff = now - timedelta(days=database.AUDIT_RETENTION_DAYS)
+        while self._events and self._events[0]["at"] < cutoff:
+            self._events.popleft()
+
+BACKENDS = {"mongo": MongoStorage, "sqlite": SQLiteStorage, "memory": MemoryStorage}
+
+_storage = None
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND not in BACKENDS:
+            raise RuntimeError(f"Unknown STORAGE_BACKEND={STORAGE_BACKEND!r} (expected {', '.join(BACKENDS)})")
+        _storage = BACKENDS[STORAGE_BACKEND]()
+    return _storage
+
+def is_embedded():
+    return STORAGE_BACKEND != "mongo"
+
+async def init(on_leader=None):
+    # Mongo: migration + lock startup (database.init_db); nhúng: tạo schema
+    return await get_storage().init(on_leader=on_leader)
+
+async def ping():
+    await get_storage().ping()
+
+async def start():
+    await get_storage().start()
+
+async def stop():
+    if _storage is not None:
+        await _storage.stop()
@@ -0,0 +1,12 @@
+import importlib.util
+import sys
+from pathlib import Path
+
+# Thư mục gốc repo chính là package app (mã nguồn import "from app...")
+ROOT = Path(__file__).resolve().parent.parent
+
+if "app" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("app", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["app"] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from app.bulk import iter_lines, iter_rows
+
+CSV = (b'username,email,password\r\n'
+       b'alice,alice@example.com,"multi\r\nline, pass"\r\n'
+       b'\r\n'
+       b'bob,bob@example.com,"say ""hi"""\r\n'
+       b'carol,carol@example.com,"x"y\r\n'
+       b'dave,dave@example.com,\r\n'
+       b'eve,"unterminated\r\n')
+
+async def _chunks(data, size):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+def _rows(data, size, fmt):
+    async def main():
+        return [r async for r in iter_rows(iter_lines(_chunks(data, size)), fmt)]
+    return asyncio.run(main())
+
+@pytest.mark.parametrize("size", [1, 7, 64 * 1024])
+def test_csv_rows_across_chunks_and_quoted_newlines(size):
+    rows = _rows(CSV, size, "csv")
+    assert rows[0] == ({"username": "alice", "email": "alice@example.com", "password": "multi\nline, pass"}, None)
+    assert rows[1] == ({"username": "bob", "email": "bob@example.com", "password": 'say "hi"'}, None)
+    assert rows[2][0] is None and rows[2][1].startswith("Invalid CSV")
+    # Ô trống coi như không có giá trị
+    assert rows[3] == ({"username": "dave", "email": "dave@example.com"}, None)
+    assert rows[4] == (None, "Invalid CSV: unterminated quoted field")
+    assert len(rows) == 5
+
+def test_ndjson_rows():
+    data = b'{"username": "alice", "role": ""}\n\nnot json\n[1]\n{"username": "bob"}'
+    assert _rows(data, 5, "ndjson") == [
+        ({"username": "alice"}, None),
+        (None, "Invalid JSON"),
+        (None, "Row must be a JSON object"),
+        ({"username": "bob"}, None),
+    ]
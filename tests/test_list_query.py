@@ -0,0 +1,83 @@
+import asyncio
+import base64
+import json
+import os
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+from app import database
+from app.cli import _explain_cases, _plan_stages
+from app.crud_user import check_cursor
+from app.storage import build_list_query, encode_cursor, list_projection, sort_field
+
+SAMPLE = {"_id": ObjectId(), "username": "admin", "email": "admin@example.com", "created_at": datetime(2024, 5, 1, 12, 30)}
+
+def _raw_cursor(value, last_id="0" * 24):
+    return base64.urlsafe_b64encode(json.dumps([value, last_id]).encode()).decode().rstrip("=")
+
+@pytest.mark.parametrize("filters", [{}, {"role": "user"}, {"username_prefix": "ad"}, {"email_prefix": "ad"},
+                                     {"created_from": SAMPLE["created_at"]}])
+def test_check_cursor_accepts_own_sort(filters):
+    check_cursor(filters, encode_cursor(SAMPLE, sort_field(filters)))
+
+@pytest.mark.parametrize("filters, cursor", [
+    ({}, "not-an-id"),
+    ({}, encode_cursor(SAMPLE, "username")),
+    ({"username_prefix": "ad"}, str(SAMPLE["_id"])),
+    ({"username_prefix": "ad"}, "%%%"),
+    ({"username_prefix": "ad"}, _raw_cursor(5)),
+    ({"username_prefix": "ad"}, _raw_cursor("admin", "bad-id")),
+    ({"created_from": SAMPLE["created_at"]}, _raw_cursor("yesterday")),
+    ({"created_from": SAMPLE["created_at"]}, encode_cursor(SAMPLE, "email")),
+])
+def test_check_cursor_rejects(filters, cursor):
+    with pytest.raises(ValueError):
+        check_cursor(filters, cursor)
+
+def test_created_at_cursor_round_trip():
+    query, sort, field = build_list_query({"created_to": datetime(2025, 1, 1)}, encode_cursor(SAMPLE, "created_at"))
+    assert field == "created_at"
+    assert sort == [("created_at", 1), ("_id", 1)]
+    assert query["$and"][1] == {
+        "created_at": {"$gte": SAMPLE["created_at"]},
+        "$or": [{"created_at": {"$gt": SAMPLE["created_at"]}}, {"_id": {"$gt": SAMPLE["_id"]}}],
+    }
+
+@pytest.fixture(scope="module")
+def mongo_url():
+    # Cần mongod thật (mongomock không có explain): MONGO_URL, bỏ qua nếu không kết nối được
+    pymongo = pytest.importorskip("pymongo")
+    url = os.getenv("MONGO_URL", "mongodb://localhost:27017")
+    client = pymongo.MongoClient(url, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("no mongod at MONGO_URL")
+    finally:
+        client.close()
+    return url
+
+@pytest.mark.parametrize("filters, after", _explain_cases(),
+                         ids=lambda v: ",".join(v) or "none" if isinstance(v, dict) else "page2" if v else "page1")
+def test_list_query_uses_index(mongo_url, filters, after):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    async def main():
+        client = AsyncIOMotorClient(mongo_url)
+        db = client["user_db_test_explain"]
+        try:
+            for _, _, migrate in database.MIGRATIONS:
+                await migrate(db)
+            query, sort, field = build_list_query(filters, after)
+            plan = await db["users"].find(query, list_projection(field)).sort(sort).limit(100).explain()
+            winning = plan["queryPlanner"]["winningPlan"]
+            return list(_plan_stages(winning.get("queryPlan", winning)))
+        finally:
+            await client.drop_database(db.name)
+            client.close()
+
+    stages = asyncio.run(main())
+    assert "IXSCAN" in stages
+    assert not {"COLLSCAN", "SORT"} & set(stages)
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import auth, ratelimit, refresh_store, revocation, token_store
+
+fakeredis = pytest.importorskip("fakeredis")
+
+@pytest.fixture(autouse=True)
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(token_store, "_redis", client)
+    monkeypatch.setattr(revocation, "_revoked", {})
+    return client
+
+@pytest.fixture
+def refresh(monkeypatch):
+    store = refresh_store.RedisRefreshStore()
+    monkeypatch.setattr(refresh_store, "_store", store)
+    return store
+
+def test_blacklist_shared_between_workers():
+    async def main():
+        blacklist = token_store.RedisBlacklist()
+        doc = {"token_hash": revocation.token_hash("t1"), "user_id": "u1",
+               "expires_at": datetime.utcnow() + timedelta(minutes=5)}
+        await blacklist.add(doc)
+        assert await blacklist.is_revoked("t1")
+        # Worker khác không có bản sao cục bộ: phải thấy qua Redis
+        revocation._revoked.clear()
+        assert await blacklist.is_revoked("t1")
+        assert not await blacklist.is_revoked("t2")
+        assert await blacklist.revoked_many(["t1", "t2"]) == {"t1"}
+        stats = blacklist.get_stats()
+        assert (stats["local_hits"], stats["revoked_hits"]) == (1, 1)
+        assert 0 < await token_store.get_redis().ttl(token_store.redis_key("bl", doc["token_hash"])) <= 300
+    asyncio.run(main())
+
+def test_refresh_rotation_and_reuse_detection(refresh):
+    async def main():
+        token = await auth.create_refresh_token("u1")
+        new_token, old = await auth.rotate_refresh_token(token)
+        assert old["user_id"] == "u1"
+        record = await refresh.get(auth._refresh_token_hash(token))
+        assert record["used_at"] is not None and record["replaced_by"] == auth._refresh_token_hash(new_token)
+        assert await auth.is_refresh_token_valid(new_token)
+
+        # Token cũ bị gửi lại: thu hồi cả family, kể cả token vừa cấp
+        assert await auth.rotate_refresh_token(token) is None
+        assert refresh.get_stats()["reuse_detected"] == 1
+        assert (await refresh.get(auth._refresh_token_hash(new_token)))["revoked"] is True
+        assert await auth.rotate_refresh_token(new_token) is None
+    asyncio.run(main())
+
+def test_refresh_concurrent_rotation_single_winner(refresh):
+    async def main():
+        token = await auth.create_refresh_token("u1")
+        results = await asyncio.gather(*(auth.rotate_refresh_token(token) for _ in range(5)))
+        assert sum(r is not None for r in results) == 1
+    asyncio.run(main())
+
+def test_refresh_revoke_user_and_delete(refresh):
+    async def main():
+        a = await auth.create_refresh_token("u1")
+        b = await auth.create_refresh_token("u1")
+        other = await auth.create_refresh_token("u2")
+        await auth.revoke_all_user_refresh_tokens("u1")
+        assert await refresh.get(auth._refresh_token_hash(a)) is None
+        assert await auth.rotate_refresh_token(b) is None
+        assert await auth.is_refresh_token_valid(other)
+
+        await auth.revoke_refresh_token(other)
+        assert await auth.is_refresh_token_valid(other) is None
+    asyncio.run(main())
+
+def test_window_limiter(monkeypatch):
+    now = [1000.0 * 60]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+
+    async def main():
+        limiter = ratelimit.RedisWindowLimiter("test", 3, 60)
+        assert [await limiter.hit("ip1") for _ in range(3)] == [0, 0, 0]
+        # peek không trừ lượt nhưng vẫn báo vượt giới hạn
+        assert await limiter.hit("ip1", peek=True) == 60
+        now[0] += 15
+        assert await limiter.hit("ip1") == 45
+        assert await limiter.hit("ip2") == 0
+        # Cửa sổ mới thì đếm lại từ đầu
+        now[0] += 45
+        assert await limiter.hit("ip1") == 0
+        assert limiter.stats()["rejected"] == 2
+        # Dùng chung giữa các worker: limiter khác cùng tên thấy cùng bộ đếm
+        other = ratelimit.RedisWindowLimiter("test", 3, 60)
+        assert [await other.hit("ip1") for _ in range(3)] == [0, 0, 60]
+    asyncio.run(main())
+
+def test_window_limiter_falls_back_when_redis_fails(monkeypatch):
+    class Broken:
+        def pipeline(self, **kwargs):
+            raise ConnectionError("redis down")
+
+    monkeypatch.setattr(token_store, "_redis", Broken())
+
+    async def main():
+        limiter = ratelimit.RedisWindowLimiter("test", 2, 60)
+        assert [await limiter.hit("ip1") for _ in range(2)] == [0, 0]
+        assert await limiter.hit("ip1") > 0
+        assert limiter.stats()["errors"] == 3
+    asyncio.run(main())
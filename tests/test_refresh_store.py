@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from app import auth, database, refresh_store
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+@pytest.fixture
+def tiered(monkeypatch):
+    # Vòng ghi nền không kịp chạy trong test: mọi thao tác còn nằm trong lô chờ ghi
+    monkeypatch.setattr(refresh_store, "REFRESH_FLUSH_SECONDS", 3600)
+    monkeypatch.setattr(database, "_client", mongomock_motor.AsyncMongoMockClient())
+    store = refresh_store.TieredRefreshStore()
+    monkeypatch.setattr(refresh_store, "_store", store)
+    return store
+
+async def _cold_token(user_id="u1", family_id="f1"):
+    # Token chỉ có trong Mongo (ví dụ cấp trước khi worker khởi động lại)
+    token = f"token-{user_id}-{family_id}"
+    await refresh_store._coll().insert_one(auth._refresh_record(token, user_id, family_id))
+    return token
+
+def test_revoke_family_blocks_cold_token_before_flush(tiered):
+    async def main():
+        await tiered.start()
+        try:
+            token = await _cold_token()
+            await tiered.revoke_family("f1")
+            assert tiered.get_stats()["pending"] == 1
+            assert await auth.rotate_refresh_token(token) is None
+            assert await auth.is_refresh_token_valid(token) is None
+        finally:
+            await tiered.stop()
+        assert (await refresh_store._coll().find_one({}))["revoked"] is True
+    asyncio.run(main())
+
+def test_revoke_user_blocks_cold_token_before_flush(tiered):
+    async def main():
+        await tiered.start()
+        try:
+            token = await _cold_token()
+            other = await _cold_token(user_id="u2", family_id="f2")
+            await tiered.revoke_user("u1")
+            assert await auth.rotate_refresh_token(token) is None
+            assert await auth.rotate_refresh_token(other) is not None
+            # Đăng nhập lại sau khi thu hồi vẫn dùng được token mới
+            fresh = await auth.create_refresh_token("u1")
+            assert await auth.rotate_refresh_token(fresh) is not None
+        finally:
+            await tiered.stop()
+    asyncio.run(main())
+
+def test_reuse_of_cold_token_revokes_family(tiered):
+    async def main():
+        await tiered.start()
+        try:
+            token = await _cold_token()
+            new_token, _ = await auth.rotate_refresh_token(token)
+            assert await auth.rotate_refresh_token(token) is None
+            assert await auth.rotate_refresh_token(new_token) is None
+        finally:
+            await tiered.stop()
+    asyncio.run(main())
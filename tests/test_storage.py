@@ -0,0 +1,150 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from app import database, storage
+from app.storage import DuplicateUserError, encode_cursor, list_projection, sort_field
+
+BACKENDS = ["memory", "sqlite", "mongomock"]
+
+async def _open(backend, tmp_path):
+    if backend == "memory":
+        return storage.MemoryStorage()
+    if backend == "sqlite":
+        return storage.SQLiteStorage(str(tmp_path / "users.db"))
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+    # Unique index của users nằm trong migration
+    for _, _, migrate in database.MIGRATIONS:
+        await migrate(db)
+    return storage.MongoStorage(db)
+
+def _user(name, role="user", at=None):
+    return {
+        "_id": ObjectId(),
+        "username": name,
+        "email": f"{name}@example.com",
+        "password_hash": "hash-" + name,
+        "role": role,
+        "version": 1,
+        "created_at": at or datetime.utcnow().replace(microsecond=0),
+    }
+
+def _run(backend, tmp_path, case):
+    async def main():
+        store = await _open(backend, tmp_path)
+        try:
+            await case(store)
+        finally:
+            if backend == "sqlite":
+                store.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_insert_and_duplicate(backend, tmp_path):
+    async def case(store):
+        alice = await store.insert_user(_user("alice"))
+        assert (await store.find_user_by_username("alice"))["_id"] == alice["_id"]
+        with pytest.raises(DuplicateUserError) as e:
+            await store.insert_user({**_user("alice"), "email": "other@example.com"})
+        assert e.value.field == "username"
+        with pytest.raises(DuplicateUserError) as e:
+            await store.insert_user({**_user("other"), "email": "alice@example.com"})
+        assert e.value.field == "email"
+
+        errors = await store.insert_users([_user("bob"), _user("alice"), _user("carol")])
+        assert list(errors) == [1]
+        assert (await store.find_user_by_username("carol")) is not None
+    _run(backend, tmp_path, case)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_update_and_duplicate(backend, tmp_path):
+    async def case(store):
+        await store.insert_user(_user("alice"))
+        await store.insert_user(_user("bob"))
+        updated = await store.update_user({"username": "bob"}, {"role": "admin"})
+        assert (updated["role"], updated["version"]) == ("admin", 2)
+        assert (await store.find_user_by_username("bob"))["role"] == "admin"
+        with pytest.raises(DuplicateUserError):
+            await store.update_user({"username": "bob"}, {"username": "alice"})
+        with pytest.raises(DuplicateUserError):
+            await store.update_user({"username": "bob"}, {"email": "alice@example.com"})
+        assert (await store.find_user_by_username("bob"))["version"] == 2
+        assert await store.update_user({"username": "nobody"}, {"role": "admin"}) is None
+    _run(backend, tmp_path, case)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_delete(backend, tmp_path):
+    async def case(store):
+        alice = await store.insert_user(_user("alice"))
+        deleted = await store.delete_user({"username": "alice"})
+        assert deleted["_id"] == alice["_id"]
+        assert await store.find_user_by_username("alice") is None
+        assert await store.delete_user({"username": "alice"}) is None
+        # Xóa xong thì tạo lại được cùng username/email
+        await store.insert_user(_user("alice"))
+    _run(backend, tmp_path, case)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("filters, expected", [
+    ({}, ["alice", "albert", "bob", "carol", "alan"]),
+    ({"role": "user"}, ["bob", "carol", "alan"]),
+    ({"username_prefix": "al"}, ["alan", "albert", "alice"]),
+    ({"created_from": 1}, ["albert", "bob", "carol", "alan"]),
+])
+def test_list_with_cursor_and_count(backend, tmp_path, filters, expected):
+    # created_from/created_to tính bằng giây kể từ user đầu tiên
+    t0 = datetime.utcnow().replace(microsecond=0) - timedelta(days=1)
+    filters = {k: t0 + timedelta(seconds=v) if k.startswith("created_") else v for k, v in filters.items()}
+    names = [("alice", "admin"), ("albert", "admin"), ("bob", "user"), ("carol", "user"), ("alan", "user")]
+
+    async def case(store):
+        for i, (name, role) in enumerate(names):
+            await store.insert_user(_user(name, role, t0 + timedelta(seconds=i)))
+        field = sort_field(filters)
+        seen, after = [], None
+        while True:
+            docs = await store.list_users(filters, after, 2, list_projection(field))
+            seen.extend(d["username"] for d in docs)
+            if len(docs) < 2:
+                break
+            after = encode_cursor(docs[-1], field)
+        assert seen == expected
+        assert (await store.count_users(filters, exact=True)) == {"count": len(expected), "exact": True}
+    _run(backend, tmp_path, case)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_count_without_filters(backend, tmp_path):
+    async def case(store):
+        assert (await store.count_users({}, exact=True))["count"] == 0
+        await store.insert_users([_user("alice"), _user("bob")])
+        assert (await store.count_users({}))["count"] == 2
+        assert (await store.count_users({"role": "admin"}))["count"] == 0
+    _run(backend, tmp_path, case)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_users_version_changes_on_every_write(backend, tmp_path):
+    async def case(store):
+        seen = [await store.users_version()]
+
+        async def changed():
+            seen.append(await store.users_version())
+            return seen[-1] not in seen[:-1]
+
+        alice = await store.insert_user(_user("alice"))
+        assert await changed()
+        await store.insert_users([_user("bob")])
+        assert await changed()
+        await store.update_user({"username": "bob"}, {"role": "admin"})
+        assert await changed()
+        # Sửa rồi xóa (số user về như cũ) vẫn là hai version mới
+        await store.delete_user({"username": "bob"})
+        assert await changed()
+        await store.insert_user(_user("bob"))
+        assert await changed()
+        # Băm lại mật khẩu không đổi dữ liệu trả ra nên không đổi ETag
+        assert await store.set_password_hash(alice["_id"], "hash-alice", "rehashed")
+        assert await store.users_version() == seen[-1]
+    _run(backend, tmp_path, case)
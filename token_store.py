@@ -0,0 +1,200 @@
+import os
+from datetime import datetime
+
+from app import revocation, storage
+from app.database import get_db
+from app.metrics import timed
+
+# Nơi lưu blacklist access token và refresh token:
+#   TOKEN_BACKEND=mongo (mặc định): token_blacklist/refresh_tokens trong Mongo
+#   TOKEN_BACKEND=redis: key có TTL trong Redis, không tạo tải cho DB chính
+#   TOKEN_BACKEND=embedded: bảng của SQLite/bộ nhớ (mặc định khi STORAGE_BACKEND khác mongo)
+# REDIS_URL=fakeredis:// dùng fakeredis trong bộ nhớ (chạy thử không cần redis-server).
+# Session của SessionMiddleware vẫn là cookie đã ký, không đi qua đây.
+TOKEN_BACKEND = os.getenv("TOKEN_BACKEND", "embedded" if storage.is_embedded() else "mongo")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "2"))
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "auth:")
+
+_redis = None
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        if REDIS_URL.startswith("fakeredis://"):
+            try:
+                import fakeredis
+            except ImportError:
+                raise RuntimeError("REDIS_URL=fakeredis:// requires the fakeredis package")
+            _redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        else:
+            try:
+                import redis.asyncio as aioredis
+            except ImportError:
+                raise RuntimeError("TOKEN_BACKEND=redis requires the redis package")
+            pool = aioredis.ConnectionPool.from_url(
+                REDIS_URL,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                decode_responses=True,
+            )
+            _redis = aioredis.Redis(connection_pool=pool)
+    return _redis
+
+def redis_key(*parts):
+    return REDIS_PREFIX + ":".join(parts)
+
+def _ttl_seconds(expires_at: datetime):
+    return max(1, int((expires_at - datetime.utcnow()).total_seconds()))
+
+class MongoBlacklist:
+    """Ghi token_blacklist trong Mongo, đọc từ bản sao trong bộ nhớ (app.revocation)."""
+
+    name = "mongo"
+
+    async def start(self):
+        await revocation.start()
+
+    async def stop(self):
+        await revocation.stop()
+
+    async def add(self, doc: dict):
+        # Cập nhật bộ nhớ cục bộ trước, các worker khác nhận qua polling
+        revocation.add(doc["token_hash"], doc["expires_at"])
+        with timed("mongo", "token_blacklist.update_one"):
+            await get_db()["token_blacklist"].update_one({"token": doc["token"]}, {"$setOnInsert": doc}, upsert=True)
+
+    async def is_revoked(self, token: str):
+        return revocation.is_revoked(token)
+
+    async def revoked_many(self, tokens: list):
+        # Bản sao trong bộ nhớ có thể trễ một chu kỳ poll: phần còn lại hỏi Mongo một lần bằng $in
+        revoked = {t for t in tokens if revocation.is_revoked(t)}
+        rest = [t for t in tokens if t not in revoked]
+        if rest:
+            with timed("mongo", "token_blacklist.find"):
+                docs = await get_db()["token_blacklist"].find(
+                    {"token": {"$in": rest}, "expires_at": {"$gt": datetime.utcnow()}},
+                    {"_id": 0, "token": 1, "token_hash": 1, "expires_at": 1},
+                ).to_list(length=len(rest))
+            for doc in docs:
+                revocation.add(doc.get("token_hash") or revocation.token_hash(doc["token"]), doc["expires_at"])
+                revoked.add(doc["token"])
+        return revoked
+
+    def get_stats(self):
+        return {"backend": self.name, **revocation.get_stats()}
+
+class RedisBlacklist:
+    """Mỗi token bị thu hồi là một key hết hạn cùng lúc với token.
+    Token do chính worker này thu hồi được nhớ cục bộ, không cần hỏi Redis."""
+
+    name = "redis"
+
+    def __init__(self):
+        self._stats = {"checks": 0, "local_hits": 0, "redis_checks": 0, "revoked_hits": 0}
+
+    async def start(self):
+        await get_redis().ping()
+        print("✅ Redis token store connected")
+
+    async def stop(self):
+        pass
+
+    async def add(self, doc: dict):
+        revocation.add(doc["token_hash"], doc["expires_at"])
+        with timed("redis", "blacklist.set"):
+            await get_redis().set(
+                redis_key("bl", doc["token_hash"]),
+                doc.get("user_id") or "unknown",
+                ex=_ttl_seconds(doc["expires_at"]),
+            )
+
+    async def is_revoked(self, token: str):
+        self._stats["checks"] += 1
+        h = revocation.token_hash(token)
+        if revocation.is_revoked(token):
+            self._stats["local_hits"] += 1
+            return True
+        self._stats["redis_checks"] += 1
+        with timed("redis", "blacklist.exists"):
+            revoked = await get_redis().exists(redis_key("bl", h)) > 0
+        if revoked:
+            self._stats["revoked_hits"] += 1
+        return revoked
+
+    async def revoked_many(self, tokens: list):
+        revoked = {t for t in tokens if revocation.is_revoked(t)}
+        rest = [t for t in tokens if t not in revoked]
+        if rest:
+            self._stats["redis_checks"] += 1
+            with timed("redis", "blacklist.mget"):
+                values = await get_redis().mget([redis_key("bl", revocation.token_hash(t)) for t in rest])
+            revoked.update(t for t, v in zip(rest, values) if v is not None)
+        return revoked
+
+    def get_stats(self):
+        return {"backend": self.name, **self._stats}
+
+class EmbeddedBlacklist:
+    """Blacklist trong backend nhúng (app.storage), chỉ lưu hash của token.
+    Tra cứu là một câu SELECT theo khóa chính hoặc một phép tra dict."""
+
+    name = "embedded"
+
+    def __init__(self):
+        self._stats = {"checks": 0, "revoked_hits": 0}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def add(self, doc: dict):
+        await storage.get_storage().revoke_token(doc["token_hash"], doc["expires_at"], doc.get("user_id"))
+
+    async def is_revoked(self, token: str):
+        self._stats["checks"] += 1
+        revoked = bool(await storage.get_storage().revoked_hashes([revocation.token_hash(token)]))
+        if revoked:
+            self._stats["revoked_hits"] += 1
+        return revoked
+
+    async def revoked_many(self, tokens: list):
+        hashes = {revocation.token_hash(t): t for t in tokens}
+        return {hashes[h] for h in await storage.get_storage().revoked_hashes(list(hashes))}
+
+    def get_stats(self):
+        return {"backend": self.name, "storage": storage.STORAGE_BACKEND, **self._stats}
+
+_blacklist = None
+
+def get_blacklist():
+    global _blacklist
+    if _blacklist is None:
+        if TOKEN_BACKEND == "redis":
+            _blacklist = RedisBlacklist()
+        elif TOKEN_BACKEND == "embedded":
+            _blacklist = EmbeddedBlacklist()
+        else:
+            _blacklist = MongoBlacklist()
+    return _blacklist
+
+async def start():
+    try:
+        await get_blacklist().start()
+    except Exception as e:
+        print(f"⚠️ Could not start {TOKEN_BACKEND} token store: {e}")
+
+async def stop():
+    global _redis
+    if _blacklist is not None:
+        await _blacklist.stop()
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+
+def get_stats():
+    return get_blacklist().get_stats()
@@ -1,33 +1,79 @@
-from datetime import datetime
-from bson import ObjectId
-import json
-
-class JSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        return super().default(obj)
-
-def oid_str(doc):
-    if doc is None:
-        return None
-    
-    new_doc = doc.copy()
-    
-    # Chuyển tất cả ObjectId thành string
-    if "_id" in new_doc:
-        new_doc["_id"] = str(new_doc["_id"])
-    
-    # Chuyển tất cả datetime thành ISO string
-    for key, value in new_doc.items():
-        if isinstance(value, datetime):
-            new_doc[key] = value.isoformat()
-        elif isinstance(value, ObjectId):
-            new_doc[key] = str(value)
-    
-    return new_doc
-
-def oid_str_list(docs):
-    return [oid_str(d) for d in docs]
\ No newline at end of file
+from datetime import datetime
+from bson import ObjectId
+from starlette.responses import JSONResponse
+import json
+import orjson
+
+from app.metrics import timed
+
+class JSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        return super().default(obj)
+
+def oid_str(doc):
+    if doc is None:
+        return None
+    
+    new_doc = doc.copy()
+    
+    # Chuyển tất cả ObjectId thành string
+    if "_id" in new_doc:
+        new_doc["_id"] = str(new_doc["_id"])
+    
+    # Chuyển tất cả datetime thành ISO string
+    for key, value in new_doc.items():
+        if isinstance(value, datetime):
+            new_doc[key] = value.isoformat()
+        elif isinstance(value, ObjectId):
+            new_doc[key] = str(value)
+    
+    return new_doc
+
+def oid_str_list(docs):
+    return [oid_str(d) for d in docs]
+
+# Codec BSON -> output: dựng đúng hình dạng UserOut từ document (đã projection),
+# không copy toàn bộ document như oid_str
+def user_out(doc):
+    if doc is None:
+        return None
+    return {
+        "_id": str(doc["_id"]),
+        "username": doc.get("username"),
+        "email": doc.get("email"),
+        "role": doc.get("role"),
+    }
+
+def etag(*parts) -> str:
+    # Weak ETag: cùng nội dung về nghĩa, không cam kết giống từng byte
+    return 'W/"' + "-".join(str(p) for p in parts) + '"'
+
+def etag_matches(if_none_match: str, tag: str) -> bool:
+    # If-None-Match dùng so sánh yếu: bỏ tiền tố W/ ở cả hai phía
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = tag.removeprefix("W/")
+    return any(t.strip().removeprefix("W/") == opaque for t in if_none_match.split(","))
+
+def _orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+def dumps(obj) -> bytes:
+    # orjson tự xử lý datetime (ISO 8601), chỉ cần thêm ObjectId
+    return orjson.dumps(obj, default=_orjson_default)
+
+def ndjson_lines(docs) -> bytes:
+    return b"".join(orjson.dumps(d, default=_orjson_default, option=orjson.OPT_APPEND_NEWLINE) for d in docs)
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with timed("serialize", "orjson"):
+            return dumps(content)